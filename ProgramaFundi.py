@@ -1,20 +1,60 @@
 import json
 import os
-import requests
-from bs4 import BeautifulSoup
+import httpx
 from dotenv import load_dotenv
 import urllib.parse
 import re
-from datetime import datetime, timedelta
-import time
+import sys
+import traceback
+from datetime import datetime, timedelta, timezone
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import DuplicateKeyError, OperationFailure
 import asyncio
+import contextlib
+import copy
+import functools
+import html as html_lib
+import math
+import random
+import time
+import unicodedata
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, NamedTuple
+from zoneinfo import ZoneInfo
+
+try:
+    from lxml import etree
+except ImportError:  # lxml es opcional: sin él se usa el extractor por expresiones regulares
+    etree = None
+
+try:
+    import h2  # noqa: F401  (lo usa httpx para HTTP/2)
+except ImportError:  # h2 es opcional (httpx[http2]): sin él, solo HTTP/1.1
+    h2 = None
+
+try:
+    import brotli  # noqa: F401  (lo usa httpx para descomprimir br)
+except ImportError:
+    try:
+        import brotlicffi as brotli  # noqa: F401
+    except ImportError:  # brotli es opcional: sin él solo se anuncia gzip/deflate
+        brotli = None
 
 # =========================
 # Configuración
 # =========================
-URL_LOGIN = "https://deportesweb.madrid.es/DeportesWeb/Login"
-URL_HOME = "https://deportesweb.madrid.es/DeportesWeb/Home"
+# Servidor de reservas; URL_BASE en .env permite apuntar a otro (p. ej. benchmarks/servidor_simulado.py)
+URL_BASE = "https://deportesweb.madrid.es"
+URL_LOGIN = f"{URL_BASE}/DeportesWeb/Login"
+URL_HOME = f"{URL_BASE}/DeportesWeb/Home"
+
+# Compresión de respuestas que se anuncia al servidor (br solo si httpx puede descomprimirla)
+CODIFICACIONES_ACEPTADAS = "gzip, deflate, br" if brotli else "gzip, deflate"
+# HTTP/2 si h2 está instalado: se negocia por ALPN en el handshake TLS y, si el servidor no lo
+# ofrece, el cliente sigue en HTTP/1.1 sin más. En HTTP/2 todo va multiplexado por una conexión
+# (también los duplicados de Seleccionar, que salen como otro stream)
+USAR_HTTP2 = True
 
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:140.0) Gecko/20100101 Firefox/140.0",
@@ -23,7 +63,7 @@ HEADERS = {
     "X-Requested-With": "XMLHttpRequest",
     "X-MicrosoftAjax": "Delta=true",
     "Content-Type": "application/x-www-form-urlencoded; charset=utf-8",
-    "Origin": "https://deportesweb.madrid.es",
+    "Origin": URL_BASE,
     "Cache-Control": "no-cache",
     "Dnt": "1",
     "Sec-Gpc": "1",
@@ -32,6 +72,17 @@ HEADERS = {
     "Sec-Fetch-Site": "same-origin",
 }
 
+# Centros deportivos: código de instalación (SelectFacility) y menú "Oferta de actividades por día y centro"
+CENTROS = {
+    "La Fundi": {"facility_code": "2", "menu_code": "8580"},
+}
+CENTRO_POR_DEFECTO = "La Fundi"
+
+# Cada clase puede indicar su "centro" (por defecto CENTRO_POR_DEFECTO) y "alternativas":
+# clases equivalentes en otros centros que se intentan si la principal está llena, p. ej.
+#   {"dia": "lunes", "hora": "17:00", "nombre": "Pilates MesD",
+#    "alternativas": [{"centro": "Otro centro", "hora": "17:15"}]}
+# En las alternativas, "nombre" y "hora" se heredan de la clase si no se indican.
 CLASES = [
     {"dia": "lunes", "hora": "15:45", "nombre": "Fitness"},
     {"dia": "lunes", "hora": "17:00", "nombre": "Pilates MesD"},
@@ -53,55 +104,289 @@ DIAS_SEMANA = {
 
 HORAS_ANTES_APERTURA = 49
 
+# Zona horaria de las clases y de las aperturas (la del servidor), sea cual sea la del sistema
+ZONA_HORARIA = ZoneInfo("Europe/Madrid")
+
+# Días que se conserva cada reserva en BD desde que se guarda (índice TTL sobre timestamp)
+DIAS_EXPIRACION_RESERVAS = 8
+# Versión de los índices de DatabaseManager.inicializar: subirla al cambiarlos para que se vuelvan a crear
+VERSION_INDICES = 2
+
+# Informes de latencia: carpeta de los JSON de cada ejecución y días que se conservan sus resúmenes en BD
+DIRECTORIO_INFORMES = "informes"
+DIAS_EXPIRACION_INFORMES = 30
+
+# Modo multicuenta: cuentas que hacen login y navegación a la vez
+MAX_CUENTAS_EN_PARALELO = 3
+
+# Modo daemon: antelación con la que se despierta antes de cada apertura y espera tras un ciclo fallido
+ANTELACION_DESPERTAR = 10 * 60
+REINTENTO_DAEMON = 60
+
+# Planificador: con coste de preparación medido (del inicio del ciclo a tener los disparos listos, el
+# mayor de las últimas EJECUCIONES_COSTE_PREPARACION) se despierta ese coste + MARGEN_DESPERTAR antes
+# de la apertura; sin medidas, ANTELACION_DESPERTAR
+MARGEN_DESPERTAR = 120
+EJECUCIONES_COSTE_PREPARACION = 10
+# Horario de cron (--horario): cada ejecución arranca ANTELACION_PROGRAMADOR antes de su apertura (retraso
+# de la cola de GitHub Actions + despertar) y solo atiende las suyas; comparten ejecución las aperturas
+# separadas menos de eso, porque una ejecución propia arrancaría antes de la anterior
+ANTELACION_PROGRAMADOR = 15 * 60 + ANTELACION_DESPERTAR
+SEMANAS_HORARIO = 52
+
+# Validez supuesta de una sesión guardada cuando la cookie Token no indica caducidad
+HORAS_VALIDEZ_SESION = 12
+
+# TTL estimado de los tokens de navegación (por cuenta y centro): cada rechazo lo acerca a su edad con
+# este peso, así que un rechazo aislado no lo hunde; se siguen probando tokens hasta un
+# MARGEN_EXPLORACION_TOKENS por encima de la estimación para que los usos válidos la suban
+PESO_RECHAZO_TOKENS = 0.5
+MARGEN_EXPLORACION_TOKENS = 0.25
+
+# Desfase respecto a la hora de apertura con el que se dispara la reserva (negativo = antes)
+OFFSET_DISPARO_MS = 0
+# Últimos segundos antes del disparo que se esperan activamente en lugar de dormir
+MARGEN_SPIN_SEGUNDOS = 0.3
+
+# Reintentos de Seleccionar: ventana máxima desde el primer envío, pausa mientras la sesión aún
+# no está abierta y esperas crecientes ante errores transitorios (5xx, timeouts, deltas rotos)
+VENTANA_REINTENTOS_SEGUNDOS = 3.0
+PAUSA_NO_ABIERTA_MS = 20
+ESPERAS_TRANSITORIO_MS = (50, 100, 200, 400)
+# Copia del POST por otra conexión del pool si no hay respuesta en max(RETARDO_DUPLICADO_MS, 2 × RTT mínimo)
+DUPLICAR_SELECCION = True
+RETARDO_DUPLICADO_MS = 100
+# Segundos antes de la apertura en los que se abren (calientan) las conexiones del disparo
+ANTELACION_CALENTAMIENTO = 2.0
+# Confirmar juntas las clases que están en el carrito (un solo GET CarritoConfirmar + POST ConfirmCart).
+# Se desactiva sola si el servidor no admite varias sesiones en el carrito
+AGRUPAR_CARRITO = True
+
+# Vigilancia de cancelaciones (--vigilar): tras las reservas, sigue consultando las clases llenas hasta
+# HORAS_VIGILANCIA horas. INTERVALO_VIGILANCIA es la pausa base entre consultas de una misma fecha y
+# centro, que se alarga lejos de la clase (donde apenas hay cancelaciones), con un jitter relativo.
+VIGILAR_CANCELACIONES = False
+HORAS_VIGILANCIA = 5
+INTERVALO_VIGILANCIA = 30
+JITTER_VIGILANCIA = 0.3
+
+# Segundos durante los que se reutilizan los eventos ya cargados de una fecha
+FRESCURA_CACHE_EVENTOS = 10 * 60
+
+# Motor para leer los campos ocultos de las páginas completas: "regex" o "lxml" (si está instalado)
+BACKEND_CAMPOS_OCULTOS = "regex"
+# Segundos que se espera al cerrar el cliente a que terminen de leerse los restos de páginas en streaming
+ESPERA_DRENAJES = 2.0
+
 # =========================
 # Gestión de BD
 # =========================
 
+class IndiceReservas:
+    """Reservas conocidas como conjunto de claves (nombre, hora, fecha "YYYY-MM-DD"), con consulta O(1)"""
+    
+    def __init__(self, documentos=()):
+        self._claves = {(d["nombre"], d["hora"], d["fecha"]) for d in documentos}
+    
+    def contiene(self, nombre: str, hora: str, fecha: str) -> bool:
+        return (nombre, hora, fecha) in self._claves
+    
+    def registrar(self, nombre: str, hora: str, fecha: str) -> None:
+        self._claves.add((nombre, hora, fecha))
+    
+    def __len__(self) -> int:
+        return len(self._claves)
+    
+    def __iter__(self):
+        return iter(sorted(self._claves, key=lambda clave: (clave[2], clave[1])))
+
+
 class DatabaseManager:
     def __init__(self, mongo_url: str):
         self.client = AsyncIOMotorClient(mongo_url)
         self.db = self.client["reservas_clases"]
         self.coleccion = self.db["clases_reservadas"]
+        self.sesiones = self.db["sesiones"]
+        self.cuentas = self.db["cuentas"]
+        self.ejecuciones = self.db["ejecuciones"]
+        self.esquema = self.db["esquema"]
+        # None = cuenta única configurada por .env (incluye las reservas anteriores al modo multicuenta)
+        self.cuenta = None
+        self.reservadas = IndiceReservas()
         print("✅ Conectado a MongoDB")
     
-    async def cargar_reservadas_recientes(self, dias_atras: int = 7):
-        """Carga las clases ya reservadas para filtrarlas del plan"""
-        await self.coleccion.delete_many({"fecha": {"$lt": (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")}})
+    def para_cuenta(self, cuenta: str) -> "DatabaseManager":
+        """Vista de la BD para una cuenta: comparte la conexión pero filtra y guarda sus propias reservas"""
+        vista = copy.copy(self)
+        vista.cuenta = cuenta
+        vista.reservadas = IndiceReservas()
+        return vista
+    
+    async def inicializar(self):
+        """
+        Crea los índices una sola vez: la versión creada se guarda en la colección `esquema`
+        y, si coincide con VERSION_INDICES, el arranque cuesta una sola lectura.
+        
+        clases_reservadas lleva un índice único (cuenta, fecha, nombre, hora): impide
+        duplicados, sirve las consultas de una cuenta por rango de fecha y las cubre con
+        la proyección de cargar_reservadas_recientes. Las reservas antiguas caducan solas por el índice
+        TTL sobre timestamp, sin delete_many en cada arranque.
+        """
+        version = await self.esquema.find_one({"_id": "indices"})
+        if version and version.get("version") == VERSION_INDICES:
+            return
+        
+        indices_reservas = [
+            IndexModel([("cuenta", ASCENDING), ("fecha", ASCENDING), ("nombre", ASCENDING), ("hora", ASCENDING)], unique=True, name="reserva_unica_cuenta"),
+            IndexModel([("timestamp", ASCENDING)], expireAfterSeconds=DIAS_EXPIRACION_RESERVAS * 24 * 3600, name="reserva_ttl"),
+        ]
+        indices_sesiones = [IndexModel([("email", ASCENDING)], unique=True, name="sesion_email")]
+        indices_ejecuciones = [
+            IndexModel([("fin", ASCENDING)], expireAfterSeconds=DIAS_EXPIRACION_INFORMES * 24 * 3600, name="ejecucion_ttl"),
+            # cargar_costes_preparacion: últimas ejecuciones de una cuenta
+            IndexModel([("email", ASCENDING), ("fin", DESCENDING)], name="ejecucion_email_fin"),
+        ]
+        try:
+            await asyncio.gather(
+                self.coleccion.create_indexes(indices_reservas),
+                self.sesiones.create_indexes(indices_sesiones),
+                self.ejecuciones.create_indexes(indices_ejecuciones),
+            )
+        except OperationFailure as e:
+            # Normalmente duplicados previos al índice único: se sigue funcionando sin él y se
+            # reintenta en el próximo arranque
+            print(f"⚠️ No se pudieron crear los índices de MongoDB: {e}")
+            return
+        
+        # El índice único sin cuenta (anterior al modo multicuenta) impediría que dos cuentas reserven la misma clase
+        if "reserva_unica" in await self.coleccion.index_information():
+            await self.coleccion.drop_index("reserva_unica")
+        
+        await self.esquema.update_one({"_id": "indices"}, {"$set": {"version": VERSION_INDICES}}, upsert=True)
+        print(f"🗂️ Índices de MongoDB creados (versión {VERSION_INDICES})")
+    
+    async def cargar_reservadas_recientes(self, dias_atras: int = 7) -> IndiceReservas:
+        """Carga las clases ya reservadas para filtrarlas del plan (también las usa guardar_reserva)"""
         fecha_inicio = (datetime.now() - timedelta(days=dias_atras)).strftime("%Y-%m-%d")
-        cursor = self.coleccion.find({"fecha": {"$gte": fecha_inicio}})
-        reservadas = await cursor.to_list(length=None)
+        cursor = self.coleccion.find(
+            {"cuenta": self.cuenta, "fecha": {"$gte": fecha_inicio}},
+            {"_id": 0, "fecha": 1, "nombre": 1, "hora": 1}
+        )
+        self.reservadas = IndiceReservas(await cursor.to_list(length=None))
         
-        if reservadas:
-            print(f"\n📚 Reservas en BD (últimos {dias_atras} días): {len(reservadas)}")
-            for r in reservadas:
-                print(f"   - {r['nombre']} | {r['fecha']} {r['hora']}")
+        if self.reservadas:
+            print(f"\n📚 Reservas en BD (últimos {dias_atras} días): {len(self.reservadas)}")
+            for nombre, hora, fecha in self.reservadas:
+                print(f"   - {nombre} | {fecha} {hora}")
         
-        return reservadas
+        return self.reservadas
     
     async def guardar_reserva(self, clase: dict, fecha_clase: datetime) -> bool:
         """Guarda una reserva en la BD (llamar manualmente cuando confirmes la reserva)"""
         documento = {
+            "cuenta": self.cuenta,
             "nombre": clase["nombre"],
             "hora": clase["hora"],
-            "dia": clase["dia"],
             "fecha": fecha_clase.strftime("%Y-%m-%d"),
-            "timestamp": datetime.now()
         }
         
-        existe = await self.coleccion.find_one({
-            "nombre": documento["nombre"],
-            "hora": documento["hora"],
-            "fecha": documento["fecha"]
-        })
+        if self.reservadas.contiene(documento["nombre"], documento["hora"], documento["fecha"]):
+            print(f"ℹ️ Ya existe en BD: {documento['nombre']} - {documento['fecha']} {documento['hora']}")
+            return False
+        
+        # Upsert atómico: una sola petición y sin carrera entre ejecuciones solapadas
+        try:
+            resultado = await self.coleccion.update_one(
+                documento,
+                {"$setOnInsert": {"dia": clase["dia"], "timestamp": datetime.now()}},
+                upsert=True
+            )
+            insertada = resultado.upserted_id is not None
+        except DuplicateKeyError:
+            insertada = False
+        self.reservadas.registrar(documento["nombre"], documento["hora"], documento["fecha"])
         
-        if not existe:
-            await self.coleccion.insert_one(documento)
+        if insertada:
             print(f"💾 Guardada en BD: {documento['nombre']} - {documento['fecha']} {documento['hora']}")
             return True
         else:
             print(f"ℹ️ Ya existe en BD: {documento['nombre']} - {documento['fecha']} {documento['hora']}")
             return False
     
+    async def guardar_informe(self, email: str, resumen: dict) -> None:
+        """Guarda el resumen de latencias de una ejecución (sin las mediciones petición a petición)"""
+        await self.ejecuciones.insert_one({"cuenta": self.cuenta, "email": email, **resumen})
+    
+    async def cargar_costes_preparacion(self, email: str, ultimas: int) -> list[float]:
+        """Segundos de preparación (preparacion_s) de las `ultimas` ejecuciones de `email` que los midieron"""
+        cursor = self.ejecuciones.find(
+            {"email": email, "preparacion_s": {"$exists": True}}, {"preparacion_s": 1, "_id": 0}
+        ).sort("fin", -1).limit(ultimas)
+        return [documento["preparacion_s"] async for documento in cursor]
+    
+    async def cargar_cuentas(self) -> list[dict]:
+        """
+        Cuentas activas de la colección `cuentas`. Cada documento lleva email, password,
+        nombre y apellidos, y opcionalmente person_code y clases (si no, se usa CLASES).
+        """
+        cursor = self.cuentas.find({"activa": {"$ne": False}}, {"_id": 0})
+        return await cursor.to_list(length=None)
+    
+    async def guardar_sesion(self, email: str, cookies: list[dict], caducidad: datetime) -> None:
+        """Guarda las cookies de la sesión autenticada para reutilizarlas en la próxima ejecución"""
+        await self.sesiones.update_one(
+            {"email": email},
+            {"$set": {"cookies": cookies, "caducidad": caducidad, "timestamp": datetime.now()}},
+            upsert=True
+        )
+        print(f"💾 Sesión guardada en BD (válida hasta {caducidad.strftime('%d/%m/%Y %H:%M')})")
+    
+    async def cargar_sesion(self, email: str) -> list[dict] | None:
+        """Devuelve las cookies guardadas si siguen vigentes"""
+        documento = await self.sesiones.find_one({"email": email})
+        if not documento:
+            return None
+        if documento["caducidad"] <= datetime.now():
+            await self.sesiones.delete_one({"email": email})
+            return None
+        return documento["cookies"]
+    
+    async def guardar_tokens_navegacion(self, email: str, centro: str, token_centro: str, token_alta: str) -> None:
+        """Guarda los tokens de Centro y AltaEventos de un centro para saltarse su navegación en la próxima ejecución"""
+        codigo = CENTROS[centro]["facility_code"]
+        await self.sesiones.update_one(
+            {"email": email},
+            {"$set": {f"tokens.{codigo}": {"centro": token_centro, "alta": token_alta, "obtenidos": datetime.now()}}},
+            upsert=True
+        )
+    
+    async def cargar_tokens_navegacion(self, email: str, centro: str) -> dict | None:
+        """Tokens guardados del centro junto con su TTL estimado en segundos ("ttl", None si nunca se han rechazado)"""
+        codigo = CENTROS[centro]["facility_code"]
+        documento = await self.sesiones.find_one(
+            {"email": email},
+            {f"tokens.{codigo}": 1, f"ttl_tokens.{codigo}": 1}
+        )
+        if not documento or codigo not in documento.get("tokens", {}):
+            return None
+        return {**documento["tokens"][codigo], "ttl": documento.get("ttl_tokens", {}).get(codigo)}
+    
+    async def registrar_edad_tokens(self, email: str, centro: str, edad: float, validos: bool, ttl: float | None = None) -> None:
+        """
+        Ajusta el TTL estimado de los tokens de navegación del centro con la edad a la que
+        han funcionado o no.
+        
+        Un rechazo acerca la estimación (`ttl`, la cargada con los tokens) a su edad con peso
+        PESO_RECHAZO_TOKENS; un uso válido más viejo que la estimación la sube hasta su edad.
+        """
+        campo = f"ttl_tokens.{CENTROS[centro]['facility_code']}"
+        if validos:
+            # Sin rechazos aún no hay estimación que subir: los tokens se siguen probando siempre
+            await self.sesiones.update_one({"email": email, campo: {"$exists": True}}, {"$max": {campo: edad}})
+            return
+        estimado = edad if ttl is None else ttl + PESO_RECHAZO_TOKENS * (edad - ttl)
+        await self.sesiones.update_one({"email": email}, {"$set": {campo: estimado}})
+    
     def cerrar(self):
         self.client.close()
         print("👋 Conexión a MongoDB cerrada")
@@ -110,45 +395,57 @@ class DatabaseManager:
 # Cálculo de fechas
 # =========================
 
-def calcular_proxima_fecha_clase(dia_semana: str, hora: str) -> datetime:
-    ahora = datetime.now()
-    dia_num = DIAS_SEMANA[dia_semana.lower()]
+# El resto del programa trabaja con datetime naive en la hora local del sistema (la de datetime.now());
+# las fechas de clases y aperturas se calculan en ZONA_HORARIA y se convierten a esa hora local.
+
+def a_hora_local(instante: datetime) -> datetime:
+    """Instante con zona horaria -> datetime naive en la hora local del sistema"""
+    return instante.astimezone().replace(tzinfo=None)
+
+def antes_de(instante: datetime, segundos: float) -> datetime:
+    """`segundos` reales antes de `instante` (en UTC: restar en hora local falla en los cambios de hora)"""
+    return (instante.astimezone(timezone.utc) - timedelta(seconds=segundos)).astimezone(ZONA_HORARIA)
+
+def proximo_inicio_clase(dia_semana: str, hora: str, desde: datetime | None = None) -> datetime:
+    """Primer inicio de una clase semanal posterior a `desde` (por defecto, ahora), en ZONA_HORARIA"""
+    desde = (desde or datetime.now(ZONA_HORARIA)).astimezone(ZONA_HORARIA)
     hora_int, minuto_int = map(int, hora.split(":"))
-    
-    dias_hasta = (dia_num - ahora.weekday() + 7) % 7
-    
-    if dias_hasta == 0:
-        fecha_clase = ahora.replace(hour=hora_int, minute=minuto_int, second=0, microsecond=0)
-        if ahora >= fecha_clase:
-            dias_hasta = 7
-    
-    if dias_hasta == 0:
-        fecha_clase = ahora.replace(hour=hora_int, minute=minuto_int, second=0, microsecond=0)
-    else:
-        fecha_clase = ahora + timedelta(days=dias_hasta)
-        fecha_clase = fecha_clase.replace(hour=hora_int, minute=minuto_int, second=0, microsecond=0)
-    
-    return fecha_clase
+    fecha = desde.date() + timedelta(days=(DIAS_SEMANA[dia_semana.lower()] - desde.weekday()) % 7)
+    inicio = datetime(fecha.year, fecha.month, fecha.day, hora_int, minuto_int, tzinfo=ZONA_HORARIA)
+    if inicio <= desde:
+        # Misma hora de reloj una semana después (la aritmética con zona es de hora local)
+        inicio += timedelta(days=7)
+    return inicio
+
+def apertura_de_clase(inicio: datetime) -> datetime:
+    """
+    Apertura de una clase: HORAS_ANTES_APERTURA antes en hora de reloj de ZONA_HORARIA,
+    como se ha calculado siempre (también cuando hay un cambio de hora entre medias).
+    """
+    return (inicio.astimezone(ZONA_HORARIA) - timedelta(hours=HORAS_ANTES_APERTURA)).astimezone(ZONA_HORARIA)
+
+def calcular_proxima_fecha_clase(dia_semana: str, hora: str) -> datetime:
+    return a_hora_local(proximo_inicio_clase(dia_semana, hora))
 
 def calcular_hora_apertura(fecha_clase: datetime) -> datetime:
-    return fecha_clase - timedelta(hours=HORAS_ANTES_APERTURA)
+    return a_hora_local(apertura_de_clase(fecha_clase))
 
 def calcular_fecha_para_post(fecha_clase: datetime) -> str:
     hora_apertura = calcular_hora_apertura(fecha_clase)
     return hora_apertura.strftime("%Y-%m-%d")
 
-async def preparar_plan_de_reservas(db_manager=None):
+async def preparar_plan_de_reservas(db_manager=None, clases: list[dict] = CLASES):
     ahora = datetime.now()
     plan = []
     
-    # Solo considerar clases en los próximos 2 días completos (hasta el final del día +2)
-    limite_fecha = (ahora + timedelta(days=2)).replace(hour=23, minute=59, second=59)
+    # Solo considerar clases en los próximos 2 días completos (hasta el final del día +2, en ZONA_HORARIA)
+    limite_fecha = a_hora_local((datetime.now(ZONA_HORARIA) + timedelta(days=2)).replace(hour=23, minute=59, second=59))
     
-    reservadas = []
+    reservadas = IndiceReservas()
     if db_manager:
         reservadas = await db_manager.cargar_reservadas_recientes()
     
-    for clase in CLASES:
+    for clase in clases:
         fecha_clase = calcular_proxima_fecha_clase(clase["dia"], clase["hora"])
         
         # Filtrar: solo clases dentro de los próximos 2 días completos
@@ -160,14 +457,7 @@ async def preparar_plan_de_reservas(db_manager=None):
         fecha_para_post = calcular_fecha_para_post(fecha_clase)
         tiempo_hasta_apertura = (hora_apertura - ahora).total_seconds()
         
-        ya_reservada = any(
-            r["nombre"] == clase["nombre"] and
-            r["hora"] == clase["hora"] and
-            r["fecha"] == fecha_clase.strftime("%Y-%m-%d")
-            for r in reservadas
-        )
-        
-        if ya_reservada:
+        if reservadas.contiene(clase["nombre"], clase["hora"], fecha_clase.strftime("%Y-%m-%d")):
             print(f"⏭️ Saltando {clase['nombre']} {fecha_clase.strftime('%d/%m')} {clase['hora']} (ya en BD)")
             continue
         
@@ -188,7 +478,6 @@ def mostrar_plan_de_reservas(plan):
     print("📅 PLAN DE RESERVAS")
     print("="*80)
     
-    ahora = datetime.now()
     abiertas = sum(1 for p in plan if p["ya_abierta"])
     cerradas = len(plan) - abiertas
     
@@ -220,37 +509,712 @@ def mostrar_plan_de_reservas(plan):
     
     print("="*80 + "\n")
 
+# =========================
+# Planificador
+# =========================
+
+def aperturas_entre(desde: datetime, hasta: datetime, clases: list[dict] = CLASES) -> list[tuple[datetime, datetime, dict]]:
+    """
+    Aperturas de `clases` en (desde, hasta], ordenadas.
+    
+    Returns:
+        (apertura, inicio de la clase, clase), ambas fechas en ZONA_HORARIA
+    """
+    aperturas = []
+    for clase in clases:
+        inicio = proximo_inicio_clase(clase["dia"], clase["hora"], desde)
+        while apertura_de_clase(inicio) <= desde:
+            inicio += timedelta(days=7)
+        while (apertura := apertura_de_clase(inicio)) <= hasta:
+            aperturas.append((apertura, inicio, clase))
+            inicio += timedelta(days=7)
+    aperturas.sort(key=lambda x: x[0])
+    return aperturas
+
+def proxima_apertura(desde: datetime | None = None, clases: list[dict] = CLASES) -> tuple[datetime, datetime, dict]:
+    """Primera apertura posterior a `desde` (por defecto, ahora); ver aperturas_entre"""
+    desde = desde or datetime.now(ZONA_HORARIA)
+    return aperturas_entre(desde, desde + timedelta(days=8), clases)[0]
+
+def antelacion_despertar(coste_preparacion: float | None) -> float:
+    """Segundos antes de una apertura en los que hay que empezar el ciclo"""
+    if coste_preparacion is None:
+        return ANTELACION_DESPERTAR
+    return coste_preparacion + MARGEN_DESPERTAR
+
+def proximo_despertar(desde: datetime | None = None, coste_preparacion: float | None = None, clases: list[dict] = CLASES) -> tuple[datetime, datetime, dict]:
+    """
+    Cuándo empezar el ciclo para llegar a tiempo a la próxima apertura.
+    
+    Args:
+        coste_preparacion: Segundos medidos de preparación (ver coste_preparacion); None = sin medidas
+    
+    Returns:
+        (despertar, apertura, clase), fechas en ZONA_HORARIA
+    """
+    apertura, _, clase = proxima_apertura(desde, clases)
+    return antes_de(apertura, antelacion_despertar(coste_preparacion)), apertura, clase
+
+async def coste_preparacion(db_manager, email: str) -> float | None:
+    """Mayor preparación (segundos) de las últimas ejecuciones guardadas de la cuenta, o None si no hay"""
+    if not db_manager:
+        return None
+    costes = await db_manager.cargar_costes_preparacion(email, EJECUCIONES_COSTE_PREPARACION)
+    return max(costes) if costes else None
+
+def generar_horario(desde: datetime, hasta: datetime, clases: list[dict] = CLASES) -> list[tuple[datetime, list[tuple[datetime, dict]]]]:
+    """
+    Ejecuciones programadas para las aperturas en (desde, hasta]: una por grupo de
+    aperturas separadas menos de ANTELACION_PROGRAMADOR (normalmente una por apertura),
+    ANTELACION_PROGRAMADOR antes de la primera.
+    
+    Returns:
+        (arranque, [(apertura, clase), ...]) por ejecución, fechas en ZONA_HORARIA
+    """
+    grupos = []
+    for apertura, _, clase in aperturas_entre(desde, hasta, clases):
+        if grupos and apertura - grupos[-1][-1][0] < timedelta(seconds=ANTELACION_PROGRAMADOR):
+            grupos[-1].append((apertura, clase))
+        else:
+            grupos.append([(apertura, clase)])
+    return [(antes_de(grupo[0][0], ANTELACION_PROGRAMADOR), grupo) for grupo in grupos]
+
+def _campos_cron(instante: datetime) -> tuple[int, int, int]:
+    """(minuto, hora, día de la semana de cron, 0 = domingo) en UTC, que es como interpreta cron GitHub Actions"""
+    utc = instante.astimezone(timezone.utc)
+    return utc.minute, utc.hour, (utc.weekday() + 1) % 7
+
+def lineas_cron(horario: list[tuple[datetime, list[tuple[datetime, dict]]]]) -> list[str]:
+    """
+    Entradas `schedule` de GitHub Actions para un horario de generar_horario.
+    
+    cron va en UTC, así que un horario que cruza un cambio de hora da dos entradas por
+    día (horario de invierno y de verano); ejecucion_programada_vigente descarta la que
+    no toca. Si dos ejecuciones caen en la misma entrada (p. ej. 16:00 CET y 17:00 CEST),
+    se comenta cada una.
+    """
+    nombres_dias = {numero: nombre for nombre, numero in DIAS_SEMANA.items()}
+    entradas = {}
+    for arranque, aperturas in horario:
+        primera = aperturas[0][0]
+        horas = ", ".join(apertura.strftime("%H:%M") for apertura, _ in aperturas)
+        comentario = (f"    # {nombres_dias[primera.weekday()].capitalize()} ({primera.tzname()}): "
+                      f"aperturas {horas} -> arranque {arranque.strftime('%H:%M')}")
+        comentarios = entradas.setdefault(_campos_cron(arranque), [])
+        if comentario not in comentarios:
+            comentarios.append(comentario)
+    return [
+        "\n".join(entradas[campos]) + f"\n    - cron: \"{campos[0]} {campos[1]} * * {campos[2]}\""
+        for campos in sorted(entradas, key=lambda c: (c[2], c[1], c[0]))
+    ]
+
+def ejecucion_programada_vigente(expresion: str, ahora: datetime | None = None) -> bool:
+    """
+    Si la entrada de cron que ha lanzado esta ejecución (github.event.schedule) es la del
+    horario de hoy; la del otro horario (invierno/verano) no sale en generar_horario.
+    """
+    ahora = ahora or datetime.now(ZONA_HORARIA)
+    minuto, hora, _, _, dia = expresion.split()
+    campos = (int(minuto), int(hora), int(dia) % 7)
+    horario = generar_horario(ahora - timedelta(days=1), ahora + timedelta(days=1))
+    return any(_campos_cron(arranque) == campos for arranque, _ in horario)
+
+def aperturas_de_la_ejecucion(ahora: datetime, clases: list[dict] = CLASES) -> list[tuple[datetime, dict]]:
+    """
+    Grupo de aperturas de generar_horario que atiende una ejecución de cron lanzada en `ahora`:
+    el último que ya debía haber arrancado (la cola de GitHub Actions solo retrasa), o el
+    siguiente si no hay ninguno.
+    """
+    horario = generar_horario(ahora - timedelta(days=1), ahora + timedelta(days=8), clases)
+    arrancadas = [aperturas for arranque, aperturas in horario if arranque <= ahora]
+    return arrancadas[-1] if arrancadas else horario[0][1]
+
+async def esperar_turno_programado(db_manager, email: str) -> datetime | None:
+    """
+    Para las ejecuciones de cron (--programado): duerme hasta la primera apertura de su grupo
+    (aperturas_de_la_ejecucion) menos antelacion_despertar con el coste de preparación medido;
+    si la ejecución llega tarde (esa apertura ya ha pasado), empieza en el acto.
+    
+    Returns:
+        Última apertura del grupo: las cerradas que abren después tienen su propia ejecución.
+        None si la ejecución sobra (entrada de cron del otro horario en CRON_PROGRAMADO)
+    """
+    expresion = os.getenv("CRON_PROGRAMADO")
+    if expresion and not ejecucion_programada_vigente(expresion):
+        print(f"⏭️ La entrada de cron \"{expresion}\" es del otro horario (invierno/verano): nada que hacer")
+        return None
+    
+    ahora = datetime.now(ZONA_HORARIA)
+    aperturas = aperturas_de_la_ejecucion(ahora)
+    ultima = aperturas[-1][0]
+    
+    if aperturas[0][0] <= ahora:
+        print(f"⏰ Ejecución retrasada (apertura de las {aperturas[0][0].strftime('%H:%M')}): empezando ya")
+        return ultima
+    
+    coste = await coste_preparacion(db_manager, email)
+    despertar = antes_de(aperturas[0][0], antelacion_despertar(coste))
+    clase = aperturas[0][1]
+    print(f"\n💤 Próxima apertura: {clase['nombre']} ({clase['dia']} {clase['hora']}) "
+          f"el {aperturas[0][0].strftime('%d/%m/%Y %H:%M %Z')}")
+    print(f"   ⏰ Despertando a las {despertar.strftime('%H:%M:%S')} "
+          f"({'sin medidas de preparación' if coste is None else f'preparación medida: {coste:.0f} s'})")
+    # Dormir en tramos para corregir suspensiones o cambios de hora del sistema
+    while (espera := (despertar - datetime.now(ZONA_HORARIA)).total_seconds()) > 0:
+        await asyncio.sleep(min(espera, 3600))
+    return ultima
+
+def mostrar_horario(semanas: int = SEMANAS_HORARIO) -> None:
+    """Imprime las entradas `schedule` de .github/workflows/cron.yml para las próximas `semanas`"""
+    ahora = datetime.now(ZONA_HORARIA)
+    horario = generar_horario(ahora, ahora + timedelta(weeks=semanas))
+    print(f"  schedule:\n    # Generado con: python ProgramaFundi.py --horario {semanas}")
+    print("\n".join(lineas_cron(horario)))
+
+# =========================
+# Cliente HTTP
+# =========================
+
+class RelojServidor:
+    """
+    Estima el desfase entre el reloj local y el de deportesweb.madrid.es a partir
+    de las cabeceras Date de las respuestas, al estilo NTP.
+    
+    Cada muestra acota el desfase: el servidor generó la cabecera en algún momento
+    entre el envío y la recepción locales, y como Date va truncada al segundo su
+    hora real está en [Date, Date + 1). Las cotas de todas las muestras se
+    intersecan, así que la estimación mejora con cada petición.
+    """
+    
+    def __init__(self):
+        self.limite_inferior = -math.inf
+        self.limite_superior = math.inf
+        self.rtt_minimo = math.inf
+        self.muestras = 0
+        self._envios = {}
+    
+    async def on_request(self, request: httpx.Request) -> None:
+        self._envios[id(request)] = time.time()
+    
+    async def on_response(self, response: httpx.Response) -> None:
+        t_recepcion = time.time()
+        t_envio = self._envios.pop(id(response.request), None)
+        fecha = response.headers.get("Date")
+        if t_envio is not None and fecha:
+            self.registrar_muestra(fecha, t_envio, t_recepcion)
+    
+    def registrar_muestra(self, cabecera_date: str, t_envio: float, t_recepcion: float) -> None:
+        try:
+            hora_servidor = parsedate_to_datetime(cabecera_date).timestamp()
+        except (TypeError, ValueError):
+            return
+        
+        inferior = hora_servidor - t_recepcion
+        superior = hora_servidor + 1 - t_envio
+        self.rtt_minimo = min(self.rtt_minimo, t_recepcion - t_envio)
+        self.muestras += 1
+        
+        nuevo_inferior = max(self.limite_inferior, inferior)
+        nuevo_superior = min(self.limite_superior, superior)
+        if nuevo_inferior > nuevo_superior:
+            # Muestras incompatibles (el reloj local ha saltado): quedarse con la más reciente
+            nuevo_inferior, nuevo_superior = inferior, superior
+        self.limite_inferior = nuevo_inferior
+        self.limite_superior = nuevo_superior
+    
+    @property
+    def desfase(self) -> float:
+        """Segundos que hay que sumar a la hora local para obtener la del servidor"""
+        if not self.muestras:
+            return 0.0
+        return (self.limite_inferior + self.limite_superior) / 2
+    
+    @property
+    def error(self) -> float:
+        """Semiancho del intervalo de confianza del desfase, en segundos"""
+        if not self.muestras:
+            return math.inf
+        return (self.limite_superior - self.limite_inferior) / 2
+    
+    def deadline_monotonic(self, instante_servidor: datetime) -> float:
+        """
+        Convierte un instante del reloj del servidor en un deadline de time.perf_counter.
+        `instante_servidor` va con zona horaria o naive en la hora local del sistema (a_hora_local).
+        """
+        epoch_local = instante_servidor.timestamp() - self.desfase
+        return time.perf_counter() + (epoch_local - time.time())
+    
+    def resumen(self) -> str:
+        if not self.muestras:
+            return "sin muestras del servidor"
+        return (f"{self.desfase:+.3f} s ± {self.error:.3f} s "
+                f"(RTT mín. {self.rtt_minimo * 1000:.0f} ms, {self.muestras} muestras)")
+
+
+class MedidorLatencia:
+    """
+    Mide cada petición de red con el trace de httpcore: conexión (DNS + TCP + TLS,
+    solo si se abre una nueva), tiempo hasta la respuesta (cabeceras recibidas),
+    tiempo total con el cuerpo leído, bytes enviados y recibidos (tal como viajan,
+    comprimidos si el servidor comprime), versión de HTTP y compresión.
+    
+    Cada petición se etiqueta con las extensiones "paso" (login, select_facility,
+    seleccionar_clase...) y opcionalmente "detalle". Los tiempos salen de
+    time.perf_counter; cada medición guarda además su hora de inicio para poder
+    alinearla con las aperturas.
+    """
+    
+    def __init__(self):
+        self.mediciones: list[dict] = []
+        self.datos: dict = {}
+        self.inicio = datetime.now()
+    
+    def reiniciar(self) -> None:
+        """Empieza un informe nuevo (el daemon reutiliza el cliente entre ciclos)"""
+        self.mediciones = []
+        self.datos = {}
+        self.inicio = datetime.now()
+    
+    async def on_request(self, request: httpx.Request) -> None:
+        t0 = time.perf_counter()
+        marcas = {}
+        respuesta = []
+        medicion = {
+            "paso": request.extensions.get("paso", request.url.path.rsplit("/", 1)[-1]),
+            "detalle": request.extensions.get("detalle"),
+            "metodo": request.method,
+            "ruta": request.url.path,
+            "inicio": time.time(),
+            "conexion_ms": None,
+            "ttfb_ms": None,
+            "total_ms": None,
+            "bytes_enviados": int(request.headers.get("Content-Length", 0)),
+            "bytes_recibidos": None,
+            "estado": None,
+            "http": None,
+            "compresion": None,
+        }
+        self.mediciones.append(medicion)
+        
+        async def trace(evento: str, info: dict) -> None:
+            # "connection.connect_tcp.started", "http11.receive_response_headers.complete"...
+            marcas.setdefault(evento.split(".", 1)[1], time.perf_counter())
+            if evento.endswith("response_closed.complete") and respuesta:
+                self._completar(medicion, t0, marcas, respuesta[0])
+        
+        request.extensions["trace"] = trace
+        request.extensions["medicion"] = (medicion, respuesta)
+    
+    async def on_response(self, response: httpx.Response) -> None:
+        medicion, respuesta = response.request.extensions["medicion"]
+        medicion["estado"] = response.status_code
+        medicion["http"] = response.http_version
+        medicion["compresion"] = response.headers.get("Content-Encoding")
+        respuesta.append(response)
+    
+    @staticmethod
+    def _completar(medicion: dict, t0: float, marcas: dict, response: httpx.Response) -> None:
+        if "connect_tcp.started" in marcas:
+            fin_conexion = marcas.get("start_tls.complete", marcas.get("connect_tcp.complete", t0))
+            medicion["conexion_ms"] = round((fin_conexion - marcas["connect_tcp.started"]) * 1000, 1)
+        if "receive_response_headers.complete" in marcas:
+            medicion["ttfb_ms"] = round((marcas["receive_response_headers.complete"] - t0) * 1000, 1)
+        fin = marcas.get("receive_response_body.complete", marcas["response_closed.complete"])
+        medicion["total_ms"] = round((fin - t0) * 1000, 1)
+        medicion["bytes_recibidos"] = response.num_bytes_downloaded
+    
+    def resumen_por_paso(self) -> dict[str, dict]:
+        pasos = {}
+        for medicion in self.mediciones:
+            paso = pasos.setdefault(medicion["paso"], {
+                "peticiones": 0, "conexiones_nuevas": 0, "total_ms": 0.0, "max_ms": 0.0,
+                "ttfb_ms": 0.0, "bytes_enviados": 0, "bytes_recibidos": 0,
+            })
+            paso["peticiones"] += 1
+            paso["conexiones_nuevas"] += medicion["conexion_ms"] is not None
+            paso["total_ms"] = round(paso["total_ms"] + (medicion["total_ms"] or 0), 1)
+            paso["max_ms"] = max(paso["max_ms"], medicion["total_ms"] or 0)
+            paso["ttfb_ms"] = round(paso["ttfb_ms"] + (medicion["ttfb_ms"] or 0), 1)
+            paso["bytes_enviados"] += medicion["bytes_enviados"]
+            paso["bytes_recibidos"] += medicion["bytes_recibidos"] or 0
+        return pasos
+    
+    def resumen_transporte(self) -> dict[str, dict[str, int]]:
+        """Peticiones por versión de HTTP y por compresión de la respuesta ("sin" si no la hubo)"""
+        transporte = {"http": {}, "compresion": {}}
+        for medicion in self.mediciones:
+            if medicion["http"] is None:
+                continue
+            transporte["http"][medicion["http"]] = transporte["http"].get(medicion["http"], 0) + 1
+            compresion = medicion["compresion"] or "sin"
+            transporte["compresion"][compresion] = transporte["compresion"].get(compresion, 0) + 1
+        return transporte
+    
+    def informe(self) -> dict:
+        """Informe de la ejecución: totales, resumen por paso y todas las mediciones"""
+        return {
+            "inicio": self.inicio,
+            "fin": datetime.now(),
+            "peticiones": len(self.mediciones),
+            "total_ms": round(sum(m["total_ms"] or 0 for m in self.mediciones), 1),
+            "bytes_enviados": sum(m["bytes_enviados"] for m in self.mediciones),
+            "bytes_recibidos": sum(m["bytes_recibidos"] or 0 for m in self.mediciones),
+            **self.datos,
+            "transporte": self.resumen_transporte(),
+            "pasos": self.resumen_por_paso(),
+            "mediciones": self.mediciones,
+        }
+    
+    def mostrar_resumen(self) -> None:
+        print("\n⏱️ LATENCIA POR PASO")
+        for nombre, paso in self.resumen_por_paso().items():
+            print(f"   {nombre:<26} {paso['peticiones']:>3} pet. {paso['total_ms']:>9.1f} ms "
+                  f"(máx. {paso['max_ms']:.1f} ms) {paso['bytes_recibidos'] / 1024:>8.1f} KB")
+        transporte = self.resumen_transporte()
+        print("   🔌 " + ", ".join(f"{version} × {n}" for version, n in transporte["http"].items())
+              + " | compresión: " + ", ".join(f"{codificacion} × {n}" for codificacion, n in transporte["compresion"].items()))
+
+
+class ClienteHTTP(httpx.AsyncClient):
+    """
+    AsyncClient que además lleva las lecturas en segundo plano de los restos de respuestas
+    ya aprovechadas (leer_campos_ocultos): al cerrarse les da ESPERA_DRENAJES segundos para
+    terminar, cancela las que sigan y las espera antes de cerrar el pool, para que ninguna
+    quede viva leyendo de una conexión cerrada.
+    """
+    
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.drenajes: set[asyncio.Task] = set()
+    
+    def drenar(self, tarea: asyncio.Task) -> None:
+        """Guarda la tarea (también para que no la recoja el GC) hasta que termine"""
+        self.drenajes.add(tarea)
+        tarea.add_done_callback(self.drenajes.discard)
+    
+    async def terminar_drenajes(self) -> None:
+        if not self.drenajes:
+            return
+        _, pendientes = await asyncio.wait(self.drenajes, timeout=ESPERA_DRENAJES)
+        for tarea in pendientes:
+            tarea.cancel()
+        await asyncio.gather(*pendientes, return_exceptions=True)
+    
+    async def aclose(self) -> None:
+        await self.terminar_drenajes()
+        await super().aclose()
+    
+    async def __aexit__(self, *exc_info) -> None:
+        # `async with` no pasa por aclose
+        await self.terminar_drenajes()
+        await super().__aexit__(*exc_info)
+
+
+def crear_cliente_http(reloj: RelojServidor | None = None, medidor: MedidorLatencia | None = None) -> ClienteHTTP:
+    """
+    Crea el cliente HTTP asíncrono compartido por todo el flujo de reserva.
+    
+    Mantiene un pool de conexiones con keep-alive hacia deportesweb.madrid.es para
+    que login, navegación y reservas reutilicen el mismo socket TLS, y no bloquea
+    el bucle de eventos (MongoDB y temporizadores siguen avanzando mientras tanto).
+    Si se pasa un `reloj`, cada respuesta alimenta su estimación del desfase, y
+    si se pasa un `medidor`, cada petición queda medida paso a paso. Pide las
+    respuestas comprimidas (CODIFICACIONES_ACEPTADAS) y ofrece HTTP/2 (USAR_HTTP2).
+    """
+    limites = httpx.Limits(
+        max_connections=10,
+        max_keepalive_connections=10,
+        keepalive_expiry=300,
+    )
+    event_hooks = {"request": [], "response": []}
+    for observador in (reloj, medidor):
+        if observador:
+            event_hooks["request"].append(observador.on_request)
+            event_hooks["response"].append(observador.on_response)
+    return ClienteHTTP(
+        limits=limites,
+        timeout=httpx.Timeout(30.0, connect=10.0),
+        follow_redirects=True,
+        event_hooks=event_hooks,
+        headers={"Accept-Encoding": CODIFICACIONES_ACEPTADAS},
+        http2=USAR_HTTP2 and h2 is not None,
+    )
+
 # =========================
 # Funciones ASP.NET
 # =========================
 
+# Campos ocultos que forman el state ASP.NET de cada página
+CAMPOS_ESTADO = ("__VIEWSTATE", "__VIEWSTATEGENERATOR", "__EVENTVALIDATION")
+# Los que toda página ASP.NET lleva (__EVENTVALIDATION solo si hay controles que validar)
+CAMPOS_IMPRESCINDIBLES = ("__VIEWSTATE", "__VIEWSTATEGENERATOR")
+
+_PATRON_INPUT = re.compile(r"<input\b([^>]*)>", re.IGNORECASE)
+_PATRON_ATRIBUTO = re.compile(r"""([\w:-]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))""")
+_TAMANO_BLOQUE_LXML = 64 * 1024
+
+def extraer_campos_ocultos(html: str, ids: tuple[str, ...] = CAMPOS_ESTADO, backend: str = BACKEND_CAMPOS_OCULTOS) -> dict[str, str]:
+    """
+    Extrae el atributo value de los <input> cuyo id está en `ids`.
+    
+    Sustituye a construir un árbol BeautifulSoup de la página entera: solo mira las
+    etiquetas <input> y deja de recorrer el HTML en cuanto ha encontrado todos los
+    ids pedidos (el ViewState va al principio de la página).
+    
+    Args:
+        html: Página HTML completa
+        ids: Ids de los campos a buscar
+        backend: "regex" (por defecto) o "lxml" (si está instalado)
+    
+    Returns:
+        Dict id -> value con los campos encontrados (los que no aparecen no se incluyen)
+    """
+    if backend == "lxml" and etree is not None:
+        return _extraer_campos_ocultos_lxml(html, ids)
+    
+    pendientes = set(ids)
+    encontrados = {}
+    for match in _PATRON_INPUT.finditer(html):
+        atributos = {}
+        for nombre, doble, simple, sin_comillas in _PATRON_ATRIBUTO.findall(match.group(1)):
+            atributos[nombre.lower()] = doble or simple or sin_comillas
+        
+        id_campo = atributos.get("id")
+        if id_campo in pendientes:
+            valor = atributos.get("value", "")
+            encontrados[id_campo] = html_lib.unescape(valor) if "&" in valor else valor
+            pendientes.discard(id_campo)
+            if not pendientes:
+                break
+    return encontrados
+
+def _extraer_campos_ocultos_lxml(html: str, ids: tuple[str, ...]) -> dict[str, str]:
+    """Variante de extraer_campos_ocultos con el parser incremental de lxml, alimentado por bloques"""
+    parser = etree.HTMLPullParser(events=("start",), tag="input")
+    pendientes = set(ids)
+    encontrados = {}
+    for inicio in range(0, len(html), _TAMANO_BLOQUE_LXML):
+        parser.feed(html[inicio:inicio + _TAMANO_BLOQUE_LXML])
+        for _, elemento in parser.read_events():
+            id_campo = elemento.get("id")
+            if id_campo in pendientes:
+                encontrados[id_campo] = elemento.get("value", "")
+                pendientes.discard(id_campo)
+        if not pendientes:
+            break
+    return encontrados
+
+def _state_desde_campos(campos: dict[str, str]) -> dict:
+    for requerido in CAMPOS_IMPRESCINDIBLES:
+        if requerido not in campos:
+            raise ValueError(f"No se encontró {requerido} en la página")
+    return {key: campos[key] for key in CAMPOS_ESTADO if key in campos}
+
 def parse_initial_state(html: str) -> dict:
-    soup = BeautifulSoup(html, "html.parser")
-    state = {
-        "__VIEWSTATE": soup.find("input", {"id": "__VIEWSTATE"})["value"],
-        "__VIEWSTATEGENERATOR": soup.find("input", {"id": "__VIEWSTATEGENERATOR"})["value"],
-    }
-    ev_tag = soup.find("input", {"id": "__EVENTVALIDATION"})
-    if ev_tag:
-        state["__EVENTVALIDATION"] = ev_tag["value"]
-    return state
-
-def extract_hidden_field(delta_text: str, field: str) -> str | None:
-    token = f"|hiddenField|{field}|"
-    if token not in delta_text:
+    return _state_desde_campos(extraer_campos_ocultos(html))
+
+def update_state_from_html(state: dict, html: str) -> None:
+    state.update(parse_initial_state(html))
+
+_PATRON_INICIO_INPUT_BYTES = re.compile(rb"<input\b", re.IGNORECASE)
+_PATRON_FIN_FORMULARIO_BYTES = re.compile(rb"</form", re.IGNORECASE)
+_PATRON_ATRIBUTO_BYTES = re.compile(rb"""([\w:-]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))""")
+# Los mismos patrones que extraer_person_code, por orden de preferencia
+_PATRONES_PERSON_CODE_BYTES = (
+    re.compile(rb'data-person-code=["\']([a-f0-9]{64})["\']'),
+    re.compile(rb'"personCode"\s*:\s*"([a-f0-9]{64})"'),
+    re.compile(rb"'personCode'\s*:\s*'([a-f0-9]{64})'"),
+    re.compile(rb'personCode\s*=\s*["\']([a-f0-9]{64})["\']'),
+    re.compile(rb'personCode\s*:\s*["\']?([a-f0-9]{64})["\']?'),
+)
+# Bytes ya vistos que se vuelven a mirar con cada bloque: un personCode puede quedar partido entre dos
+_SOLAPE_PERSON_CODE = 128
+
+class ExtractorCamposOcultos:
+    """
+    extraer_campos_ocultos (y extraer_person_code) incremental, para respuestas en streaming.
+    
+    Recibe la página por bloques de bytes y busca las etiquetas <input> sin decodificar
+    el HTML: solo se decodifica el value de los campos pedidos. Lo ya recorrido se
+    descarta, salvo una etiqueta que llega partida (el ViewState ocupa muchos bloques),
+    que se retoma con el siguiente bloque sin volver a recorrer lo ya visto.
+    `completo` indica que no hace falta seguir leyendo: ya están todos los campos, o
+    los imprescindibles y el cierre del formulario (tras él no hay más campos ocultos).
+    """
+    
+    def __init__(self, ids: tuple[str, ...] = CAMPOS_ESTADO, person_code: bool = False, codificacion: str = "utf-8"):
+        self.pendientes = set(ids)
+        self.campos: dict[str, str] = {}
+        self.buscar_person_code = person_code
+        self.person_code: str | None = None
+        self.codificacion = codificacion
+        self.datos = bytearray()
+        self.leidos = 0
+        self._pos_input = 0
+        self._pos_cierre = 0
+        self._pos_person_code = 0
+    
+    @property
+    def completo(self) -> bool:
+        return not self.pendientes and (self.person_code is not None or not self.buscar_person_code)
+    
+    def feed(self, bloque: bytes) -> bool:
+        """Añade un bloque; devuelve `completo`"""
+        self.datos += bloque
+        self.leidos += len(bloque)
+        if self.pendientes:
+            self._buscar_inputs()
+        if self.buscar_person_code and self.person_code is None:
+            self._buscar_person_code()
+        self._descartar_vistos()
+        return self.completo
+    
+    def state(self) -> dict:
+        """State ASP.NET con los campos encontrados (ValueError si falta alguno imprescindible)"""
+        return _state_desde_campos(self.campos)
+    
+    def _buscar_inputs(self) -> None:
+        while self.pendientes:
+            inicio = _PATRON_INICIO_INPUT_BYTES.search(self.datos, self._pos_input)
+            # Con los imprescindibles ya leídos, un </form> antes del siguiente <input> cierra la búsqueda
+            if (self.pendientes.isdisjoint(CAMPOS_IMPRESCINDIBLES) and _PATRON_FIN_FORMULARIO_BYTES.search(
+                    self.datos, self._pos_input, inicio.start() if inicio else len(self.datos))):
+                self.pendientes.clear()
+                return
+            if inicio is None:
+                # Un "<inpu" al final del bloque se completará con el siguiente
+                self._pos_input = max(self._pos_input, len(self.datos) - len(b"<input"))
+                return
+            cierre = self.datos.find(b">", max(inicio.end(), self._pos_cierre))
+            if cierre < 0:
+                self._pos_input = inicio.start()
+                self._pos_cierre = len(self.datos)
+                return
+            self._pos_input = cierre + 1
+            
+            # Posiciones en lugar de copias: el value del ViewState puede ocupar varios MB
+            atributos = {}
+            for match in _PATRON_ATRIBUTO_BYTES.finditer(self.datos, inicio.end(), cierre):
+                grupo = next(g for g in (2, 3, 4) if match.start(g) >= 0)
+                atributos[match.group(1).lower()] = match.span(grupo)
+            inicio_id, fin_id = atributos.get(b"id", (0, 0))
+            id_campo = self.datos[inicio_id:fin_id].decode("ascii", "replace")
+            if id_campo in self.pendientes:
+                inicio_valor, fin_valor = atributos.get(b"value", (0, 0))
+                with memoryview(self.datos) as vista:
+                    valor = str(vista[inicio_valor:fin_valor], self.codificacion, "replace")
+                self.campos[id_campo] = html_lib.unescape(valor) if "&" in valor else valor
+                self.pendientes.discard(id_campo)
+    
+    def _buscar_person_code(self) -> None:
+        desde = max(0, self._pos_person_code - _SOLAPE_PERSON_CODE)
+        # Los cinco patrones solo si hay candidato: find recorre el ViewState mucho más rápido
+        if self.datos.find(b"erson-code", desde) >= 0 or self.datos.find(b"personCode", desde) >= 0:
+            for patron in _PATRONES_PERSON_CODE_BYTES:
+                match = patron.search(self.datos, desde)
+                if match:
+                    self.person_code = match.group(1).decode("ascii")
+                    return
+        self._pos_person_code = len(self.datos)
+    
+    def _descartar_vistos(self) -> None:
+        corte = self._pos_input if self.pendientes else len(self.datos)
+        if self.buscar_person_code and self.person_code is None:
+            corte = min(corte, max(0, self._pos_person_code - _SOLAPE_PERSON_CODE))
+        if corte:
+            del self.datos[:corte]
+            self._pos_input = max(0, self._pos_input - corte)
+            self._pos_cierre = max(0, self._pos_cierre - corte)
+            self._pos_person_code -= corte
+
+class SegmentoDelta(NamedTuple):
+    """Registro `longitud|tipo|id|contenido|` de una respuesta delta; el contenido es texto[inicio:fin]"""
+    tipo: str
+    id: str
+    inicio: int
+    fin: int
+
+
+class RespuestaDelta:
+    """
+    Respuesta delta de un UpdatePanel de ASP.NET analizada en una sola pasada.
+    
+    Recorre los registros `longitud|tipo|id|contenido|` saltando el contenido con
+    su prefijo de longitud, sin volver a escanearlo. Solo se copian los campos
+    ocultos, la redirección y los errores; el resto (paneles, scripts...) queda
+    como rango sobre `texto` y se extrae bajo demanda.
+    """
+    
+    def __init__(self, texto: str):
+        self.texto = texto
+        self.segmentos: list[SegmentoDelta] = []
+        self.campos_ocultos: dict[str, str] = {}
+        self.redirect: str | None = None
+        self.errores: list[str] = []
+        self.completa = self._analizar()
+    
+    def _analizar(self) -> bool:
+        """Devuelve False si la respuesta no es un delta bien formado (p. ej. una página HTML completa)"""
+        texto = self.texto
+        pos = 0
+        total = len(texto)
+        while pos < total:
+            sep_longitud = texto.find("|", pos)
+            if sep_longitud == -1:
+                return False
+            sep_tipo = texto.find("|", sep_longitud + 1)
+            if sep_tipo == -1:
+                return False
+            sep_id = texto.find("|", sep_tipo + 1)
+            if sep_id == -1:
+                return False
+            try:
+                longitud = int(texto[pos:sep_longitud])
+            except ValueError:
+                return False
+            
+            inicio = sep_id + 1
+            fin = inicio + longitud
+            if texto[fin:fin + 1] != "|":
+                return False
+            
+            segmento = SegmentoDelta(texto[sep_longitud + 1:sep_tipo], texto[sep_tipo + 1:sep_id], inicio, fin)
+            self.segmentos.append(segmento)
+            if segmento.tipo == "hiddenField":
+                self.campos_ocultos[segmento.id] = texto[inicio:fin]
+            elif segmento.tipo == "pageRedirect":
+                self.redirect = urllib.parse.unquote(texto[inicio:fin])
+            elif segmento.tipo == "error":
+                self.errores.append(texto[inicio:fin])
+            
+            pos = fin + 1
+        return True
+    
+    def contenido(self, segmento: SegmentoDelta) -> str:
+        return self.texto[segmento.inicio:segmento.fin]
+    
+    def panel(self, id_panel: str) -> str | None:
+        """Contenido HTML del updatePanel `id_panel`, o None si no viene en la respuesta"""
+        for segmento in self.segmentos:
+            if segmento.tipo == "updatePanel" and segmento.id == id_panel:
+                return self.contenido(segmento)
         return None
-    return delta_text.split(token, 1)[1].split("|", 1)[0]
+    
+    def redirige_a(self, pagina: str) -> bool:
+        return self.redirect is not None and pagina in self.redirect
 
-def update_state_from_delta(state: dict, delta_text: str) -> None:
+def update_state_from_delta(state: dict, delta_text: str) -> RespuestaDelta:
+    delta = RespuestaDelta(delta_text)
     for key in ("__VIEWSTATE", "__VIEWSTATEGENERATOR", "__EVENTVALIDATION"):
-        new_val = extract_hidden_field(delta_text, key)
+        new_val = delta.campos_ocultos.get(key)
         if new_val:
             state[key] = new_val
+    return delta
 
-def is_login_success(response_text: str, session: requests.Session) -> bool:
-    if "pageRedirect" in response_text:
+def is_login_success(delta: RespuestaDelta, session: httpx.AsyncClient) -> bool:
+    if delta.redirect is not None:
         return True
-    if "Token" in session.cookies.get_dict():
+    if any(cookie.name == "Token" for cookie in session.cookies.jar):
         return True
     return False
 
@@ -258,21 +1222,15 @@ def is_login_success(response_text: str, session: requests.Session) -> bool:
 # Navegación
 # =========================
 
-def select_facility(session: requests.Session, facility_code: str, facility_name: str, state: dict):
-    r = session.get(URL_HOME, headers={**HEADERS, "Referer": URL_HOME})
+async def select_facility(session: httpx.AsyncClient, facility_code: str, facility_name: str, state: dict) -> RespuestaDelta:
+    r = await session.get(URL_HOME, headers={**HEADERS, "Referer": URL_HOME}, extensions={"paso": "home"})
     r.raise_for_status()
-    soup = BeautifulSoup(r.text, "html.parser")
+    campos = extraer_campos_ocultos(r.text, CAMPOS_ESTADO + ("ctl00_ScriptManager1",))
+    state.update(_state_desde_campos(campos))
 
-    state["__VIEWSTATE"] = soup.find("input", {"id": "__VIEWSTATE"})["value"]
-    state["__VIEWSTATEGENERATOR"] = soup.find("input", {"id": "__VIEWSTATEGENERATOR"})["value"]
-    ev_tag = soup.find("input", {"id": "__EVENTVALIDATION"})
-    if ev_tag:
-        state["__EVENTVALIDATION"] = ev_tag["value"]
-
-    script_manager = soup.find("input", {"id": "ctl00_ScriptManager1"})
     script_manager_value = (
-        f"{script_manager['id']}|{script_manager['id'].replace('_', '$')}|ContentPlaceHolder1_UpdatePanel"
-        if script_manager else "ctl00$ContentFixedSection$uSecciones$uAlert$uplAlert|ContentFixedSection_uSecciones_uAlert_uplAlert"
+        "ctl00_ScriptManager1|ctl00$ScriptManager1|ContentPlaceHolder1_UpdatePanel"
+        if "ctl00_ScriptManager1" in campos else "ctl00$ContentFixedSection$uSecciones$uAlert$uplAlert|ContentFixedSection_uSecciones_uAlert_uplAlert"
     )
 
     post_data = {
@@ -292,21 +1250,15 @@ def select_facility(session: requests.Session, facility_code: str, facility_name
     if "__EVENTVALIDATION" in state:
         post_data["__EVENTVALIDATION"] = state["__EVENTVALIDATION"]
 
-    r = session.post(URL_HOME, data=post_data, headers={**HEADERS, "Referer": URL_HOME})
+    r = await session.post(URL_HOME, data=post_data, headers={**HEADERS, "Referer": URL_HOME}, extensions={"paso": "select_facility", "detalle": facility_name})
     r.raise_for_status()
-    return r.text
+    return RespuestaDelta(r.text)
 
-def select_centro_menu_post(session: requests.Session, token: str, menu_code: str, menu_title: str, state: dict):
-    url_centro = f"https://deportesweb.madrid.es/DeportesWeb/Centro?token={token}"
-    r = session.get(url_centro, headers={"User-Agent": HEADERS["User-Agent"], "Referer": URL_HOME})
+async def select_centro_menu_post(session: httpx.AsyncClient, token: str, menu_code: str, menu_title: str, state: dict) -> RespuestaDelta:
+    url_centro = f"{URL_BASE}/DeportesWeb/Centro?token={token}"
+    r = await session.get(url_centro, headers={"User-Agent": HEADERS["User-Agent"], "Referer": URL_HOME}, extensions={"paso": "centro"})
     r.raise_for_status()
-    soup = BeautifulSoup(r.text, "html.parser")
-
-    state["__VIEWSTATE"] = soup.find("input", {"id": "__VIEWSTATE"})["value"]
-    state["__VIEWSTATEGENERATOR"] = soup.find("input", {"id": "__VIEWSTATEGENERATOR"})["value"]
-    ev_tag = soup.find("input", {"id": "__EVENTVALIDATION"})
-    if ev_tag:
-        state["__EVENTVALIDATION"] = ev_tag["value"]
+    update_state_from_html(state, r.text)
 
     script_manager_value = "ctl00$ContentFixedSection$uCentro$uSecciones$uAlert$uplAlert|ContentFixedSection_uCentro_uSecciones_uAlert_uplAlert"
     post_data = {
@@ -325,12 +1277,78 @@ def select_centro_menu_post(session: requests.Session, token: str, menu_code: st
         **state
     }
 
-    r = session.post(url_centro, data=post_data, headers={**HEADERS, "Referer": url_centro})
+    r = await session.post(url_centro, data=post_data, headers={**HEADERS, "Referer": url_centro}, extensions={"paso": "select_centro_menu"})
     r.raise_for_status()
-    return r.text
+    return RespuestaDelta(r.text)
+
+async def _drenar_respuesta(r: httpx.Response, bloques) -> None:
+    """Lee y descarta el resto del cuerpo para que la conexión vuelva al pool"""
+    try:
+        async for _ in bloques:
+            pass
+    except httpx.HTTPError:
+        pass
+    finally:
+        # Cerrar el generador aquí, no en una tarea del finalizador de asyncio
+        await bloques.aclose()
+        await r.aclose()
+
+async def leer_campos_ocultos(session: ClienteHTTP, url: str, headers: dict, paso: str, person_code: bool = False) -> tuple[httpx.Response, ExtractorCamposOcultos]:
+    """
+    GET de una página ASP.NET en streaming que vuelve en cuanto tiene los campos ocultos.
+    
+    Los bloques se pasan a un ExtractorCamposOcultos según llegan; cuando está completo
+    (o la respuesta termina) se devuelve sin esperar al resto de la página, que se sigue
+    leyendo y descartando en segundo plano (una tarea del cliente, que la cancela al
+    cerrarse) para no perder la conexión keep-alive.
+    
+    Args:
+        paso: Nombre del paso para el MedidorLatencia
+        person_code: Seguir leyendo hasta encontrar también el personCode
+    
+    Returns:
+        (respuesta, sin cuerpo; extractor con los campos encontrados)
+    """
+    peticion = session.build_request("GET", url, headers=headers, extensions={"paso": paso})
+    r = await session.send(peticion, stream=True)
+    bloques = r.aiter_bytes()
+    try:
+        r.raise_for_status()
+        extractor = ExtractorCamposOcultos(person_code=person_code, codificacion=r.encoding or "utf-8")
+        async for bloque in bloques:
+            if extractor.feed(bloque):
+                break
+        else:
+            await r.aclose()
+            return r, extractor
+    except BaseException:
+        await bloques.aclose()
+        await r.aclose()
+        raise
+    
+    session.drenar(asyncio.create_task(_drenar_respuesta(r, bloques)))
+    return r, extractor
+
+class RedireccionAltaEventos(ValueError):
+    """AltaEventos no se ha servido: el servidor ha redirigido a `ruta`"""
+    
+    def __init__(self, ruta: str):
+        super().__init__(f"AltaEventos ha redirigido a {ruta}")
+        self.ruta = ruta
+    
+    @property
+    def sesion_caducada(self) -> bool:
+        """A Login va la cookie de sesión caducada; a Home o Centro, el token rechazado"""
+        return self.ruta.endswith("/Login")
 
-def get_alta_eventos(session: requests.Session, token: str, referer: str):
-    url_alta_eventos = f"https://deportesweb.madrid.es/DeportesWeb/Modulos/VentaServicios/Eventos/AltaEventos?token={token}"
+async def get_alta_eventos(session: httpx.AsyncClient, token: str, referer: str, person_code: bool = False) -> ExtractorCamposOcultos:
+    """
+    Abre AltaEventos y lee lo justo para tener su state (y el personCode si se pide).
+    
+    Returns:
+        Extractor con los campos ocultos de la página (ver leer_campos_ocultos)
+    """
+    url_alta_eventos = f"{URL_BASE}/DeportesWeb/Modulos/VentaServicios/Eventos/AltaEventos?token={token}"
     headers = {
         "User-Agent": HEADERS["User-Agent"],
         "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
@@ -340,90 +1358,49 @@ def get_alta_eventos(session: requests.Session, token: str, referer: str):
         "Upgrade-Insecure-Requests": "1",
     }
 
-    r = session.get(url_alta_eventos, headers=headers)
-    r.raise_for_status()
-    return r.text
+    r, pagina = await leer_campos_ocultos(session, url_alta_eventos, headers, "get_alta_eventos", person_code)
+    if not r.url.path.endswith("/AltaEventos"):
+        # Token caducado o sesión no válida: el servidor manda a otra página (Login, Home...)
+        raise RedireccionAltaEventos(r.url.path)
+    return pagina
 
-def extraer_cod_sesion(html_response: str, nombre_clase: str, hora_clase: str, fecha_esperada: str) -> dict | None:
+_PATRON_CLICK_SESION = re.compile(r"\.on\('click',\s*\{([^}]+)\}")
+_PATRON_PAR_JS = re.compile(r"(\w+):\s*'([^']*)'")
+# .append('20') seguido de .append($('<span/>'...).append('/20')
+_PATRON_PLAZAS = re.compile(r"\.append\('(\d+)'\)\s*\)\s*\.append\(\$\('<span/>'.*?\.append\('/(\d+)'\)")
+_PATRON_PLAZAS_SIMPLE = re.compile(r"\.append\('(\d+)'\).*?\.append\('/(\d+)'\)", re.DOTALL)
+# Las plazas aparecen poco después del objeto de datos de cada sesión
+_VENTANA_PLAZAS = 800
+
+
+class CatalogoSesiones:
     """
-    Extrae el COD_SESION de una clase específica del HTML de respuesta.
-    Solo devuelve resultados si la clase tiene plazas disponibles (> 0) y coincide la fecha.
-    
-    Args:
-        html_response: HTML de respuesta del POST de eventos
-        nombre_clase: Nombre de la clase a buscar (ej: "Pilates MesD")
-        hora_clase: Hora de la clase a buscar (ej: "18:00")
-        fecha_esperada: Fecha esperada de la clase en formato "YYYY-MM-DD"
+    Sesiones de un día de AltaEventos, extraídas de una sola pasada por la respuesta.
     
-    Returns:
-        Dict con datos de la sesión si se encuentra, tiene plazas y coincide la fecha, None en caso contrario
+    Cada bloque `.on('click', {...})` se lee una vez junto con sus plazas, y las
+    sesiones quedan indexadas por (nombre en minúsculas, hora de inicio, fecha), así
+    que buscar cualquier clase de esa fecha es una consulta a un dict.
     """
-    # Buscar todos los bloques .on('click', {...}) con los datos de las clases
-    # El patrón busca el objeto JavaScript con los datos de cada clase
-    pattern = r"\.on\('click',\s*\{([^}]+)\}"
-    
-    matches = re.findall(pattern, html_response)
     
-    for match in matches:
-        # Parsear los datos del objeto JavaScript
-        datos = {}
-        # Extraer cada par clave: 'valor'
-        pares = re.findall(r"(\w+):\s*'([^']*)'", match)
-        for clave, valor in pares:
-            datos[clave] = valor
+    def __init__(self, html_response: str):
+        self.sesiones: dict[tuple[str, str, str], dict] = {}
         
-        # Verificar si es la clase que buscamos (nombre, hora Y fecha)
-        if (datos.get("NOM_EVENTO", "").lower() == nombre_clase.lower() and 
-            datos.get("HORA_DESDE") == hora_clase and
-            datos.get("FECHA") == fecha_esperada):
-            # Ahora necesitamos verificar las plazas disponibles
-            # El HTML tiene la estructura: .append('X').append('/Y') donde X son plazas disponibles
-            # Buscamos el patrón específico cerca de este evento
-            
+        for match in _PATRON_CLICK_SESION.finditer(html_response):
+            datos = dict(_PATRON_PAR_JS.findall(match.group(1)))
             cod_sesion = datos.get("COD_SESION")
             if not cod_sesion:
                 continue
             
-            # Buscar las plazas disponibles para esta sesión
-            # El patrón está en: .append($('<span/>'...font-weight: bold' }).append('X'))
-            # seguido de .append($('<span/>'...font-weight: bold' }).append('/Y'))
-            
-            # Buscar el bloque completo que contiene este COD_SESION y extraer plazas
-            idx = html_response.find(f"COD_SESION: '{cod_sesion}'")
-            if idx == -1:
+            clave = (datos.get("NOM_EVENTO", "").lower(), datos.get("HORA_DESDE"), datos.get("FECHA"))
+            if clave in self.sesiones:
                 continue
             
-            # Buscar hacia adelante para encontrar las plazas (dentro de los próximos 500 caracteres)
-            bloque = html_response[idx:idx+800]
-            
-            # Patrón para extraer plazas disponibles y totales
-            # .append('20') seguido de .append('/20')
-            plazas_pattern = r"\.append\('(\d+)'\)\s*\)\s*\.append\(\$\('<span/>'.*?\.append\('/(\d+)'\)"
-            plazas_match = re.search(plazas_pattern, bloque)
-            
-            if plazas_match:
-                plazas_disponibles = int(plazas_match.group(1))
-                plazas_totales = int(plazas_match.group(2))
-            else:
-                # Intentar otro patrón más simple
-                simple_pattern = r"\.append\('(\d+)'\).*?\.append\('/(\d+)'\)"
-                simple_match = re.search(simple_pattern, bloque, re.DOTALL)
-                if simple_match:
-                    plazas_disponibles = int(simple_match.group(1))
-                    plazas_totales = int(simple_match.group(2))
-                else:
-                    print(f"   ⚠️ No se pudieron extraer plazas para {nombre_clase}")
-                    plazas_disponibles = 0
-                    plazas_totales = 0
-            
-            # Verificar que hay plazas disponibles
-            if plazas_disponibles <= 0:
-                print(f"   ❌ {nombre_clase} a las {hora_clase}: Sin plazas disponibles (0/{plazas_totales})")
-                return None
-            
-            print(f"   ✅ {nombre_clase} a las {hora_clase}: {plazas_disponibles}/{plazas_totales} plazas disponibles")
+            # Buscar las plazas en la ventana que sigue al bloque, sin copiar el HTML
+            fin_ventana = match.end() + _VENTANA_PLAZAS
+            plazas_match = (_PATRON_PLAZAS.search(html_response, match.end(), fin_ventana)
+                            or _PATRON_PLAZAS_SIMPLE.search(html_response, match.end(), fin_ventana))
             
-            return {
+            self.sesiones[clave] = {
                 "cod_sesion": cod_sesion,
                 "cod_sala": datos.get("COD_SALA"),
                 "nom_sala": datos.get("NOM_SALA"),
@@ -432,20 +1409,93 @@ def extraer_cod_sesion(html_response: str, nombre_clase: str, hora_clase: str, f
                 "fecha": datos.get("FECHA"),
                 "hora_desde": datos.get("HORA_DESDE"),
                 "hora_hasta": datos.get("HORA_HASTA"),
-                "plazas_disponibles": plazas_disponibles,
-                "plazas_totales": plazas_totales,
+                "plazas_disponibles": int(plazas_match.group(1)) if plazas_match else None,
+                "plazas_totales": int(plazas_match.group(2)) if plazas_match else None,
                 "habilitar_limite_reservas": datos.get("HABILITAR_LIMITE_RESERVAS"),
                 "limite_reservas": datos.get("LIMITE_RESERVAS"),
                 "salas_multiples": datos.get("SALAS_MULTIPLES")
             }
     
-    print(f"   ❌ No se encontró la clase '{nombre_clase}' a las {hora_clase} en fecha {fecha_esperada}")
-    return None
+    def __len__(self) -> int:
+        return len(self.sesiones)
+    
+    def buscar(self, nombre_clase: str, hora_clase: str, fecha: str) -> dict | None:
+        """Sesión con ese nombre, hora y fecha (tenga o no plazas)"""
+        return self.sesiones.get((nombre_clase.lower(), hora_clase, fecha))
+    
+    def sesion_disponible(self, nombre_clase: str, hora_clase: str, fecha_esperada: str) -> dict | None:
+        """
+        Devuelve los datos de la sesión si existe y tiene plazas disponibles (> 0).
+        
+        Args:
+            nombre_clase: Nombre de la clase a buscar (ej: "Pilates MesD")
+            hora_clase: Hora de la clase a buscar (ej: "18:00")
+            fecha_esperada: Fecha esperada de la clase en formato "YYYY-MM-DD"
+        
+        Returns:
+            Dict con datos de la sesión si se encuentra y tiene plazas, None en caso contrario
+        """
+        sesion = self.buscar(nombre_clase, hora_clase, fecha_esperada)
+        if sesion is None:
+            print(f"   ❌ No se encontró la clase '{nombre_clase}' a las {hora_clase} en fecha {fecha_esperada}")
+            return None
+        
+        if sesion["plazas_disponibles"] is None:
+            print(f"   ⚠️ No se pudieron extraer plazas para {nombre_clase}")
+            sesion = {**sesion, "plazas_disponibles": 0, "plazas_totales": 0}
+        
+        if sesion["plazas_disponibles"] <= 0:
+            print(f"   ❌ {nombre_clase} a las {hora_clase}: Sin plazas disponibles (0/{sesion['plazas_totales']})")
+            return None
+        
+        print(f"   ✅ {nombre_clase} a las {hora_clase}: {sesion['plazas_disponibles']}/{sesion['plazas_totales']} plazas disponibles")
+        return dict(sesion)
+
+
+def extraer_cod_sesion(html_response: str, nombre_clase: str, hora_clase: str, fecha_esperada: str) -> dict | None:
+    """
+    Extrae el COD_SESION de una clase específica del HTML de respuesta.
+    Solo devuelve resultados si la clase tiene plazas disponibles (> 0) y coincide la fecha.
+    
+    Para buscar varias clases en la misma respuesta, construir un CatalogoSesiones
+    una vez y consultarlo en lugar de llamar a esta función por cada clase.
+    
+    Args:
+        html_response: HTML de respuesta del POST de eventos
+        nombre_clase: Nombre de la clase a buscar (ej: "Pilates MesD")
+        hora_clase: Hora de la clase a buscar (ej: "18:00")
+        fecha_esperada: Fecha esperada de la clase en formato "YYYY-MM-DD"
+    
+    Returns:
+        Dict con datos de la sesión si se encuentra, tiene plazas y coincide la fecha, None en caso contrario
+    """
+    return CatalogoSesiones(html_response).sesion_disponible(nombre_clase, hora_clase, fecha_esperada)
+
+
+def plazas_de_sesiones(texto: str, cod_sesiones: set[str]) -> dict[str, int]:
+    """
+    Plazas libres de las sesiones indicadas, leyendo solo sus bloques: sin construir el
+    CatalogoSesiones ni tocar el resto de sesiones del día. Las que no aparecen se omiten.
+    """
+    plazas = {}
+    for cod_sesion in cod_sesiones:
+        match = re.search(rf"COD_SESION:\s*'{re.escape(cod_sesion)}'", texto)
+        if not match:
+            continue
+        fin_bloque = texto.find("}", match.end()) + 1
+        if not fin_bloque:
+            continue
+        fin_ventana = fin_bloque + _VENTANA_PLAZAS
+        plazas_match = (_PATRON_PLAZAS.search(texto, fin_bloque, fin_ventana)
+                        or _PATRON_PLAZAS_SIMPLE.search(texto, fin_bloque, fin_ventana))
+        if plazas_match:
+            plazas[cod_sesion] = int(plazas_match.group(1))
+    return plazas
 
 
-def load_events_for_date(session: requests.Session, token: str, fecha: str, state: dict):
-    """Carga los eventos de una fecha específica"""
-    url_alta_eventos = f"https://deportesweb.madrid.es/DeportesWeb/Modulos/VentaServicios/Eventos/AltaEventos?token={token}"
+async def load_events_for_date(session: httpx.AsyncClient, token: str, fecha: str, state: dict, mostrar: bool = True) -> RespuestaDelta:
+    """Carga los eventos de una fecha específica (`mostrar=False` para las consultas repetidas de la vigilancia)"""
+    url_alta_eventos = f"{URL_BASE}/DeportesWeb/Modulos/VentaServicios/Eventos/AltaEventos?token={token}"
     
     event_argument = json.dumps({
         "action": "Load",
@@ -471,9 +1521,10 @@ def load_events_for_date(session: requests.Session, token: str, fecha: str, stat
     encoded_data = urllib.parse.urlencode(post_data)
     content_length = len(encoded_data)
     
-    print(f"\n{'='*60}")
-    print(f"📅 Cargando eventos para: {fecha}")
-    print(f"📊 Content-Length: {content_length} bytes")
+    if mostrar:
+        print(f"\n{'='*60}")
+        print(f"📅 Cargando eventos para: {fecha}")
+        print(f"📊 Content-Length: {content_length} bytes")
     
     headers = {
         **HEADERS,
@@ -481,32 +1532,89 @@ def load_events_for_date(session: requests.Session, token: str, fecha: str, stat
         "Content-Type": "application/x-www-form-urlencoded; charset=utf-8",
     }
     
-    r = session.post(url_alta_eventos, data=post_data, headers=headers)
+    r = await session.post(url_alta_eventos, data=post_data, headers=headers, extensions={"paso": "load_events", "detalle": fecha})
     r.raise_for_status()
     
-    update_state_from_delta(state, r.text)
+    delta = update_state_from_delta(state, r.text)
     
-    print(f"✅ Respuesta recibida ({len(r.text)} bytes)")
-    print(f"{'='*60}\n")
+    if mostrar:
+        print(f"✅ Respuesta recibida ({len(r.text)} bytes)")
+        print(f"{'='*60}\n")
     
-    return r.text
+    return delta
 
 
-def seleccionar_clase(session: requests.Session, token: str, sesion_data: dict, person_code: str, state: dict):
+class CacheEventos:
     """
-    Hace el POST para seleccionar/reservar una clase específica.
+    Catálogos de AltaEventos por fecha, para hacer un solo POST Load por fecha y ejecución.
+    
+    Cada entrada guarda el CatalogoSesiones y una copia del state ASP.NET tal y como
+    quedó tras cargar esa fecha, que se restaura al reutilizarla: así el siguiente
+    POST (p. ej. Seleccionar) sale con el ViewState que corresponde a esa fecha.
+    Las entradas caducan pasados `frescura` segundos; las lecturas que dependen de
+    las plazas pueden pedir `forzar=True` para recargar.
+    """
+    
+    def __init__(self, session: httpx.AsyncClient, token: str, frescura: float = FRESCURA_CACHE_EVENTOS):
+        self.session = session
+        self.token = token
+        self.frescura = frescura
+        self._entradas: dict[str, tuple[CatalogoSesiones, dict, float]] = {}
+    
+    async def obtener(self, fecha: str, state: dict, forzar: bool = False) -> CatalogoSesiones:
+        """
+        Devuelve el catálogo de `fecha`, cargándolo solo si no está en caché, ha caducado o se fuerza.
+        
+        Args:
+            fecha: Fecha a cargar en formato "YYYY-MM-DD"
+            state: Estado ASP.NET; se actualiza con el de la carga (nueva o en caché)
+            forzar: Recargar aunque la entrada siga fresca (lecturas de plazas)
+        """
+        entrada = self._entradas.get(fecha)
+        if entrada and not forzar and time.monotonic() - entrada[2] < self.frescura:
+            catalogo, state_fecha, _ = entrada
+            state.update(state_fecha)
+            print(f"♻️ Eventos de {fecha} en caché ({len(catalogo)} sesiones)")
+            return catalogo
+        
+        response = await load_events_for_date(
+            session=self.session,
+            token=self.token,
+            fecha=fecha,
+            state=state
+        )
+        catalogo = CatalogoSesiones(response.texto)
+        self._entradas[fecha] = (catalogo, dict(state), time.monotonic())
+        return catalogo
+    
+    def invalidar(self, fecha: str | None = None) -> None:
+        """Descarta la entrada de `fecha`, o todas si no se indica"""
+        if fecha is None:
+            self._entradas.clear()
+        else:
+            self._entradas.pop(fecha, None)
+
+
+def preparar_seleccion(session: httpx.AsyncClient, token: str, sesion_data: dict, person_code: str, state: dict, mostrar: bool = True) -> httpx.Request:
+    """
+    Construye por adelantado el POST para seleccionar/reservar una clase específica.
+    
+    Todo el trabajo (JSON del __EVENTARGUMENT, urlencode del __VIEWSTATE, cabeceras y
+    cookies) se hace aquí, durante la espera, para que en la apertura solo quede
+    escribir los bytes en la conexión ya abierta con `enviar_seleccion`.
     
     Args:
-        session: Sesión de requests
+        session: Cliente HTTP (aporta las cookies de la sesión)
         token: Token de AltaEventos
         sesion_data: Datos de la sesión obtenidos de extraer_cod_sesion
         person_code: Código de persona del usuario
         state: Estado de ASP.NET (viewstate, etc.)
+        mostrar: Imprimir los datos de la sesión (no al volver a prepararla entre reintentos)
     
     Returns:
-        Texto de la respuesta del servidor
+        Petición lista para enviarse con `enviar_seleccion`
     """
-    url_alta_eventos = f"https://deportesweb.madrid.es/DeportesWeb/Modulos/VentaServicios/Eventos/AltaEventos?token={token}"
+    url_alta_eventos = f"{URL_BASE}/DeportesWeb/Modulos/VentaServicios/Eventos/AltaEventos?token={token}"
     
     event_argument = json.dumps({
         "action": "Seleccionar",
@@ -539,12 +1647,14 @@ def seleccionar_clase(session: requests.Session, token: str, sesion_data: dict,
     if "__EVENTVALIDATION" in state:
         post_data["__EVENTVALIDATION"] = state["__EVENTVALIDATION"]
     
-    print(f"\n{'='*60}")
-    print(f"🎫 Seleccionando clase: {sesion_data['nom_evento']}")
-    print(f"   📅 Fecha: {sesion_data['fecha']}")
-    print(f"   ⏰ Hora: {sesion_data['hora_desde']} - {sesion_data['hora_hasta']}")
-    print(f"   📍 Sala: {sesion_data['nom_sala']}")
-    print(f"   🔑 COD_SESION: {sesion_data['cod_sesion']}")
+    if mostrar:
+        print(f"\n{'='*60}")
+        print(f"🎫 Preparando selección: {sesion_data['nom_evento']}")
+        print(f"   📅 Fecha: {sesion_data['fecha']}")
+        print(f"   ⏰ Hora: {sesion_data['hora_desde']} - {sesion_data['hora_hasta']}")
+        print(f"   📍 Sala: {sesion_data['nom_sala']}")
+        print(f"   🔑 COD_SESION: {sesion_data['cod_sesion']}")
+        print(f"{'='*60}\n")
     
     headers = {
         **HEADERS,
@@ -552,30 +1662,57 @@ def seleccionar_clase(session: requests.Session, token: str, sesion_data: dict,
         "Content-Type": "application/x-www-form-urlencoded; charset=utf-8",
     }
     
-    r = session.post(url_alta_eventos, data=post_data, headers=headers)
+    return session.build_request(
+        "POST", url_alta_eventos,
+        content=urllib.parse.urlencode(post_data).encode("utf-8"),
+        headers=headers,
+        extensions={"paso": "seleccionar_clase", "detalle": f"{sesion_data['nom_evento']} {sesion_data['fecha']} {sesion_data['hora_desde']}"}
+    )
+
+
+async def enviar_seleccion(session: httpx.AsyncClient, peticion: httpx.Request, state: dict) -> RespuestaDelta:
+    """Envía un POST de selección preparado con `preparar_seleccion` y actualiza el state"""
+    r = await session.send(peticion)
     r.raise_for_status()
     
-    update_state_from_delta(state, r.text)
+    delta = update_state_from_delta(state, r.text)
     
-    print(f"✅ Respuesta recibida ({len(r.text)} bytes)")
-    print(f"{'='*60}\n")
+    print(f"✅ Respuesta de selección recibida ({len(r.text)} bytes)")
+    
+    return delta
+
+
+async def seleccionar_clase(session: httpx.AsyncClient, token: str, sesion_data: dict, person_code: str, state: dict) -> RespuestaDelta:
+    """
+    Hace el POST para seleccionar/reservar una clase específica.
+    
+    Args:
+        session: Cliente HTTP con la sesión iniciada
+        token: Token de AltaEventos
+        sesion_data: Datos de la sesión obtenidos de extraer_cod_sesion
+        person_code: Código de persona del usuario
+        state: Estado de ASP.NET (viewstate, etc.)
     
-    return r.text
+    Returns:
+        Respuesta delta del servidor ya analizada
+    """
+    peticion = preparar_seleccion(session, token, sesion_data, person_code, state)
+    return await enviar_seleccion(session, peticion, state)
 
 
-def confirmar_carrito(session: requests.Session, referer: str, state: dict):
+async def confirmar_carrito(session: httpx.AsyncClient, referer: str, state: dict):
     """
     Hace el GET a CarritoConfirmar para cargar la página de confirmación.
     
     Args:
-        session: Sesión de requests (ya tiene las cookies necesarias)
+        session: Cliente HTTP (ya tiene las cookies necesarias)
         referer: URL del referer (AltaEventos)
         state: Diccionario de estado ASP.NET (se actualizará con los nuevos valores)
     
     Returns:
-        Texto HTML de la respuesta
+        Extractor con los campos ocultos de la página (el resto se lee en segundo plano)
     """
-    url_carrito = "https://deportesweb.madrid.es/DeportesWeb/Modulos/VentaServicios/CarritoConfirmar"
+    url_carrito = f"{URL_BASE}/DeportesWeb/Modulos/VentaServicios/CarritoConfirmar"
     
     headers = {
         "User-Agent": HEADERS["User-Agent"],
@@ -591,40 +1728,34 @@ def confirmar_carrito(session: requests.Session, referer: str, state: dict):
     }
     
     print(f"\n{'='*60}")
-    print(f"🛒 Accediendo a CarritoConfirmar...")
+    print("🛒 Accediendo a CarritoConfirmar...")
     
-    r = session.get(url_carrito, headers=headers)
-    r.raise_for_status()
+    _, pagina = await leer_campos_ocultos(session, url_carrito, headers, "confirmar_carrito")
     
-    # Parsear el HTML para obtener el nuevo state
-    soup = BeautifulSoup(r.text, "html.parser")
-    state["__VIEWSTATE"] = soup.find("input", {"id": "__VIEWSTATE"})["value"]
-    state["__VIEWSTATEGENERATOR"] = soup.find("input", {"id": "__VIEWSTATEGENERATOR"})["value"]
-    ev_tag = soup.find("input", {"id": "__EVENTVALIDATION"})
-    if ev_tag:
-        state["__EVENTVALIDATION"] = ev_tag["value"]
+    # Con los campos ocultos basta para el nuevo state
+    state.update(pagina.state())
     
-    print(f"✅ Respuesta recibida ({len(r.text)} bytes)")
+    print(f"✅ Respuesta recibida ({pagina.leidos} bytes leídos)")
     print(f"{'='*60}\n")
     
-    return r.text
+    return pagina
 
 
-def finalizar_reserva(session: requests.Session, state: dict, nombre: str, apellidos: str, correo: str):
+async def finalizar_reserva(session: httpx.AsyncClient, state: dict, nombre: str, apellidos: str, correo: str) -> RespuestaDelta:
     """
     Hace el POST final para confirmar la reserva en el carrito.
     
     Args:
-        session: Sesión de requests
+        session: Cliente HTTP con la sesión iniciada
         state: Estado ASP.NET (viewstate, etc.)
         nombre: Nombre del usuario
         apellidos: Apellidos del usuario
         correo: Correo electrónico del usuario
     
     Returns:
-        Texto de la respuesta del servidor
+        Respuesta delta del servidor ya analizada
     """
-    url_carrito = "https://deportesweb.madrid.es/DeportesWeb/Modulos/VentaServicios/CarritoConfirmar"
+    url_carrito = f"{URL_BASE}/DeportesWeb/Modulos/VentaServicios/CarritoConfirmar"
     
     event_argument = json.dumps({
         "action": "ConfirmCart",
@@ -653,110 +1784,269 @@ def finalizar_reserva(session: requests.Session, state: dict, nombre: str, apell
     }
     
     print(f"\n{'='*60}")
-    print(f"✅ Finalizando reserva...")
+    print("✅ Finalizando reserva...")
     
     
-    r = session.post(url_carrito, data=post_data, headers=headers)
+    r = await session.post(url_carrito, data=post_data, headers=headers, extensions={"paso": "finalizar_reserva"})
     r.raise_for_status()
     
-    update_state_from_delta(state, r.text)
+    delta = update_state_from_delta(state, r.text)
     
     print(f"✅ Respuesta recibida ({len(r.text)} bytes)")
     print(f"{'='*60}\n")
     
-    return r.text
+    return delta
 
 
 # =========================
-# MAIN
+# Disparo en la apertura
 # =========================
 
-def extraer_person_code(html: str) -> str | None:
+async def esperar_hasta_deadline(deadline: float) -> None:
     """
-    Extrae el PERSON_CODE del HTML de AltaEventos.
-    Busca patrones como:
-    - data-person-code="9c879716dbb3e6068e0ff3a82f11cbe515346dbd6b08fd84"
-    - "personCode":"9c879716dbb3e6068e0ff3a82f11cbe515346dbd6b08fd84"
-    - personCode: '9c879716dbb3e6068e0ff3a82f11cbe515346dbd6b08fd84'
+    Espera hasta `deadline` (en segundos de time.perf_counter).
+    
+    Duerme con asyncio.sleep mientras falte más de MARGEN_SPIN_SEGUNDOS y hace
+    spin-wait el último tramo, cediendo el bucle en cada vuelta para no bloquear
+    otras tareas.
+    """
+    while True:
+        restante = deadline - time.perf_counter()
+        if restante <= MARGEN_SPIN_SEGUNDOS:
+            break
+        # Dormir en tramos acotados para corregir la deriva de los temporizadores largos
+        await asyncio.sleep(min(restante - MARGEN_SPIN_SEGUNDOS, 60))
+    
+    while time.perf_counter() < deadline:
+        await asyncio.sleep(0)
+
+
+async def disparar_en_apertura(hora_apertura: datetime, enviar: Callable[[], Awaitable], offset_ms: float = OFFSET_DISPARO_MS, reloj: RelojServidor | None = None, preparar: Callable[[], Awaitable] | None = None):
+    """
+    Lanza `enviar()` en `hora_apertura` + `offset_ms` con precisión de milisegundos.
     
     Args:
-        html: HTML de la página AltaEventos
+        hora_apertura: Instante (hora local) en que abre la reserva
+        enviar: Función sin argumentos que devuelve la corrutina del POST ya preparado
+        offset_ms: Desfase del disparo respecto a la apertura (negativo = antes)
+        reloj: Estimación del reloj del servidor; sin ella se usa el reloj local
+        preparar: Corrutina opcional que se lanza ANTELACION_CALENTAMIENTO segundos antes
+            (p. ej. calentar_conexiones)
     
     Returns:
-        El PERSON_CODE si lo encuentra, None en caso contrario
+        Lo que devuelva `enviar()`
     """
-    # Patrón 1: atributo data-
-    match = re.search(r'data-person-code=["\']([a-f0-9]{64})["\']', html)
-    if match:
-        return match.group(1)
-    
-    # Patrón 2: JSON con comillas dobles
-    match = re.search(r'"personCode"\s*:\s*"([a-f0-9]{64})"', html)
-    if match:
-        return match.group(1)
+    # Convertir la hora de apertura a un deadline monótono una sola vez
+    if reloj:
+        apertura = reloj.deadline_monotonic(hora_apertura)
+        print(f"   🕰️ Desfase con el servidor: {reloj.resumen()}")
+    else:
+        apertura = time.perf_counter() + (hora_apertura - datetime.now()).total_seconds()
+    deadline = apertura + offset_ms / 1000
     
-    # Patrón 3: JSON con comillas simples
-    match = re.search(r"'personCode'\s*:\s*'([a-f0-9]{64})'", html)
-    if match:
-        return match.group(1)
+    if preparar and deadline - time.perf_counter() > ANTELACION_CALENTAMIENTO:
+        await esperar_hasta_deadline(deadline - ANTELACION_CALENTAMIENTO)
+        await preparar()
+    await esperar_hasta_deadline(deadline)
     
-    # Patrón 4: Variable JavaScript
-    match = re.search(r'personCode\s*=\s*["\']([a-f0-9]{64})["\']', html)
-    if match:
-        return match.group(1)
+    t_envio = time.perf_counter()
+    respuesta = await enviar()
+    t_respuesta = time.perf_counter()
     
-    # Patrón 5: Dentro de un objeto JavaScript sin comillas
-    match = re.search(r'personCode\s*:\s*["\']?([a-f0-9]{64})["\']?', html)
-    if match:
-        return match.group(1)
+    print(f"   📤 Petición enviada a {(t_envio - apertura) * 1000:+.1f} ms de la apertura")
+    print(f"   📥 Respuesta recibida a {(t_respuesta - apertura) * 1000:+.1f} ms (ida y vuelta {(t_respuesta - t_envio) * 1000:.1f} ms)")
     
-    return None
+    return respuesta
 
-async def main():
-    load_dotenv()
-    email = os.getenv("EMAIL")
-    password = os.getenv("PASSWORD")
-    mongo_url = os.getenv("MONGO_URL")
-    person_code = os.getenv("PERSON_CODE")  # Del .env como fallback
-    nombre = os.getenv("NOMBRE")
-    apellidos = os.getenv("APELLIDOS")
-    
-    if not email or not password:
-        raise ValueError("Faltan EMAIL o PASSWORD en .env")
-    
-    if not nombre or not apellidos:
-        raise ValueError("Faltan NOMBRE o APELLIDOS en .env")
-    
-    db_manager = None
-    if mongo_url:
-        db_manager = DatabaseManager(mongo_url)
-    else:
-        print("⚠️ MONGO_URL no configurada. No se filtrarán clases ya reservadas.")
+async def calentar_conexiones(session: httpx.AsyncClient, conexiones: int) -> None:
+    """
+    Abre `conexiones` conexiones del pool a la vez con un GET ligero, para que el
+    disparo no pague DNS + TCP + TLS si el servidor cerró las de la precarga.
+    """
+    async def calentar():
+        try:
+            await session.get(f"{URL_BASE}/favicon.ico", headers={"User-Agent": HEADERS["User-Agent"]},
+                              extensions={"paso": "calentamiento"})
+        except httpx.HTTPError:
+            pass
+    
+    await asyncio.gather(*(calentar() for _ in range(conexiones)))
 
-    print("\n🎯 SISTEMA DE RESERVAS AUTOMÁTICO")
-    plan = await preparar_plan_de_reservas(db_manager)
-    
-    if not plan:
-        print("\n✅ ¡Todas las clases ya están reservadas!")
-        if db_manager:
-            db_manager.cerrar()
-        return
+
+# Frases de los avisos del portal, en minúsculas y sin tildes (se comparan con el texto normalizado).
+# Además de las del servidor simulado, variantes habituales de deportesweb para cada caso
+_AVISOS_CARRITO = ("en el carrito", "finalice la compra")
+_AVISOS_LIMITE = ("no permite mas de", "limite de reservas", "ya tiene una reserva", "ya esta inscrit")
+_AVISOS_COMPLETA = ("no quedan plazas", "no hay plazas", "no existen plazas", "sin plazas", "plazas agotadas",
+                    "aforo completo", "sesion completa", "esta completa")
+_AVISOS_NO_ABIERTA = ("todavia no", "aun no", "no esta disponible", "no se encuentra disponible", "fuera de plazo",
+                      "plazo de reserva", "plazo de inscripcion", "no se puede reservar hasta", "no se permite reservar hasta")
+_PATRON_ETIQUETA = re.compile(r"<[^>]+>")
+
+
+def texto_avisos(respuesta: RespuestaDelta) -> str:
+    """
+    Texto de todos los segmentos salvo los campos ocultos (que pueden ocupar cientos de KB):
+    el aviso puede llegar en un updatePanel, un scriptBlock, un pageRedirect o un error.
+    Sin etiquetas HTML, en minúsculas y sin tildes ("m&#225;s" -> "mas").
+    """
+    texto = " ".join(
+        respuesta.contenido(segmento) for segmento in respuesta.segmentos if segmento.tipo != "hiddenField"
+    )
+    texto = unicodedata.normalize("NFKD", html_lib.unescape(_PATRON_ETIQUETA.sub(" ", texto)).lower())
+    return "".join(caracter for caracter in texto if not unicodedata.combining(caracter))
+
+
+def clasificar_seleccion(respuesta: RespuestaDelta) -> str:
+    """
+    Resultado de un POST Seleccionar a partir de su delta:
+    "ok" (al carrito), "carrito_ocupado" (el carrito ya tiene otra sesión y no admite
+    más), "limite" (ya reservada), "completa", "no_abierta", "aviso_desconocido" o
+    "transitorio" (error del servidor, delta incompleto...).
+    
+    "aviso_desconocido" es un delta bien formado con un aviso que no coincide con ninguna
+    frase conocida: seleccionar_con_reintentos lo reintenta como "no_abierta" (alrededor
+    de la apertura es lo más probable) y muestra el texto para poder añadirlo a las listas.
+    """
+    if respuesta.redirige_a("CarritoConfirmar"):
+        return "ok"
+    
+    avisos = texto_avisos(respuesta)
+    for resultado, patrones in (("carrito_ocupado", _AVISOS_CARRITO), ("limite", _AVISOS_LIMITE),
+                                ("completa", _AVISOS_COMPLETA), ("no_abierta", _AVISOS_NO_ABIERTA)):
+        if any(patron in avisos for patron in patrones):
+            return resultado
+    if not respuesta.completa or respuesta.errores:
+        return "transitorio"
+    return "aviso_desconocido"
+
+
+async def enviar_con_duplicado(session: httpx.AsyncClient, peticion: httpx.Request, state: dict, retardo: float) -> RespuestaDelta:
+    """
+    Envía `peticion` y, si en `retardo` segundos no ha respondido, lanza una copia
+    que el pool saca por otra conexión. Devuelve la primera respuesta que entra en
+    el carrito (cancelando la otra); si ninguna lo hace, espera a todas (una copia
+    descartada podría haber entrado) y devuelve la primera.
+    """
+    envios = [asyncio.create_task(enviar_seleccion(session, peticion, state))]
+    terminados, _ = await asyncio.wait(envios, timeout=retardo)
+    if not terminados:
+        print(f"   ⏱️ Sin respuesta en {retardo * 1000:.0f} ms, enviando un duplicado por otra conexión")
+        copia = httpx.Request(peticion.method, peticion.url, headers=peticion.headers,
+                              content=peticion.content, extensions={**peticion.extensions, "detalle": "duplicado"})
+        envios.append(asyncio.create_task(enviar_seleccion(session, copia, state)))
+    
+    respuestas = []
+    error = None
+    try:
+        for siguiente in asyncio.as_completed(envios):
+            try:
+                respuesta = await siguiente
+            except httpx.HTTPError as e:
+                error = e
+                continue
+            if respuesta.redirige_a("CarritoConfirmar"):
+                return respuesta
+            respuestas.append(respuesta)
+    finally:
+        # El envío perdedor se cancela y se recoge (sin "Task exception was never retrieved")
+        for envio in envios:
+            envio.cancel()
+        await asyncio.gather(*envios, return_exceptions=True)
+    
+    if respuestas:
+        return respuestas[0]
+    raise error
+
+
+async def seleccionar_con_reintentos(session: httpx.AsyncClient, peticion: httpx.Request, state: dict, reloj: RelojServidor | None = None, duplicar: bool = DUPLICAR_SELECCION, preparar: Callable[[], httpx.Request] | None = None) -> tuple[str, RespuestaDelta | None]:
+    """
+    Envía un POST Seleccionar preparado hasta que entra en el carrito o deja de tener sentido.
     
-    mostrar_plan_de_reservas(plan)
+    Mientras la sesión "aún no está abierta" (o el aviso no se reconoce) reintenta cada
+    PAUSA_NO_ABIERTA_MS; ante errores transitorios espera ESPERAS_TRANSITORIO_MS crecientes;
+    "completa", "limite" y "carrito_ocupado" son definitivos. Todo dentro de
+    VENTANA_REINTENTOS_SEGUNDOS desde el primer envío. Con `duplicar`, cada intento lleva un
+    duplicado por otra conexión si tarda más de max(RETARDO_DUPLICADO_MS, 2 × RTT mínimo del reloj).
     
-    # Procesar todas las clases directamente (la espera se hará en el POST de reserva)
-    proximas_a_procesar = plan
+    Args:
+        preparar: Vuelve a construir la petición con el state y las cookies actuales; se usa
+            cuando una respuesta los ha cambiado, para no reenviar un ViewState caducado
     
-    session = requests.Session()
+    Returns:
+        (resultado, última respuesta). El resultado es el de clasificar_seleccion, salvo
+        "carrito_incierto": "limite" tras un intento sin respuesta, que pudo entrar en el
+        carrito sin que lo supiéramos (hay que intentar confirmarlo).
+    """
+    fin_ventana = time.perf_counter() + VENTANA_REINTENTOS_SEGUNDOS
+    retardo_duplicado = None
+    if duplicar:
+        rtt = reloj.rtt_minimo if reloj and reloj.muestras else 0
+        retardo_duplicado = max(RETARDO_DUPLICADO_MS / 1000, 2 * rtt)
+    
+    intentos = 0
+    transitorios = 0
+    incierto = False
+    aviso_mostrado = False
+    respuesta = None
+    while True:
+        intentos += 1
+        enviado = (state.get("__VIEWSTATE"), [(cookie.name, cookie.value) for cookie in session.cookies.jar])
+        try:
+            if retardo_duplicado is None:
+                respuesta = await enviar_seleccion(session, peticion, state)
+            else:
+                respuesta = await enviar_con_duplicado(session, peticion, state, retardo_duplicado)
+            resultado = clasificar_seleccion(respuesta)
+        except httpx.HTTPError as e:
+            print(f"   ⚠️ Intento {intentos} sin respuesta válida: {e!r}")
+            resultado = "transitorio"
+            incierto = True
+        
+        if resultado == "limite" and incierto:
+            return "carrito_incierto", respuesta
+        if resultado in ("ok", "limite", "completa", "carrito_ocupado"):
+            if intentos > 1:
+                print(f"   🔁 Resultado tras {intentos} intentos: {resultado}")
+            return resultado, respuesta
+        
+        if resultado == "aviso_desconocido" and not aviso_mostrado:
+            print(f"   ❔ Aviso no reconocido, se trata como \"no abierta\": {texto_avisos(respuesta).strip()[:200]}")
+            aviso_mostrado = True
+        if resultado in ("no_abierta", "aviso_desconocido"):
+            pausa = PAUSA_NO_ABIERTA_MS / 1000
+        else:
+            pausa = ESPERAS_TRANSITORIO_MS[min(transitorios, len(ESPERAS_TRANSITORIO_MS) - 1)] / 1000
+            transitorios += 1
+        
+        if time.perf_counter() + pausa >= fin_ventana:
+            print(f"   ⌛ Sin éxito tras {intentos} intentos ({resultado})")
+            return resultado, respuesta
+        print(f"   🔁 Intento {intentos}: {resultado}, reintentando en {pausa * 1000:.0f} ms")
+        if preparar and enviado != (state.get("__VIEWSTATE"), [(cookie.name, cookie.value) for cookie in session.cookies.jar]):
+            peticion = preparar()
+        await asyncio.sleep(pausa)
+
+
+# =========================
+# Sesión
+# =========================
+
+async def iniciar_sesion(session: httpx.AsyncClient, email: str, password: str, state: dict) -> bool:
+    """
+    Hace el login completo (GET Login, SelectMenu, Login) marcando "no cerrar sesión".
     
+    Returns:
+        True si el servidor acepta las credenciales
+    """
     print("\n" + "="*60)
     print("🔐 INICIANDO SESIÓN")
     print("="*60)
     
-    r = session.get(URL_LOGIN, headers=HEADERS)
+    r = await session.get(URL_LOGIN, headers=HEADERS, extensions={"paso": "login_get"})
     r.raise_for_status()
-    state = parse_initial_state(r.text)
-    
+    state.update(parse_initial_state(r.text))
+
     select_menu_data = {
         "ctl00$ScriptManager1": "ctl00$ContentFixedSection$uSecciones$uAlert$uplAlert|ContentFixedSection_uSecciones_uAlert_uplAlert",
         "__EVENTTARGET": "ContentFixedSection_uSecciones_uAlert_uplAlert",
@@ -773,10 +2063,10 @@ async def main():
         "__ASYNCPOST": "true",
         **state
     }
-    r = session.post(URL_LOGIN, data=select_menu_data, headers=HEADERS)
+    r = await session.post(URL_LOGIN, data=select_menu_data, headers=HEADERS, extensions={"paso": "login_select_menu"})
     r.raise_for_status()
     update_state_from_delta(state, r.text)
-    
+
     login_data = {
         "ctl00$ScriptManager1": "ctl00$ContentFixedSection$uLogin$uAlert$uplAlert|ContentFixedSection_uLogin_uAlert_uplAlert",
         "__EVENTTARGET": "ContentFixedSection_uLogin_uAlert_uplAlert",
@@ -787,281 +2077,1181 @@ async def main():
         "__ASYNCPOST": "true",
         **state
     }
-    r = session.post(URL_LOGIN, data=login_data, headers=HEADERS)
+    r = await session.post(URL_LOGIN, data=login_data, headers=HEADERS, extensions={"paso": "login"})
     r.raise_for_status()
-    update_state_from_delta(state, r.text)
+    delta_login = update_state_from_delta(state, r.text)
     
-    if not is_login_success(r.text, session):
-        print("❌ LOGIN FALLIDO")
-        if db_manager:
-            db_manager.cerrar()
-        return
+    if not is_login_success(delta_login, session):
+        return False
     
     print("✅ LOGIN CORRECTO")
+    return True
+
+
+def exportar_cookies(session: httpx.AsyncClient) -> list[dict]:
+    return [
+        {"name": cookie.name, "value": cookie.value, "domain": cookie.domain, "path": cookie.path}
+        for cookie in session.cookies.jar
+    ]
+
+
+def importar_cookies(session: httpx.AsyncClient, cookies: list[dict]) -> None:
+    for cookie in cookies:
+        session.cookies.set(cookie["name"], cookie["value"], domain=cookie["domain"], path=cookie["path"])
+
+
+def caducidad_sesion(session: httpx.AsyncClient) -> datetime:
+    """Caducidad de la cookie Token, o HORAS_VALIDEZ_SESION desde ahora si es de sesión"""
+    for cookie in session.cookies.jar:
+        if cookie.name == "Token" and cookie.expires:
+            return datetime.fromtimestamp(cookie.expires)
+    return datetime.now() + timedelta(hours=HORAS_VALIDEZ_SESION)
+
+
+async def restaurar_sesion(session: httpx.AsyncClient, db_manager, email: str) -> bool:
+    """
+    Carga en el cliente las cookies guardadas por una ejecución anterior.
+    
+    La comprobación local (que no haya caducado y que incluya Token) no cuesta
+    ninguna petición; si el servidor la rechaza, navegar_a_alta_eventos fallará y
+    main() hará el login completo.
+    
+    Returns:
+        True si se han restaurado cookies utilizables
+    """
+    cookies = await db_manager.cargar_sesion(email)
+    if not cookies or not any(cookie["name"] == "Token" for cookie in cookies):
+        return False
     
+    importar_cookies(session, cookies)
+    print("♻️ Reutilizando sesión guardada (sin login)")
+    return True
+
+
+async def reutilizar_tokens_navegacion(session: httpx.AsyncClient, db_manager, email: str, state: dict, centro: str = CENTRO_POR_DEFECTO) -> tuple[str, str, ExtractorCamposOcultos] | None:
+    """
+    Abre AltaEventos de `centro` directamente con sus tokens guardados, sin
+    select_facility ni select_centro_menu_post (cuatro peticiones menos).
+    
+    El TTL de los tokens se estima ejecución a ejecución y centro a centro: si su edad
+    supera la estimación en más de MARGEN_EXPLORACION_TOKENS, ni se intenta. Solo cuenta
+    como rechazo que el servidor, con la sesión viva, redirija a Home o Centro: la
+    redirección a Login (cookie caducada), una página sin campos ocultos o un error de
+    red no dicen nada del TTL.
+    
+    Returns:
+        Lo mismo que navegar_a_alta_eventos, o None si hay que hacer la navegación completa
+    """
+    tokens = await db_manager.cargar_tokens_navegacion(email, centro)
+    if not tokens:
+        return None
+    
+    edad = (datetime.now() - tokens["obtenidos"]).total_seconds()
+    ttl = tokens["ttl"]
+    # Por encima de la estimación se sigue probando un margen, para que pueda volver a subir
+    if ttl is not None and edad >= ttl * (1 + MARGEN_EXPLORACION_TOKENS):
+        print(f"⏭️ Tokens de navegación de {centro} caducados ({edad / 60:.0f} min, TTL estimado {ttl / 60:.0f} min)")
+        return None
+    
+    print(f"♻️ Probando tokens de navegación guardados de {centro} ({edad / 60:.0f} min)...")
+    try:
+        pagina_alta = await get_alta_eventos(
+            session, token=tokens["alta"],
+            referer=f"{URL_BASE}/DeportesWeb/Centro?token={tokens['centro']}",
+            person_code=True
+        )
+        state.update(pagina_alta.state())
+    except RedireccionAltaEventos as e:
+        if e.sesion_caducada:
+            print("⚠️ La sesión ha caducado antes de probar los tokens de navegación: navegación completa")
+            return None
+        print(f"⚠️ Tokens de navegación rechazados: {e}")
+        await db_manager.registrar_edad_tokens(email, centro, edad, validos=False, ttl=ttl)
+        return None
+    except ValueError as e:
+        print(f"⚠️ AltaEventos no se ha podido leer con los tokens guardados ({e}): navegación completa")
+        return None
+    except httpx.HTTPError as e:
+        print(f"⚠️ Error de red probando los tokens de navegación ({type(e).__name__}): navegación completa")
+        return None
+    
+    await db_manager.registrar_edad_tokens(email, centro, edad, validos=True)
+    print(f"✅ AltaEventos de {centro} abierta con tokens guardados")
+    return tokens["centro"], tokens["alta"], pagina_alta
+
+
+async def navegar_a_alta_eventos(session: httpx.AsyncClient, state: dict, centro: str = CENTRO_POR_DEFECTO) -> tuple[str, str, ExtractorCamposOcultos] | None:
+    """
+    Navega Home -> centro -> Oferta de actividades -> AltaEventos.
+    
+    Returns:
+        (token de instalación, token de AltaEventos, página de AltaEventos leída), o None si
+        el servidor no redirige como se espera (p. ej. la sesión no es válida)
+    """
     print("\n" + "="*60)
-    print("🏢 NAVEGANDO A LA FUNDI")
+    print(f"🏢 NAVEGANDO A {centro.upper()}")
     print("="*60)
     
-    ajax_response = select_facility(session, facility_code="2", facility_name="La Fundi", state=state)
+    datos_centro = CENTROS[centro]
+    ajax_response = await select_facility(session, facility_code=datos_centro["facility_code"], facility_name=centro, state=state)
     
-    match = re.search(r"pageRedirect\|\|/DeportesWeb/Centro\?token=([A-Z0-9]+)", urllib.parse.unquote(ajax_response))
+    match = re.search(r"/DeportesWeb/Centro\?token=([A-Z0-9]+)", ajax_response.redirect or "")
     if not match:
         print("❌ No se pudo extraer token de instalación")
-        if db_manager:
-            db_manager.cerrar()
-        return
+        return None
     
     token = match.group(1)
     print(f"✅ Token instalación: {token}")
     
-    ajax_centro_response = select_centro_menu_post(
+    ajax_centro_response = await select_centro_menu_post(
         session, token=token,
-        menu_code="8580",
+        menu_code=datos_centro["menu_code"],
         menu_title="Oferta de actividades por día y centro",
         state=state
     )
     
-    match2 = re.search(r"pageRedirect\|\|/DeportesWeb/Modulos/VentaServicios/Eventos/AltaEventos\?token=([A-Z0-9]+)", urllib.parse.unquote(ajax_centro_response))
+    match2 = re.search(r"/DeportesWeb/Modulos/VentaServicios/Eventos/AltaEventos\?token=([A-Z0-9]+)", ajax_centro_response.redirect or "")
     if not match2:
         print("❌ No se pudo extraer token AltaEventos")
-        if db_manager:
-            db_manager.cerrar()
-        return
+        return None
     
     alta_token = match2.group(1)
     print(f"✅ Token AltaEventos: {alta_token}")
     
-    alta_eventos_html = get_alta_eventos(
+    pagina_alta = await get_alta_eventos(
         session, token=alta_token,
-        referer=f"https://deportesweb.madrid.es/DeportesWeb/Centro?token={token}"
+        referer=f"{URL_BASE}/DeportesWeb/Centro?token={token}",
+        person_code=True
     )
     
-    soup = BeautifulSoup(alta_eventos_html, "html.parser")
-    state["__VIEWSTATE"] = soup.find("input", {"id": "__VIEWSTATE"})["value"]
-    state["__VIEWSTATEGENERATOR"] = soup.find("input", {"id": "__VIEWSTATEGENERATOR"})["value"]
-    ev_tag = soup.find("input", {"id": "__EVENTVALIDATION"})
-    if ev_tag:
-        state["__EVENTVALIDATION"] = ev_tag["value"]
-    
-    # >>> NUEVO: Extraer PERSON_CODE del HTML <<>
-    extracted_person_code = extraer_person_code(alta_eventos_html)
-    if extracted_person_code:
-        print(f"✅ PERSON_CODE extraído del HTML: {extracted_person_code}")
-        person_code = extracted_person_code  # Usar el extraído
-    elif not person_code:
-        print("⚠️ No se pudo extraer PERSON_CODE del HTML ni existe en .env")
-        print("   Usando fallback: 9c879716dbb3e6068e0ff3a82f11cbe515346dbd6b08fd84")
-        person_code = "9c879716dbb3e6068e0ff3a82f11cbe515346dbd6b08fd84"
+    state.update(pagina_alta.state())
+    
+    return token, alta_token, pagina_alta
+
+
+class EstadoCentro:
+    """
+    AltaEventos abierta en un centro: sus tokens, su state ASP.NET y su caché de eventos.
+    
+    Varios centros se mantienen abiertos a la vez sobre la misma sesión; como cada uno
+    lleva su propio token y ViewState, sus POST no se pisan y pueden ir en paralelo.
+    """
+    
+    def __init__(self, session: httpx.AsyncClient, nombre: str, token: str, alta_token: str, state: dict):
+        self.nombre = nombre
+        self.token = token
+        self.alta_token = alta_token
+        self.state = state
+        self.cache_eventos = CacheEventos(session, alta_token)
+    
+    @property
+    def url_centro(self) -> str:
+        return f"{URL_BASE}/DeportesWeb/Centro?token={self.token}"
+
+
+async def abrir_centro(session: httpx.AsyncClient, db_manager, email: str, centro: str) -> EstadoCentro | None:
+    """
+    Abre AltaEventos de un centro adicional con un state propio, reutilizando sus
+    tokens guardados si siguen valiendo. Requiere la sesión ya validada.
+    
+    Returns:
+        El EstadoCentro, o None si no se pudo llegar a AltaEventos
+    """
+    if centro not in CENTROS:
+        # La configuración ya se valida con centros_conocidos; esto cubre las clases que no pasan por ahí
+        print(f"⚠️ No se pudo abrir {centro}: no está en CENTROS")
+        return None
+    
+    state = {}
+    navegacion = None
+    if db_manager:
+        navegacion = await reutilizar_tokens_navegacion(session, db_manager, email, state, centro)
+    
+    if navegacion is None:
+        try:
+            navegacion = await navegar_a_alta_eventos(session, state, centro)
+        except (httpx.HTTPError, ValueError) as e:
+            print(f"⚠️ No se pudo abrir {centro}: {e}")
+            return None
+        if navegacion is None:
+            return None
+        if db_manager:
+            await db_manager.guardar_tokens_navegacion(email, centro, navegacion[0], navegacion[1])
+    
+    token, alta_token, _ = navegacion
+    return EstadoCentro(session, centro, token, alta_token, state)
+
+
+def candidatos_clase(clase: dict) -> list[tuple[str, str, str]]:
+    """(centro, nombre, hora) de la clase y de sus alternativas, por orden de preferencia"""
+    candidatos = [(clase.get("centro", CENTRO_POR_DEFECTO), clase["nombre"], clase["hora"])]
+    for alternativa in clase.get("alternativas", []):
+        candidatos.append((
+            alternativa["centro"],
+            alternativa.get("nombre", clase["nombre"]),
+            alternativa.get("hora", clase["hora"])
+        ))
+    return candidatos
+
+
+def centros_conocidos(clases: list[dict]) -> list[dict]:
+    """
+    Quita de la configuración los centros que no están en CENTROS (sin sus códigos no se
+    puede navegar a ellos): las alternativas de esos centros se descartan, y las clases
+    cuyo centro principal no existe, también.
+    """
+    validas = []
+    for clase in clases:
+        descripcion = f"{clase['nombre']} ({clase['dia']} {clase['hora']})"
+        centro = clase.get("centro", CENTRO_POR_DEFECTO)
+        if centro not in CENTROS:
+            print(f"⚠️ {descripcion}: el centro \"{centro}\" no está en CENTROS ({', '.join(CENTROS)}), se ignora la clase")
+            continue
+        alternativas = []
+        for alternativa in clase.get("alternativas", []):
+            if alternativa["centro"] in CENTROS:
+                alternativas.append(alternativa)
+            else:
+                print(f"⚠️ {descripcion}: el centro alternativo \"{alternativa['centro']}\" no está en CENTROS, se ignora")
+        if "alternativas" in clase:
+            clase = {**clase, "alternativas": alternativas}
+        validas.append(clase)
+    return validas
+
+
+def centros_del_plan(plan: list[dict]) -> list[str]:
+    """Centros que hay que tener abiertos para el plan, empezando por el de la primera clase"""
+    centros = []
+    for item in plan:
+        for centro, _, _ in candidatos_clase(item["clase"]):
+            if centro not in centros:
+                centros.append(centro)
+    return centros
+
+
+def fecha_de_eventos(item: dict) -> str:
+    """Fecha con la que se cargan en AltaEventos los eventos de la clase del item"""
+    return (datetime.strptime(item["fecha_para_post"], "%Y-%m-%d") + timedelta(days=2)).strftime("%Y-%m-%d")
+
+
+async def buscar_en_centros(item: dict, centros: dict[str, EstadoCentro], llenas: list | None = None, forzar: bool = False) -> list[tuple[EstadoCentro, dict]]:
+    """
+    Carga en paralelo los eventos de la fecha del item en todos sus centros candidatos
+    y devuelve, por orden de preferencia, los candidatos con sesión disponible.
+    
+    Args:
+        llenas: Si se pasa, se le añaden los (EstadoCentro, sesion_data) de los
+            candidatos que existen pero no tienen plazas (para vigilar cancelaciones)
+        forzar: Recargar los eventos aunque estén en CacheEventos (decisiones por plazas)
+    
+    Returns:
+        Lista de (EstadoCentro, sesion_data); cada centro deja su state en esa fecha
+    """
+    clase = item["clase"]
+    fecha_para_post = fecha_de_eventos(item)
+    fecha_clase_str = item["fecha_clase"].strftime("%Y-%m-%d")
+    
+    candidatos = []
+    for centro, nombre, hora in candidatos_clase(clase):
+        if centro in centros:
+            candidatos.append((centros[centro], nombre, hora))
+        else:
+            print(f"   ⚠️ Centro {centro} no disponible, se omite {nombre} {hora}")
+    
+    # Un POST Load por centro (el mismo centro puede aparecer con varias alternativas)
+    unicos = list({estado.nombre: estado for estado, _, _ in candidatos}.values())
+    catalogos = await asyncio.gather(*(
+        estado.cache_eventos.obtener(fecha_para_post, estado.state, forzar=forzar) for estado in unicos
+    ))
+    catalogo_por_centro = {estado.nombre: catalogo for estado, catalogo in zip(unicos, catalogos)}
+    
+    encontrados = []
+    for estado, nombre, hora in candidatos:
+        sesion_data = catalogo_por_centro[estado.nombre].sesion_disponible(
+            nombre_clase=nombre,
+            hora_clase=hora,
+            fecha_esperada=fecha_clase_str
+        )
+        if sesion_data:
+            print(f"   🎫 {estado.nombre}: {nombre} {hora} COD_SESION {sesion_data['cod_sesion']}")
+            encontrados.append((estado, sesion_data))
+        elif llenas is not None:
+            sesion = catalogo_por_centro[estado.nombre].buscar(nombre, hora, fecha_clase_str)
+            if sesion:
+                llenas.append((estado, dict(sesion)))
+    return encontrados
+
+# =========================
+# Flujo de reserva
+# =========================
+
+async def completar_reserva(session: httpx.AsyncClient, alta_token: str, state: dict, usuario: dict) -> bool:
+    """
+    Confirma el carrito tras añadir una clase (GET CarritoConfirmar + POST ConfirmCart).
+    
+    Args:
+        session: Cliente HTTP con la sesión iniciada
+        alta_token: Token de AltaEventos (para el referer)
+        state: Estado ASP.NET (se actualizará con el de la página del carrito)
+        usuario: Dict con "nombre", "apellidos" y "correo"
+    
+    Returns:
+        True si el servidor redirige a CarritoResultado
+    """
+    url_alta_eventos = f"{URL_BASE}/DeportesWeb/Modulos/VentaServicios/Eventos/AltaEventos?token={alta_token}"
+    await confirmar_carrito(
+        session=session,
+        referer=url_alta_eventos,
+        state=state
+    )
+    
+    response_final = await finalizar_reserva(
+        session=session,
+        state=state,
+        nombre=usuario["nombre"],
+        apellidos=usuario["apellidos"],
+        correo=usuario["correo"]
+    )
+    
+    if response_final.redirige_a("CarritoResultado"):
+        return True
+    
+    print(f"   ⚠️ Error en confirmación: {response_final.texto[:300]}")
+    return False
+
+
+class Carrito:
+    """
+    Clases añadidas al carrito de una sesión HTTP y pendientes de confirmar.
+    
+    El carrito es único por sesión: quien confirma se lleva todo lo pendiente en un
+    solo GET CarritoConfirmar + POST ConfirmCart, y las tareas que esperaban el lock
+    encuentran su clase ya confirmada. Si el servidor no admite varias sesiones a la
+    vez (rechaza la segunda con "carrito_ocupado" o la confirmación conjunta falla),
+    `agrupar` pasa a False y cada clase se confirma nada más entrar; las de un lote
+    rechazado se vuelven a seleccionar y se confirman de una en una.
+    """
+    
+    def __init__(self, session: httpx.AsyncClient, usuario: dict, db_manager=None, agrupar: bool = AGRUPAR_CARRITO):
+        self.session = session
+        self.usuario = usuario
+        self.db_manager = db_manager
+        self.agrupar = agrupar
+        self.lock = asyncio.Lock()
+        self.pendientes: list[tuple[dict, EstadoCentro, dict, Callable[[], httpx.Request]]] = []
+        self.resultados: dict[int, bool] = {}
+    
+    def anadir(self, item: dict, centro: EstadoCentro, state: dict, preparar: Callable[[], httpx.Request]) -> None:
+        """
+        Apunta una clase que acaba de entrar en el carrito.
+        
+        Args:
+            state: El usado al seleccionarla
+            preparar: Vuelve a construir su POST Seleccionar (si el lote se rechaza)
+        """
+        self.resultados.pop(id(item), None)
+        self.pendientes.append((item, centro, state, preparar))
+    
+    async def seleccionar(self, peticion: httpx.Request, state: dict, reloj: RelojServidor | None = None, duplicar: bool = DUPLICAR_SELECCION, preparar: Callable[[], httpx.Request] | None = None) -> tuple[str, RespuestaDelta | None]:
+        """
+        seleccionar_con_reintentos que, si el servidor no admite otra sesión en el carrito,
+        confirma lo pendiente y repite la selección (con la petición preparada de nuevo).
+        """
+        resultado, respuesta = await seleccionar_con_reintentos(self.session, peticion, state, reloj, duplicar, preparar)
+        if resultado == "carrito_ocupado":
+            if self.agrupar:
+                print("   ⚠️ El servidor no admite varias clases en el carrito: se confirmarán de una en una")
+                self.agrupar = False
+            await self.confirmar()
+            if preparar:
+                peticion = preparar()
+            resultado, respuesta = await seleccionar_con_reintentos(self.session, peticion, state, reloj, duplicar, preparar)
+        return resultado, respuesta
+    
+    async def confirmar(self) -> bool:
+        """Confirma todo lo pendiente; True si no había nada o quedó todo confirmado"""
+        async with self.lock:
+            return await self._confirmar_pendientes()
+    
+    async def confirmar_clase(self, item: dict) -> bool:
+        """Confirma el carrito salvo que `item` ya se confirmara con otra clase; True si quedó reservada"""
+        async with self.lock:
+            if id(item) not in self.resultados:
+                await self._confirmar_pendientes()
+            return self.resultados.get(id(item), False)
+    
+    async def _confirmar_pendientes(self) -> bool:
+        lote, self.pendientes = self.pendientes, []
+        if not lote:
+            return True
+        if len(lote) > 1:
+            nombres = ", ".join(f"{item['clase']['nombre']} {item['clase']['hora']}" for item, _, _, _ in lote)
+            print(f"\n   🛒 Confirmando {len(lote)} clases en un solo carrito: {nombres}")
+        
+        # Sobre una copia: la página del carrito no debe pisar el state de AltaEventos
+        _, centro, state, _ = lote[-1]
+        confirmada = await completar_reserva(self.session, centro.alta_token, dict(state), self.usuario)
+        if confirmada or len(lote) == 1:
+            for item, _, _, _ in lote:
+                await self._registrar(item, confirmada)
+            return confirmada
+        
+        print("   ⚠️ El servidor no ha aceptado el carrito con varias clases: se confirmarán de una en una")
+        self.agrupar = False
+        todas = True
+        for item, centro, state, preparar in lote:
+            todas = await self._confirmar_sola(item, centro, state, preparar) and todas
+        return todas
+    
+    async def _confirmar_sola(self, item: dict, centro: EstadoCentro, state: dict, preparar: Callable[[], httpx.Request]) -> bool:
+        """Vuelve a seleccionar una clase de un lote rechazado y la confirma sola"""
+        clase = item["clase"]
+        print(f"   🔁 {clase['nombre']} {clase['hora']}: seleccionando de nuevo para confirmarla sola")
+        resultado, _ = await seleccionar_con_reintentos(self.session, preparar(), state, duplicar=False, preparar=preparar)
+        if resultado == "limite":
+            # El lote llegó a entrar para esta clase: ya está reservada
+            print(f"   ℹ️ {clase['nombre']} {clase['hora']}: ya estaba reservada")
+            self.resultados[id(item)] = True
+            if self.db_manager:
+                await self.db_manager.guardar_reserva(clase, item["fecha_clase"])
+            return True
+        if resultado not in ("ok", "carrito_incierto"):
+            print(f"   ❌ {clase['nombre']} {clase['hora']}: no se pudo volver a seleccionar ({resultado})")
+            self.resultados[id(item)] = False
+            return False
+        confirmada = await completar_reserva(self.session, centro.alta_token, dict(state), self.usuario)
+        await self._registrar(item, confirmada)
+        return confirmada
+    
+    async def _registrar(self, item: dict, confirmada: bool) -> None:
+        """Apunta y muestra el resultado de una clase (y la guarda en BD si quedó reservada)"""
+        clase = item["clase"]
+        self.resultados[id(item)] = confirmada
+        if not confirmada:
+            print(f"   ❌ {clase['nombre']} {clase['hora']}: confirmación rechazada")
+            return
+        print(f"   🎉 ¡{clase['nombre']} {clase['hora']} RESERVADA EXITOSAMENTE!")
+        if self.db_manager:
+            await self.db_manager.guardar_reserva(clase, item["fecha_clase"])
+
+
+async def reservar_en_apertura(session: httpx.AsyncClient, item: dict, candidatos: list[tuple[EstadoCentro, dict, dict]], person_code: str, reloj: RelojServidor, carrito: Carrito, db_manager=None, vigiladas: list | None = None) -> bool:
+    """
+    Espera a la apertura de una clase cerrada del plan, dispara la selección y confirma.
+    
+    Se lanza una tarea por clase cerrada sobre la misma sesión: cada una usa su propia
+    copia del state de AltaEventos, y la confirmación pasa por `carrito` (compartido por
+    la sesión), que confirma de una vez las clases que hayan entrado a la par.
+    
+    Args:
+        candidatos: (centro, sesion_data, copia del state) de la clase y sus alternativas,
+            por orden de preferencia. Si la primera no entra en el carrito se dispara la
+            siguiente en el acto, con su POST ya preparado.
+        vigiladas: Si se pasa y la clase no se reserva, se le añaden (item, centro, sesion_data)
+            de cada candidato que respondió "completa", para vigilar cancelaciones
+    
+    Returns:
+        True si la reserva quedó confirmada
+    """
+    clase = item["clase"]
+    hora_apertura = item["hora_apertura"]
+    
+    tiempo_espera = (hora_apertura - datetime.now()).total_seconds()
+    if tiempo_espera > 0:
+        horas = int(tiempo_espera // 3600)
+        minutos = int((tiempo_espera % 3600) // 60)
+        segundos = int(tiempo_espera % 60)
+        print(f"\n   ⏳ {clase['nombre']} {clase['hora']}: esperando {horas}h {minutos}m {segundos}s hasta que abra...")
+        print(f"   🕐 Hora de apertura: {hora_apertura.strftime('%d/%m/%Y %H:%M:%S')}")
+    
+    # Dejar los POST codificados antes de esperar: en la apertura solo queda enviarlos.
+    # Entre reintentos se vuelven a preparar si la respuesta cambia el state
+    peticiones = [
+        (centro, sesion_data, preparar_seleccion(session, centro.alta_token, sesion_data, person_code, state), state,
+         functools.partial(preparar_seleccion, session, centro.alta_token, sesion_data, person_code, state, mostrar=False))
+        for centro, sesion_data, state in candidatos
+    ]
+    
+    centro, sesion_data, peticion, state, preparar = peticiones[0]
+    conexiones = 2 if DUPLICAR_SELECCION else 1
+    resultado, response_seleccion = await disparar_en_apertura(
+        hora_apertura,
+        lambda: carrito.seleccionar(peticion, state, reloj, preparar=preparar),
+        reloj=reloj,
+        preparar=lambda: calentar_conexiones(session, conexiones)
+    )
+    llenos = [(centro, sesion_data)] if resultado == "completa" else []
+    
+    for alternativa in peticiones[1:]:
+        if resultado in ("ok", "carrito_incierto", "limite"):
+            break
+        print(f"   ↪️ {clase['nombre']} {clase['hora']}: sin plaza en {centro.nombre} ({resultado}), probando {alternativa[0].nombre}")
+        centro, sesion_data, peticion, state, preparar = alternativa
+        resultado, response_seleccion = await carrito.seleccionar(peticion, state, reloj, preparar=preparar)
+        if resultado == "completa":
+            llenos.append((centro, sesion_data))
+    
+    if resultado == "limite":
+        print(f"   ⚠️ {clase['nombre']} {clase['hora']}: límite de reservas alcanzado (ya reservada)")
+        if db_manager:
+            await db_manager.guardar_reserva(clase, item["fecha_clase"])
+        return False
+    
+    if resultado not in ("ok", "carrito_incierto"):
+        detalle = response_seleccion.texto[:300] if response_seleccion else "sin respuesta"
+        print(f"   ❌ Error ({clase['nombre']} {clase['hora']}, {resultado}): {detalle}")
+        if vigiladas is not None:
+            vigiladas.extend((item, centro, sesion_data) for centro, sesion_data in llenos)
+        return False
+    
+    if resultado == "ok":
+        print(f"   ✅ ¡{clase['nombre']} {clase['hora']} AÑADIDA AL CARRITO! ({centro.nombre})")
     else:
-        print(f"✅ Usando PERSON_CODE del .env: {person_code}")
+        print(f"   ❓ {clase['nombre']} {clase['hora']}: un intento sin respuesta pudo entrar en el carrito, confirmando")
     
-    print("✅ Página AltaEventos cargada")
+    carrito.anadir(item, centro, state, preparar)
+    return await carrito.confirmar_clase(item)
+
+def intervalo_vigilancia(segundos_hasta_clase: float) -> float:
+    """
+    Pausa hasta la siguiente consulta de una fecha: INTERVALO_VIGILANCIA en las últimas
+    3 horas antes de la clase (cuando se concentran las cancelaciones), el doble hasta
+    un día antes y el cuádruple más allá, con ±JITTER_VIGILANCIA para no ir a compás.
+    """
+    if segundos_hasta_clase > 24 * 3600:
+        factor = 4
+    elif segundos_hasta_clase > 3 * 3600:
+        factor = 2
+    else:
+        factor = 1
+    return INTERVALO_VIGILANCIA * factor * random.uniform(1 - JITTER_VIGILANCIA, 1 + JITTER_VIGILANCIA)
+
+
+async def vigilar_cancelaciones(session: httpx.AsyncClient, vigiladas: list[tuple[dict, EstadoCentro, dict]], person_code: str, reloj: RelojServidor, carrito: Carrito, db_manager, hasta: datetime) -> None:
+    """
+    Consulta las clases llenas hasta `hasta` y reserva en cuanto se libera una plaza.
     
-    # Separar clases abiertas y cerradas
-    clases_abiertas = [p for p in proximas_a_procesar if p["ya_abierta"]]
-    clases_cerradas = [p for p in proximas_a_procesar if not p["ya_abierta"]]
+    Las clases se agrupan por centro y fecha: un solo POST Load cubre todas las de ese
+    día, y de la respuesta solo se leen las plazas de las sesiones vigiladas
+    (plazas_de_sesiones). Cada grupo lleva su propio calendario (intervalo_vigilancia)
+    y las consultas van de una en una, así que nunca hay dos peticiones a la vez.
+    
+    Args:
+        vigiladas: (item del plan, centro, sesion_data) de cada candidato lleno; al reservar
+            un item se dejan de vigilar el resto de sus candidatos
+        hasta: Hora a la que se deja de vigilar
+    """
+    grupos: dict[tuple[str, str], list[tuple[dict, EstadoCentro, dict]]] = {}
+    for vigilada in vigiladas:
+        item, centro, _ = vigilada
+        grupos.setdefault((centro.nombre, fecha_de_eventos(item)), []).append(vigilada)
     
     print("\n" + "="*60)
-    print(f"📊 RESUMEN: {len(clases_abiertas)} abiertas 🟢 | {len(clases_cerradas)} cerradas 🔴")
+    print(f"👀 VIGILANDO CANCELACIONES: {len(vigiladas)} clase(s) en {len(grupos)} consulta(s), "
+          f"hasta las {hasta.strftime('%d/%m %H:%M')}")
     print("="*60)
     
-    # ========================================
-    # FASE 1: Procesar todas las clases ABIERTAS
-    # ========================================
-    if clases_abiertas:
-        print("\n" + "="*60)
-        print(f"🟢 FASE 1: RESERVANDO {len(clases_abiertas)} CLASE(S) ABIERTA(S)")
-        print("="*60)
+    proxima = {clave: time.monotonic() for clave in grupos}
+    consultas = 0
+    while grupos and datetime.now() < hasta:
+        clave = min(proxima, key=proxima.get)
+        espera = min(proxima[clave] - time.monotonic(), (hasta - datetime.now()).total_seconds())
+        if espera > 0:
+            await asyncio.sleep(espera)
+            if datetime.now() >= hasta:
+                break
         
-        for item in clases_abiertas:
+        grupo = grupos[clave]
+        centro = grupo[0][1]
+        ahora = datetime.now()
+        consultas += 1
+        try:
+            respuesta = await load_events_for_date(session, centro.alta_token, clave[1], centro.state, mostrar=False)
+        except httpx.HTTPError as e:
+            print(f"   ⚠️ Consulta de {clave[1]} en {clave[0]} fallida: {e!r}")
+            proxima[clave] = time.monotonic() + 2 * intervalo_vigilancia(0)
+            continue
+        if respuesta.redirect:
+            print(f"   ⚠️ La sesión ha caducado ({respuesta.redirect}), se deja de vigilar")
+            break
+        
+        plazas = plazas_de_sesiones(respuesta.texto, {sesion_data["cod_sesion"] for _, _, sesion_data in grupo})
+        reservados = set()
+        for item, centro, sesion_data in grupo:
             clase = item["clase"]
-            fecha_para_post = (datetime.strptime(item["fecha_para_post"], "%Y-%m-%d") + timedelta(days=2)).strftime("%Y-%m-%d")
-            fecha_clase = item["fecha_clase"]
-            
-            print(f"\n🎯 Procesando: {clase['nombre']}")
-            print(f"   Clase: {fecha_clase.strftime('%d/%m/%Y')} {clase['hora']}")
-            print(f"   Estado: 🟢 Abierta")
-            
-            response = load_events_for_date(
-                session=session,
-                token=alta_token,
-                fecha=fecha_para_post,
-                state=state
-            )
-            
-            fecha_clase_str = fecha_clase.strftime("%Y-%m-%d")
-            sesion_data = extraer_cod_sesion(
-                html_response=response,
-                nombre_clase=clase["nombre"],
-                hora_clase=clase["hora"],
-                fecha_esperada=fecha_clase_str
-            )
+            if id(item) in reservados:
+                continue
+            libres = plazas.get(sesion_data["cod_sesion"], 0)
+            if libres <= 0:
+                continue
             
-            if sesion_data:
-                print(f"   🎫 COD_SESION: {sesion_data['cod_sesion']}")
-                
-                # Hacer POST para seleccionar/reservar la clase
-                response_seleccion = seleccionar_clase(
-                    session=session,
-                    token=alta_token,
-                    sesion_data=sesion_data,
-                    person_code=person_code,
-                    state=state
-                )
-                # Verificar si hay error de límite de reservas
-                if "La sesión seleccionada no permite más de" in response_seleccion or "no permite m&#225;s de" in response_seleccion:
-                    print(f"   ⚠️ Límite de reservas alcanzado para esta sesión")
-                    if db_manager:
-                        await db_manager.guardar_reserva(clase, fecha_clase)
-                    print(f"   💾 Clase marcada como reservada en BD")
-                elif "pageRedirect" in response_seleccion and "CarritoConfirmar" in urllib.parse.unquote(response_seleccion):
-
-                    print(f"   ✅ ¡RESERVA AÑADIDA AL CARRITO!")
-                    
-                    url_alta_eventos = f"https://deportesweb.madrid.es/DeportesWeb/Modulos/VentaServicios/Eventos/AltaEventos?token={alta_token}"
-                    response_carrito = confirmar_carrito(
-                        session=session,
-                        referer=url_alta_eventos,
-                        state=state
-                    )
-                    
-                    response_final = finalizar_reserva(
-                        session=session,
-                        state=state,
-                        nombre=nombre,
-                        apellidos=apellidos,
-                        correo=email
-                    )
-                    
-                    if "pageRedirect" in response_final and "CarritoResultado" in urllib.parse.unquote(response_final):
-                        print(f"   🎉 ¡RESERVA CONFIRMADA!")
-                        if db_manager:
-                            await db_manager.guardar_reserva(clase, fecha_clase)
-                    else:
-                        print(f"   ⚠️ Error en confirmación: {response_final[:300]}")
-                else:
-                    print(f"   ❌ Error: {response_seleccion[:300]}")
-                    
+            print(f"\n   🔔 {clase['nombre']} {clase['hora']} ({centro.nombre}): {libres} plaza(s) libre(s)")
+            peticion = preparar_seleccion(session, centro.alta_token, sesion_data, person_code, centro.state)
+            preparar = functools.partial(preparar_seleccion, session, centro.alta_token, sesion_data, person_code, centro.state, mostrar=False)
+            resultado, _ = await carrito.seleccionar(peticion, centro.state, reloj, duplicar=False, preparar=preparar)
+            if resultado in ("ok", "carrito_incierto"):
+                carrito.anadir(item, centro, centro.state, preparar)
+                if not await carrito.confirmar_clase(item):
+                    continue
+            elif resultado == "limite":
+                print("   ⚠️ Límite de reservas alcanzado (ya reservada)")
+                if db_manager:
+                    await db_manager.guardar_reserva(clase, item["fecha_clase"])
             else:
-                print(f"   ⚠️ No se encontró la sesión")
-    
-    # ========================================
-    # FASE 2: Esperar y reservar la PRIMERA clase cerrada (objetivo)
-    # ========================================
-    if clases_cerradas:
-        clase_objetivo = clases_cerradas[0]  # La primera cerrada (más próxima a abrir)
-        clase = clase_objetivo["clase"]
-        fecha_para_post = (datetime.strptime(clase_objetivo["fecha_para_post"], "%Y-%m-%d") + timedelta(days=2)).strftime("%Y-%m-%d")
-        fecha_clase = clase_objetivo["fecha_clase"]
-        hora_apertura = clase_objetivo["hora_apertura"]
+                print(f"   ❌ Se ha vuelto a llenar ({resultado})")
+                continue
+            reservados.add(id(item))
         
+        # Fuera las clases reservadas (con todos sus candidatos) y las que ya han empezado
+        for clave_grupo in list(grupos):
+            grupos[clave_grupo] = [
+                vigilada for vigilada in grupos[clave_grupo]
+                if id(vigilada[0]) not in reservados and vigilada[0]["fecha_clase"] > ahora
+            ]
+            if not grupos[clave_grupo]:
+                del grupos[clave_grupo]
+                del proxima[clave_grupo]
+        if clave in grupos:
+            hasta_clase = min(item["fecha_clase"] for item, _, _ in grupos[clave]) - ahora
+            proxima[clave] = time.monotonic() + intervalo_vigilancia(hasta_clase.total_seconds())
+    
+    print(f"\n👀 Vigilancia terminada: {consultas} consulta(s), {len(grupos)} grupo(s) sin plaza")
+
+
+# =========================
+# MAIN
+# =========================
+
+def extraer_person_code(html: str) -> str | None:
+    """
+    Extrae el PERSON_CODE del HTML de AltaEventos.
+    Busca patrones como:
+    - data-person-code="9c879716dbb3e6068e0ff3a82f11cbe515346dbd6b08fd84"
+    - "personCode":"9c879716dbb3e6068e0ff3a82f11cbe515346dbd6b08fd84"
+    - personCode: '9c879716dbb3e6068e0ff3a82f11cbe515346dbd6b08fd84'
+    
+    Args:
+        html: HTML de la página AltaEventos
+    
+    Returns:
+        El PERSON_CODE si lo encuentra, None en caso contrario
+    """
+    # Patrón 1: atributo data-
+    match = re.search(r'data-person-code=["\']([a-f0-9]{64})["\']', html)
+    if match:
+        return match.group(1)
+    
+    # Patrón 2: JSON con comillas dobles
+    match = re.search(r'"personCode"\s*:\s*"([a-f0-9]{64})"', html)
+    if match:
+        return match.group(1)
+    
+    # Patrón 3: JSON con comillas simples
+    match = re.search(r"'personCode'\s*:\s*'([a-f0-9]{64})'", html)
+    if match:
+        return match.group(1)
+    
+    # Patrón 4: Variable JavaScript
+    match = re.search(r'personCode\s*=\s*["\']([a-f0-9]{64})["\']', html)
+    if match:
+        return match.group(1)
+    
+    # Patrón 5: Dentro de un objeto JavaScript sin comillas
+    match = re.search(r'personCode\s*:\s*["\']?([a-f0-9]{64})["\']?', html)
+    if match:
+        return match.group(1)
+    
+    return None
+
+def configurar_url_base(url_base: str | None) -> None:
+    """Apunta todas las peticiones a `url_base` (sin barra final); None deja el servidor real"""
+    global URL_BASE, URL_LOGIN, URL_HOME
+    if not url_base:
+        return
+    URL_BASE = url_base.rstrip("/")
+    URL_LOGIN = f"{URL_BASE}/DeportesWeb/Login"
+    URL_HOME = f"{URL_BASE}/DeportesWeb/Home"
+    HEADERS["Origin"] = URL_BASE
+    print(f"🌐 Servidor de reservas: {URL_BASE}")
+
+
+def cargar_configuracion() -> dict:
+    """Lee las credenciales y datos del usuario del entorno / .env"""
+    load_dotenv()
+    config = {
+        "email": os.getenv("EMAIL"),
+        "password": os.getenv("PASSWORD"),
+        "mongo_url": os.getenv("MONGO_URL"),
+        "person_code": os.getenv("PERSON_CODE"),  # Del .env como fallback
+        "nombre": os.getenv("NOMBRE"),
+        "apellidos": os.getenv("APELLIDOS"),
+        "url_base": os.getenv("URL_BASE"),
+        "clases": centros_conocidos(CLASES),
+    }
+    
+    if not config["email"] or not config["password"]:
+        raise ValueError("Faltan EMAIL o PASSWORD en .env")
+    
+    if not config["nombre"] or not config["apellidos"]:
+        raise ValueError("Faltan NOMBRE o APELLIDOS en .env")
+    
+    return config
+
+
+async def conectar_bd(mongo_url: str | None) -> DatabaseManager | None:
+    if not mongo_url:
+        print("⚠️ MONGO_URL no configurada. No se filtrarán clases ya reservadas.")
+        return None
+    db_manager = DatabaseManager(mongo_url)
+    await db_manager.inicializar()
+    return db_manager
+
+
+async def guardar_informe_ejecucion(medidor: MedidorLatencia, db_manager, email: str) -> None:
+    """Escribe el informe JSON de la ejecución en DIRECTORIO_INFORMES y guarda su resumen en BD"""
+    informe = medidor.informe()
+    medidor.mostrar_resumen()
+    
+    os.makedirs(DIRECTORIO_INFORMES, exist_ok=True)
+    ruta = os.path.join(DIRECTORIO_INFORMES, f"ejecucion_{informe['inicio']:%Y%m%d_%H%M%S}_{email.split('@')[0]}.json")
+    with open(ruta, "w", encoding="utf-8") as f:
+        json.dump(informe, f, ensure_ascii=False, indent=2, default=str)
+    print(f"📝 Informe de la ejecución: {ruta}")
+    
+    if db_manager:
+        await db_manager.guardar_informe(email, {clave: valor for clave, valor in informe.items() if clave != "mediciones"})
+
+
+async def ejecutar_ciclo(session: httpx.AsyncClient, reloj: RelojServidor, db_manager, config: dict, limite: asyncio.Semaphore | None = None, medidor: MedidorLatencia | None = None, vigilar_hasta: datetime | None = None, hasta_apertura: datetime | None = None) -> None:
+    """
+    Un ciclo completo de reservas: plan, sesión, FASE 1 (clases abiertas) y
+    FASE 2 (clases cerradas, cada una en su apertura).
+    
+    Args:
+        session: Cliente HTTP propio de la cuenta
+        reloj: Estimación del reloj del servidor (compartible entre cuentas)
+        db_manager: BD (o vista de la cuenta con para_cuenta), o None
+        config: Credenciales y datos de la cuenta (ver cargar_configuracion); "clases" opcional,
+            "multicuenta" si hay más cuentas (sin PERSON_CODE, la cuenta se omite)
+        limite: Semáforo que acota cuántas cuentas hacen login/navegación a la vez
+        medidor: Medidor conectado al cliente (crear_cliente_http); si se pasa, el ciclo
+            termina con su informe de latencias, también si acaba antes de tiempo
+        vigilar_hasta: Fin de la vigilancia de cancelaciones (VIGILAR_CANCELACIONES); por
+            defecto HORAS_VIGILANCIA horas después de las reservas
+        hasta_apertura: Última apertura que atiende el ciclo (ejecuciones de cron, ver
+            esperar_turno_programado); las clases cerradas que abren después se dejan
+            a su propia ejecución en vez de esperarlas en FASE 2
+    """
+    if medidor:
+        medidor.reiniciar()
+    try:
+        await _ciclo_de_reservas(session, reloj, db_manager, config, limite, medidor, vigilar_hasta, hasta_apertura)
+    finally:
+        if medidor:
+            await guardar_informe_ejecucion(medidor, db_manager, config["email"])
+
+
+async def _ciclo_de_reservas(session: httpx.AsyncClient, reloj: RelojServidor, db_manager, config: dict, limite: asyncio.Semaphore | None, medidor: MedidorLatencia | None, vigilar_hasta: datetime | None, hasta_apertura: datetime | None) -> None:
+    email = config["email"]
+    password = config["password"]
+    person_code = config["person_code"]
+    usuario = {"nombre": config["nombre"], "apellidos": config["apellidos"], "correo": email}
+    
+    print("\n🎯 SISTEMA DE RESERVAS AUTOMÁTICO")
+    plan = await preparar_plan_de_reservas(db_manager, config.get("clases", CLASES))
+    if hasta_apertura:
+        limite_apertura = a_hora_local(hasta_apertura)
+        for item in plan:
+            if item["hora_apertura"] > limite_apertura:
+                print(f"⏭️ Dejando {item['clase']['nombre']} {item['fecha_clase'].strftime('%d/%m')} {item['clase']['hora']} "
+                      f"a su propia ejecución (abre el {item['hora_apertura'].strftime('%d/%m %H:%M')})")
+        plan = [item for item in plan if item["hora_apertura"] <= limite_apertura]
+    
+    if not plan:
+        print("\n✅ ¡Todas las clases ya están reservadas!")
+        return
+    
+    mostrar_plan_de_reservas(plan)
+    if medidor:
+        medidor.datos["aperturas"] = [
+            {"clase": f"{item['clase']['nombre']} {item['clase']['hora']}",
+             "fecha": item["fecha_clase"].strftime("%Y-%m-%d"),
+             "apertura": item["hora_apertura"]}
+            for item in plan
+        ]
+    
+    # Procesar todas las clases directamente (la espera se hará en el POST de reserva)
+    proximas_a_procesar = plan
+    
+    # El límite (modo multicuenta) cubre el trabajo de red hasta dejar las clases listas,
+    # no la espera a la apertura: todas las cuentas disparan a la vez
+    objetivos = []
+    vigiladas = []  # Candidatos llenos, para vigilar cancelaciones
+    carrito = Carrito(session, usuario, db_manager)
+    nombres_centros = centros_del_plan(plan)
+    centro_principal = nombres_centros[0]
+    async with limite or contextlib.nullcontext():
+        state = {}
+        sesion_guardada = False
+        if any(cookie.name == "Token" for cookie in session.cookies.jar):
+            # Cliente ya autenticado en un ciclo anterior (modo daemon)
+            sesion_guardada = True
+        elif db_manager:
+            sesion_guardada = await restaurar_sesion(session, db_manager, email)
+
+        if not sesion_guardada and not await iniciar_sesion(session, email, password, state):
+            print("❌ LOGIN FALLIDO")
+            return
+
+        navegacion = None
+        if sesion_guardada and db_manager:
+            navegacion = await reutilizar_tokens_navegacion(session, db_manager, email, state, centro_principal)
+        tokens_reutilizados = navegacion is not None
+
+        if navegacion is None:
+            try:
+                navegacion = await navegar_a_alta_eventos(session, state, centro_principal)
+            except (httpx.HTTPError, ValueError):
+                # Con una sesión guardada, una página inesperada equivale a un rechazo
+                if not sesion_guardada:
+                    raise
+                navegacion = None
+
+        if navegacion is None and sesion_guardada:
+            print("⚠️ La sesión guardada ha sido rechazada, iniciando sesión de nuevo")
+            session.cookies.clear()
+            state.clear()
+            if not await iniciar_sesion(session, email, password, state):
+                print("❌ LOGIN FALLIDO")
+                return
+            navegacion = await navegar_a_alta_eventos(session, state, centro_principal)
+
+        if navegacion is None:
+            return
+
+        token, alta_token, pagina_alta = navegacion
+
+        if db_manager:
+            await db_manager.guardar_sesion(email, exportar_cookies(session), caducidad_sesion(session))
+            if not tokens_reutilizados:
+                await db_manager.guardar_tokens_navegacion(email, centro_principal, token, alta_token)
+
+        # >>> NUEVO: Extraer PERSON_CODE del HTML <<>
+        extracted_person_code = pagina_alta.person_code
+        if extracted_person_code:
+            print(f"✅ PERSON_CODE extraído del HTML: {extracted_person_code}")
+            person_code = extracted_person_code  # Usar el extraído
+        elif not person_code and config.get("multicuenta"):
+            # El fallback es el de la cuenta original: reservar con él suplantaría a otro socio
+            print(f"❌ {email}: no se pudo extraer PERSON_CODE del HTML ni existe en la cuenta; se omite")
+            return
+        elif not person_code:
+            print("⚠️ No se pudo extraer PERSON_CODE del HTML ni existe en .env")
+            print("   Usando fallback: 9c879716dbb3e6068e0ff3a82f11cbe515346dbd6b08fd84")
+            person_code = "9c879716dbb3e6068e0ff3a82f11cbe515346dbd6b08fd84"
+        else:
+            print(f"✅ Usando PERSON_CODE del .env: {person_code}")
+
+        print("✅ Página AltaEventos cargada")
+        print(f"🕰️ Desfase con el servidor: {reloj.resumen()}")
+
+        # Resto de centros del plan, cada uno con su token y su ViewState
+        centros = {centro_principal: EstadoCentro(session, centro_principal, token, alta_token, state)}
+        for nombre_centro in nombres_centros[1:]:
+            estado_centro = await abrir_centro(session, db_manager, email, nombre_centro)
+            if estado_centro:
+                centros[nombre_centro] = estado_centro
+        if len(centros) > 1:
+            print(f"🏢 Centros abiertos: {', '.join(centros)}")
+
+        # Separar clases abiertas y cerradas
+        clases_abiertas = [p for p in proximas_a_procesar if p["ya_abierta"]]
+        clases_cerradas = [p for p in proximas_a_procesar if not p["ya_abierta"]]
+
         print("\n" + "="*60)
-        print(f"🔴 FASE 2: ESPERANDO CLASE OBJETIVO")
+        print(f"📊 RESUMEN: {len(clases_abiertas)} abiertas 🟢 | {len(clases_cerradas)} cerradas 🔴")
         print("="*60)
-        print(f"\n🎯 Clase objetivo: {clase['nombre']}")
-        print(f"   Clase: {fecha_clase.strftime('%d/%m/%Y')} {clase['hora']}")
-        print(f"   🔓 Abre: {hora_apertura.strftime('%d/%m/%Y %H:%M')}")
+
+        # ========================================
+        # FASE 1: Procesar todas las clases ABIERTAS
+        # ========================================
+        if clases_abiertas:
+            print("\n" + "="*60)
+            print(f"🟢 FASE 1: RESERVANDO {len(clases_abiertas)} CLASE(S) ABIERTA(S)")
+            print("="*60)
+    
+            for item in clases_abiertas:
+                clase = item["clase"]
+                fecha_clase = item["fecha_clase"]
         
-        # 🔧 IMPORTANTE: Recargar estado ASP.NET antes de proceder
-        # Después de las reservas anteriores, el state puede estar desincronizado
-        print(f"\n   🔄 Recargando estado de seguridad ASP.NET...")
-        alta_eventos_html_refresh = get_alta_eventos(
-            session, token=alta_token,
-            referer=f"https://deportesweb.madrid.es/DeportesWeb/Centro?token={token}"
-        )
+                print(f"\n🎯 Procesando: {clase['nombre']}")
+                print(f"   Clase: {fecha_clase.strftime('%d/%m/%Y')} {clase['hora']}")
+                print("   Estado: 🟢 Abierta")
         
-        soup_refresh = BeautifulSoup(alta_eventos_html_refresh, "html.parser")
-        state["__VIEWSTATE"] = soup_refresh.find("input", {"id": "__VIEWSTATE"})["value"]
-        state["__VIEWSTATEGENERATOR"] = soup_refresh.find("input", {"id": "__VIEWSTATEGENERATOR"})["value"]
-        ev_tag_refresh = soup_refresh.find("input", {"id": "__EVENTVALIDATION"})
-        if ev_tag_refresh:
-            state["__EVENTVALIDATION"] = ev_tag_refresh["value"]
-        print(f"   ✅ Estado recargado correctamente")
+                # Reservar o no depende de las plazas: nada de catálogos en caché
+                llenas = []
+                encontrados = await buscar_en_centros(item, centros, llenas, forzar=True)
+                if not encontrados:
+                    if llenas:
+                        print("   🈵 Sin plazas en ninguna sesión candidata")
+                        vigiladas.extend((item, centro, sesion) for centro, sesion in llenas)
+                    else:
+                        print("   ⚠️ No se encontró la sesión")
+                    continue
+
+                for centro, sesion_data in encontrados:
+                    # Hacer POST para seleccionar/reservar la clase (con reintentos ante errores transitorios)
+                    peticion = preparar_seleccion(session, centro.alta_token, sesion_data, person_code, centro.state)
+                    preparar = functools.partial(preparar_seleccion, session, centro.alta_token, sesion_data, person_code, centro.state, mostrar=False)
+                    resultado, response_seleccion = await carrito.seleccionar(peticion, centro.state, reloj, preparar=preparar)
+                    # Verificar si hay error de límite de reservas
+                    if resultado in ("limite", "ok", "carrito_incierto"):
+                        # Las plazas de esa fecha han cambiado
+                        centro.cache_eventos.invalidar(fecha_de_eventos(item))
+                    if resultado == "limite":
+                        print("   ⚠️ Límite de reservas alcanzado para esta sesión")
+                        if db_manager:
+                            await db_manager.guardar_reserva(clase, fecha_clase)
+                        print("   💾 Clase marcada como reservada en BD")
+                        break
+                    elif resultado in ("ok", "carrito_incierto"):
+
+                        print(f"   ✅ ¡RESERVA AÑADIDA AL CARRITO! ({centro.nombre})")
+                        # Agrupando, el carrito se confirma una vez al final de la fase
+                        carrito.anadir(item, centro, centro.state, preparar)
+                        if not carrito.agrupar:
+                            await carrito.confirmar()
+                        break
+                    else:
+                        detalle = response_seleccion.texto[:300] if response_seleccion else "sin respuesta"
+                        print(f"   ❌ Error en {centro.nombre} ({resultado}): {detalle}")
+                        if resultado == "completa":
+                            llenas.append((centro, sesion_data))
+                else:
+                    vigiladas.extend((item, centro, sesion) for centro, sesion in llenas)
+            
+            # Resultado clase a clase en el carrito; si el lote se rechaza, las reintenta de una en una
+            if not await carrito.confirmar():
+                print("   ⚠️ No se han podido confirmar todas las clases de la fase 1")
+
+        # ========================================
+        # FASE 2: Esperar y reservar TODAS las clases cerradas, cada una en su apertura
+        # ========================================
+        if clases_cerradas:
+            print("\n" + "="*60)
+            print(f"🔴 FASE 2: ESPERANDO {len(clases_cerradas)} CLASE(S) CERRADA(S)")
+            print("="*60)
+    
+            # 🔧 IMPORTANTE: Recargar estado ASP.NET antes de proceder
+            # Después de las reservas anteriores, el state puede estar desincronizado
+            print("\n   🔄 Recargando estado de seguridad ASP.NET...")
+            paginas = await asyncio.gather(*(
+                get_alta_eventos(session, token=centro.alta_token, referer=centro.url_centro)
+                for centro in centros.values()
+            ))
+            for centro, pagina_refresh in zip(centros.values(), paginas):
+                centro.state.update(pagina_refresh.state())
+                # Una entrada en caché restauraría el state de la fase 1 encima del recién recargado
+                centro.cache_eventos.invalidar()
+            print("   ✅ Estado recargado correctamente")
+    
+            # Cargar eventos y obtener el COD_SESION de cada clase (y de sus alternativas) antes
+            # de esperar. Cada candidato guarda su propia copia del state para que los disparos no se pisen.
+            for item in clases_cerradas:
+                clase = item["clase"]
+                fecha_clase = item["fecha_clase"]
         
-        # Cargar eventos para obtener el COD_SESION antes de esperar
-        response = load_events_for_date(
-            session=session,
-            token=alta_token,
-            fecha=fecha_para_post,
-            state=state
-        )
+                print(f"\n🎯 Clase objetivo: {clase['nombre']}")
+                print(f"   Clase: {fecha_clase.strftime('%d/%m/%Y')} {clase['hora']}")
+                print(f"   🔓 Abre: {item['hora_apertura'].strftime('%d/%m/%Y %H:%M')}")
         
-        fecha_clase_str = fecha_clase.strftime("%Y-%m-%d")
-        sesion_data = extraer_cod_sesion(
-            html_response=response,
-            nombre_clase=clase["nombre"],
-            hora_clase=clase["hora"],
-            fecha_esperada=fecha_clase_str
-        )
+                encontrados = await buscar_en_centros(item, centros)
         
-        if sesion_data:
-            print(f"   🎫 COD_SESION: {sesion_data['cod_sesion']}")
-            
-            # Esperar hasta que abra
-            ahora = datetime.now()
-            tiempo_espera = (hora_apertura - ahora).total_seconds()
-            
-            if tiempo_espera > 0:
-                horas = int(tiempo_espera // 3600)
-                minutos = int((tiempo_espera % 3600) // 60)
-                segundos = int(tiempo_espera % 60)
-                print(f"\n   ⏳ Esperando {horas}h {minutos}m {segundos}s hasta que abra...")
-                print(f"   🕐 Hora de apertura: {hora_apertura.strftime('%d/%m/%Y %H:%M:%S')}")
-                time.sleep(tiempo_espera)
-                print(f"   🔔 ¡Reserva abierta! Procediendo...")
-            
-            # Hacer POST para seleccionar/reservar la clase
-            response_seleccion = seleccionar_clase(
+                if encontrados:
+                    objetivos.append((item, [
+                        (centro, sesion_data, dict(centro.state)) for centro, sesion_data in encontrados
+                    ]))
+                else:
+                    print("   ⚠️ No se encontró la sesión para la clase objetivo")
+    
+    if objetivos and medidor:
+        # Lo que cuesta dejar los disparos listos: el planificador despierta con esa antelación
+        medidor.datos["preparacion_s"] = round((datetime.now() - medidor.inicio).total_seconds(), 1)
+    
+    if objetivos:
+        # El carrito es único por sesión: los disparos van en paralelo y las confirmaciones
+        # se serializan (agrupando las clases que entren a la vez)
+        await asyncio.gather(*(
+            reservar_en_apertura(
                 session=session,
-                token=alta_token,
-                sesion_data=sesion_data,
+                item=item,
+                candidatos=candidatos,
                 person_code=person_code,
-                state=state
+                reloj=reloj,
+                carrito=carrito,
+                db_manager=db_manager,
+                vigiladas=vigiladas
             )
-            
-            if "pageRedirect" in response_seleccion and "CarritoConfirmar" in urllib.parse.unquote(response_seleccion):
-                print(f"   ✅ ¡RESERVA AÑADIDA AL CARRITO!")
-                
-                url_alta_eventos = f"https://deportesweb.madrid.es/DeportesWeb/Modulos/VentaServicios/Eventos/AltaEventos?token={alta_token}"
-                response_carrito = confirmar_carrito(
-                    session=session,
-                    referer=url_alta_eventos,
-                    state=state
-                )
-                
-                response_final = finalizar_reserva(
-                    session=session,
-                    state=state,
-                    nombre=nombre,
-                    apellidos=apellidos,
-                    correo=email
-                )
-                
-                if "pageRedirect" in response_final and "CarritoResultado" in urllib.parse.unquote(response_final):
-                    print(f"   🎉 ¡CLASE OBJETIVO RESERVADA EXITOSAMENTE!")
-                    if db_manager:
-                        await db_manager.guardar_reserva(clase, fecha_clase)
-                else:
-                    print(f"   ⚠️ Error en confirmación: {response_final[:300]}")
-            else:
-                print(f"   ❌ Error: {response_seleccion[:300]}")
-        else:
-            print(f"   ⚠️ No se encontró la sesión para la clase objetivo")
+            for item, candidatos in objetivos
+        ))
+    
+    if VIGILAR_CANCELACIONES and vigiladas:
+        hasta = vigilar_hasta or datetime.now() + timedelta(hours=HORAS_VIGILANCIA)
+        await vigilar_cancelaciones(session, vigiladas, person_code, reloj, carrito, db_manager, hasta)
     
     print("\n" + "="*60)
     print("✅ PROCESO COMPLETADO")
     print("="*60)
+
+
+async def main(programado: bool = False):
+    config = cargar_configuracion()
+    configurar_url_base(config["url_base"])
+    db_manager = await conectar_bd(config["mongo_url"])
+    reloj = RelojServidor()
+    medidor = MedidorLatencia()
     
-    if db_manager:
+    try:
+        # Lanzado por cron: esperar (o no hacer nada) según el planificador antes de abrir sesión
+        hasta_apertura = None
+        if programado:
+            hasta_apertura = await esperar_turno_programado(db_manager, config["email"])
+            if hasta_apertura is None:
+                return
+        async with crear_cliente_http(reloj, medidor) as session:
+            await ejecutar_ciclo(session, reloj, db_manager, config, medidor=medidor, hasta_apertura=hasta_apertura)
+    finally:
+        if db_manager:
+            db_manager.cerrar()
+
+# =========================
+# MULTICUENTA
+# =========================
+
+async def ejecutar_cuenta(cuenta: dict, db_manager: DatabaseManager, reloj: RelojServidor, limite: asyncio.Semaphore) -> None:
+    """Trabajador de una cuenta: cliente HTTP, cookies, state ASP.NET y person_code propios"""
+    config = {
+        "email": cuenta["email"],
+        "password": cuenta["password"],
+        "person_code": cuenta.get("person_code"),
+        "nombre": cuenta["nombre"],
+        "apellidos": cuenta["apellidos"],
+        "clases": centros_conocidos(cuenta.get("clases", CLASES)),
+        "multicuenta": True,
+    }
+    print(f"\n👤 Cuenta: {config['email']}")
+    medidor = MedidorLatencia()
+    async with crear_cliente_http(reloj, medidor) as session:
+        await ejecutar_ciclo(session, reloj, db_manager.para_cuenta(config["email"]), config, limite, medidor)
+
+
+async def main_multicuenta():
+    """
+    Reserva a la vez para todas las cuentas activas de la colección `cuentas`.
+    
+    Cada cuenta corre en su propio trabajador con sesión aislada; como mucho
+    MAX_CUENTAS_EN_PARALELO hacen login y navegación al mismo tiempo, pero todas
+    esperan y disparan en la apertura a la vez.
+    """
+    load_dotenv()
+    configurar_url_base(os.getenv("URL_BASE"))
+    mongo_url = os.getenv("MONGO_URL")
+    if not mongo_url:
+        raise ValueError("El modo multicuenta necesita MONGO_URL en .env")
+    
+    db_manager = await conectar_bd(mongo_url)
+    try:
+        cuentas = await db_manager.cargar_cuentas()
+        if not cuentas:
+            print("⚠️ No hay cuentas activas en la colección 'cuentas'")
+            return
+        
+        print(f"\n👥 MODO MULTICUENTA: {len(cuentas)} cuenta(s), {MAX_CUENTAS_EN_PARALELO} en paralelo")
+        reloj = RelojServidor()
+        limite = asyncio.Semaphore(MAX_CUENTAS_EN_PARALELO)
+        resultados = await asyncio.gather(
+            *(ejecutar_cuenta(cuenta, db_manager, reloj, limite) for cuenta in cuentas),
+            return_exceptions=True
+        )
+        
+        for cuenta, resultado in zip(cuentas, resultados):
+            if isinstance(resultado, Exception):
+                print(f"❌ Error en la cuenta {cuenta['email']}: {resultado}")
+    finally:
         db_manager.cerrar()
 
+# =========================
+# DAEMON
+# =========================
+
+async def daemon():
+    """
+    Proceso de larga duración que sustituye a la matriz de cron.
+    
+    Calcula las aperturas con el planificador, duerme hasta proximo_despertar (el
+    coste de preparación medido más MARGEN_DESPERTAR antes de la siguiente, o
+    ANTELACION_DESPERTAR sin medidas) y lanza un ciclo de reservas con el mismo cliente HTTP (sesión caliente, sin login repetido). Todo
+    el estado duradero (reservas, cookies, tokens) vive en MongoDB, así que tras un
+    reinicio basta con volver a lanzarlo: el primer ciclo se ejecuta al arrancar y
+    recoge las clases que se hayan abierto mientras estaba parado.
+    """
+    config = cargar_configuracion()
+    configurar_url_base(config["url_base"])
+    db_manager = await conectar_bd(config["mongo_url"])
+    reloj = RelojServidor()
+    medidor = MedidorLatencia()
+    
+    print("\n🤖 MODO DAEMON")
+    
+    try:
+        async with crear_cliente_http(reloj, medidor) as session:
+            ultima_apertura = None  # Última apertura atendida con éxito
+            en_curso = datetime.now(ZONA_HORARIA)  # Apertura que se está atendiendo (el primer ciclo, al arrancar)
+            while True:
+                coste = await coste_preparacion(db_manager, config["email"])
+                if en_curso is None:
+                    # Buscar después de la última apertura atendida para no repetir el mismo ciclo
+                    despertar, hora_apertura, clase = proximo_despertar(max(datetime.now(ZONA_HORARIA), ultima_apertura), coste)
+                    print(f"\n💤 Próxima apertura: {clase['nombre']} ({clase['dia']} {clase['hora']}) "
+                          f"el {hora_apertura.strftime('%d/%m/%Y %H:%M %Z')}")
+                    print(f"   ⏰ Despertando a las {despertar.strftime('%d/%m/%Y %H:%M:%S')}")
+                    # Dormir en tramos para corregir suspensiones o cambios de hora del sistema
+                    while (espera := (despertar - datetime.now(ZONA_HORARIA)).total_seconds()) > 0:
+                        await asyncio.sleep(min(espera, 3600))
+                    en_curso = hora_apertura
+                
+                try:
+                    # La vigilancia de cancelaciones termina a tiempo para despertar en la siguiente apertura
+                    siguiente, _, _ = proximo_despertar(max(datetime.now(ZONA_HORARIA), en_curso), coste)
+                    vigilar_hasta = a_hora_local(siguiente)
+                    await ejecutar_ciclo(session, reloj, db_manager, config, medidor=medidor, vigilar_hasta=vigilar_hasta)
+                    ultima_apertura, en_curso = en_curso, None
+                except Exception as e:
+                    # Un ciclo fallido no debe tumbar el daemon, ni dar su apertura por atendida:
+                    # se repite hasta que salga (las clases ya abiertas entran en FASE 1)
+                    print(f"\n❌ Error en el ciclo: {e}\n")
+                    traceback.print_exc()
+                    print(f"🔁 Reintentando la apertura del {en_curso.strftime('%d/%m %H:%M')} en {REINTENTO_DAEMON} s")
+                    await asyncio.sleep(REINTENTO_DAEMON)
+    finally:
+        if db_manager:
+            db_manager.cerrar()
+
 if __name__ == "__main__":
+    if "--vigilar" in sys.argv[1:]:
+        VIGILAR_CANCELACIONES = True
     try:
-        asyncio.run(main())
+        if "--horario" in sys.argv[1:]:
+            posicion = sys.argv.index("--horario") + 1
+            mostrar_horario(int(sys.argv[posicion]) if posicion < len(sys.argv) and sys.argv[posicion].isdigit() else SEMANAS_HORARIO)
+        elif "--daemon" in sys.argv[1:]:
+            asyncio.run(daemon())
+        elif "--cuentas" in sys.argv[1:]:
+            asyncio.run(main_multicuenta())
+        else:
+            asyncio.run(main(programado="--programado" in sys.argv[1:]))
     except KeyboardInterrupt:
         print("\n⏹️ Interrumpido\n")
     except Exception as e:
         print(f"\n❌ Error: {e}\n")
-        import traceback
         traceback.print_exc()
\ No newline at end of file
@@ -0,0 +1,72 @@
+"""
+Benchmark de la lectura de campos ocultos de páginas completas.
+
+Compara el código anterior (árbol BeautifulSoup con html.parser) con
+extraer_campos_ocultos en sus dos backends, sobre páginas AltaEventos sintéticas.
+
+    python benchmarks/bench_campos_ocultos.py
+"""
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import ProgramaFundi as pf
+from paginas_sinteticas import generar_pagina_alta_eventos
+
+try:
+    from bs4 import BeautifulSoup
+except ImportError:
+    BeautifulSoup = None
+
+ESCENARIOS = [
+    ("normal", 60, 100_000),
+    ("grande", 150, 500_000),
+    ("extremo", 400, 2_000_000),
+]
+
+
+def state_con_beautifulsoup(html: str) -> dict:
+    """Implementación anterior de parse_initial_state"""
+    soup = BeautifulSoup(html, "html.parser")
+    state = {
+        "__VIEWSTATE": soup.find("input", {"id": "__VIEWSTATE"})["value"],
+        "__VIEWSTATEGENERATOR": soup.find("input", {"id": "__VIEWSTATEGENERATOR"})["value"],
+    }
+    ev_tag = soup.find("input", {"id": "__EVENTVALIDATION"})
+    if ev_tag:
+        state["__EVENTVALIDATION"] = ev_tag["value"]
+    return state
+
+
+def medir(funcion, html: str, repeticiones: int) -> float:
+    """Mejor tiempo en ms de `repeticiones` llamadas"""
+    return min(timeit.repeat(lambda: funcion(html), number=1, repeat=repeticiones)) * 1000
+
+
+def main():
+    metodos = []
+    if BeautifulSoup is not None:
+        metodos.append(("BeautifulSoup html.parser", state_con_beautifulsoup))
+    metodos.append(("extractor regex", lambda html: pf._state_desde_campos(pf.extraer_campos_ocultos(html, backend="regex"))))
+    if pf.etree is not None:
+        metodos.append(("extractor lxml", lambda html: pf._state_desde_campos(pf.extraer_campos_ocultos(html, backend="lxml"))))
+    
+    for nombre, n_sesiones, tamano_viewstate in ESCENARIOS:
+        html = generar_pagina_alta_eventos(n_sesiones=n_sesiones, tamano_viewstate=tamano_viewstate)
+        print(f"\n📄 Página {nombre}: {len(html) / 1024:.0f} KB, {n_sesiones} sesiones")
+        
+        referencia = None
+        for etiqueta, funcion in metodos:
+            resultado = funcion(html)
+            if referencia is None:
+                referencia = resultado
+            elif resultado != referencia:
+                print(f"   ❌ {etiqueta} devuelve un state distinto")
+                continue
+            print(f"   {etiqueta:<28} {medir(funcion, html, 5):9.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
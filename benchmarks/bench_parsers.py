@@ -0,0 +1,187 @@
+"""
+Benchmark de los parsers que corren entre la respuesta del servidor y el siguiente POST.
+
+Mide extraer_cod_sesion, extraer_person_code, parse_initial_state,
+ExtractorCamposOcultos (la página en bloques, como llega en streaming) y
+update_state_from_delta sobre respuestas AltaEventos sintéticas de tamaño
+realista y extremo (cientos de sesiones, ViewState de varios MB): mejor tiempo
+y pico de memoria (tracemalloc) de cada uno, comparados con la referencia
+guardada en referencia_parsers.json.
+
+parse_initial_state recibe la página ya decodificada, que no cuenta en su pico;
+ExtractorCamposOcultos hay que compararlo con "parse_initial_state (cuerpo en
+bytes)", que decodifica el cuerpo entero antes (lo que hacía r.text sin streaming).
+
+    python benchmarks/bench_parsers.py                      # comparar con la referencia
+    python benchmarks/bench_parsers.py --guardar-referencia # fijar la referencia en esta máquina
+
+Termina con código 1 si algún parser empeora más de TOLERANCIA respecto a la
+referencia. Los tiempos dependen de la máquina: la referencia solo es
+comparable con ejecuciones en el mismo equipo.
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+from pathlib import Path
+from typing import Callable
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import ProgramaFundi as pf
+from paginas_sinteticas import generar_delta_eventos, generar_pagina_alta_eventos, generar_sesiones
+
+RUTA_REFERENCIA = Path(__file__).resolve().parent / "referencia_parsers.json"
+
+# (nombre, sesiones del día, bytes de __VIEWSTATE)
+ESCENARIOS = [
+    ("normal", 60, 100_000),
+    ("grande", 200, 1_000_000),
+    ("extremo", 500, 4_000_000),
+]
+
+# Empeoramiento relativo tolerado y margen absoluto (ruido de medida en parsers de microsegundos)
+TOLERANCIA = 0.3
+MARGEN_MS = 0.2
+MARGEN_KB = 16
+
+# Tamaño de los bloques con los que se alimenta ExtractorCamposOcultos
+BLOQUE_STREAMING = 64 * 1024
+
+FECHA = "2026-10-19"
+PERSON_CODE = "4f1c2a9be0d37a6c85f0e9d2b1a4c3e5f6a7b8c9d0e1f2a3b4c5d6e7f8091a2b"
+
+
+def casos(n_sesiones: int, tamano_viewstate: int) -> list[tuple[str, Callable[[], object]]]:
+    """Parsers a medir sobre las respuestas del escenario, cada uno como función sin argumentos"""
+    pagina = generar_pagina_alta_eventos(n_sesiones=n_sesiones, tamano_viewstate=tamano_viewstate,
+                                         fecha=FECHA, person_code=PERSON_CODE)
+    # Sin person_code de 64 caracteres: los cinco patrones recorren la página entera
+    pagina_sin_person_code = generar_pagina_alta_eventos(n_sesiones=n_sesiones, tamano_viewstate=tamano_viewstate,
+                                                         fecha=FECHA, person_code="")
+    delta = generar_delta_eventos(n_sesiones=n_sesiones, tamano_viewstate=tamano_viewstate, fecha=FECHA)
+
+    # La última sesión del día con plazas (de las que no repiten nombre y hora): el peor caso para una búsqueda lineal
+    primeras = {}
+    for sesion in generar_sesiones(n_sesiones, FECHA):
+        primeras.setdefault((sesion["NOM_EVENTO"], sesion["HORA_DESDE"]), sesion)
+    objetivo = [s for s in primeras.values() if s["plazas_disponibles"] > 0][-1]
+
+    assert pf.extraer_person_code(pagina) == PERSON_CODE
+    assert pf.extraer_cod_sesion(delta, objetivo["NOM_EVENTO"], objetivo["HORA_DESDE"], FECHA)["cod_sesion"] == objetivo["COD_SESION"]
+
+    pagina_bytes = pagina.encode()
+
+    def extraer_en_streaming(person_code: bool) -> pf.ExtractorCamposOcultos:
+        extractor = pf.ExtractorCamposOcultos(person_code=person_code)
+        for inicio in range(0, len(pagina_bytes), BLOQUE_STREAMING):
+            if extractor.feed(pagina_bytes[inicio:inicio + BLOQUE_STREAMING]):
+                break
+        return extractor
+
+    assert extraer_en_streaming(True).person_code == PERSON_CODE
+    assert extraer_en_streaming(False).state() == pf.parse_initial_state(pagina)
+
+    return [
+        ("extraer_cod_sesion", lambda: pf.extraer_cod_sesion(delta, objetivo["NOM_EVENTO"], objetivo["HORA_DESDE"], FECHA)),
+        ("extraer_person_code", lambda: pf.extraer_person_code(pagina)),
+        ("extraer_person_code (ausente)", lambda: pf.extraer_person_code(pagina_sin_person_code)),
+        ("parse_initial_state", lambda: pf.parse_initial_state(pagina)),
+        ("parse_initial_state (cuerpo en bytes)", lambda: pf.parse_initial_state(pagina_bytes.decode("utf-8"))),
+        ("ExtractorCamposOcultos", lambda: extraer_en_streaming(False)),
+        ("ExtractorCamposOcultos (+person_code)", lambda: extraer_en_streaming(True)),
+        ("update_state_from_delta", lambda: pf.update_state_from_delta({}, delta)),
+    ]
+
+
+def medir_tiempo(funcion, repeticiones: int) -> float:
+    """Mejor tiempo en ms de `repeticiones` llamadas"""
+    return min(timeit.repeat(funcion, number=1, repeat=repeticiones)) * 1000
+
+
+def medir_memoria(funcion) -> float:
+    """Pico de memoria en KB asignada durante una llamada"""
+    tracemalloc.start()
+    try:
+        funcion()
+        _, pico = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return pico / 1024
+
+
+def ejecutar(repeticiones: int) -> dict:
+    resultados = {}
+    for nombre, n_sesiones, tamano_viewstate in ESCENARIOS:
+        print(f"\n📄 Escenario {nombre}: {n_sesiones} sesiones, ViewState {tamano_viewstate / 1_000_000:.1f} MB")
+        resultados[nombre] = {}
+        # Con la salida silenciada: extraer_cod_sesion imprime lo que encuentra
+        with open(os.devnull, "w") as nulo, contextlib.redirect_stdout(nulo):
+            casos_escenario = casos(n_sesiones, tamano_viewstate)
+        for parser, funcion in casos_escenario:
+            with open(os.devnull, "w") as nulo, contextlib.redirect_stdout(nulo):
+                ms = medir_tiempo(funcion, repeticiones)
+                kb = medir_memoria(funcion)
+            resultados[nombre][parser] = {"ms": round(ms, 3), "pico_kb": round(kb, 1)}
+            print(f"   {parser:<40} {ms:9.3f} ms {kb:10.1f} KB")
+    return resultados
+
+
+def comparar(resultados: dict, referencia: dict) -> list[str]:
+    """Regresiones de tiempo o memoria respecto a la referencia"""
+    regresiones = []
+    for escenario, parsers in resultados.items():
+        for parser, medida in parsers.items():
+            base = referencia.get(escenario, {}).get(parser)
+            if base is None:
+                continue
+            if medida["ms"] > base["ms"] * (1 + TOLERANCIA) + MARGEN_MS:
+                regresiones.append(f"{escenario} / {parser}: {base['ms']:.3f} ms -> {medida['ms']:.3f} ms")
+            if medida["pico_kb"] > base["pico_kb"] * (1 + TOLERANCIA) + MARGEN_KB:
+                regresiones.append(f"{escenario} / {parser}: {base['pico_kb']:.1f} KB -> {medida['pico_kb']:.1f} KB")
+    return regresiones
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de los parsers de AltaEventos")
+    parser.add_argument("--guardar-referencia", action="store_true", help="Guardar los resultados como nueva referencia")
+    parser.add_argument("--repeticiones", type=int, default=15)
+    args = parser.parse_args()
+
+    resultados = ejecutar(args.repeticiones)
+
+    if args.guardar_referencia:
+        RUTA_REFERENCIA.write_text(json.dumps(resultados, indent=2, ensure_ascii=False) + "\n", encoding="utf-8")
+        print(f"\n💾 Referencia guardada en {RUTA_REFERENCIA.name}")
+        return
+
+    if not RUTA_REFERENCIA.exists():
+        print("\n⚠️ No hay referencia; créala con --guardar-referencia")
+        return
+
+    referencia = json.loads(RUTA_REFERENCIA.read_text(encoding="utf-8"))
+    regresiones = comparar(resultados, referencia)
+    if regresiones:
+        # Confirmar con una segunda pasada (quedándose con el mejor de ambas) antes de darlas por buenas
+        print(f"\n🔁 {len(regresiones)} posible(s) regresión(es), repitiendo la medida...")
+        repeticion = ejecutar(args.repeticiones)
+        for escenario, parsers in resultados.items():
+            for parser, medida in parsers.items():
+                otra = repeticion[escenario][parser]
+                medida["ms"] = min(medida["ms"], otra["ms"])
+                medida["pico_kb"] = min(medida["pico_kb"], otra["pico_kb"])
+        regresiones = comparar(resultados, referencia)
+
+    if regresiones:
+        print(f"\n❌ {len(regresiones)} regresión(es) respecto a la referencia:")
+        for regresion in regresiones:
+            print(f"   {regresion}")
+        sys.exit(1)
+    print("\n✅ Sin regresiones respecto a la referencia")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+Generador de páginas y respuestas de AltaEventos sintéticas para los benchmarks.
+
+Reproduce la estructura que leen los parsers de ProgramaFundi.py: los <input>
+ocultos de ASP.NET al principio del formulario y un bloque JavaScript
+`.on('click', {...})` con las plazas por cada sesión del día.
+"""
+import base64
+import functools
+import random
+import urllib.parse
+
+NOMBRES_CLASES = [
+    "Fitness", "Pilates MesD", "Entrenamiento en suspensión", "Fuerza en sala multitrabajo",
+    "Fuerza GAP", "Entrenamiento Funcional", "Yoga", "Spinning", "Zumba", "Body Pump",
+]
+
+ID_PANEL_EVENTOS = "ContentFixedSection_uAltaEventos_uAltaEventosFechas_uplEventos"
+
+
+@functools.lru_cache(maxsize=64)
+def generar_viewstate(tamano_bytes: int, semilla: int = 0) -> str:
+    """Cadena base64 de unos `tamano_bytes` caracteres, como un __VIEWSTATE real (memorizada)"""
+    aleatorio = random.Random(semilla)
+    crudo = bytes(aleatorio.getrandbits(8) for _ in range(tamano_bytes * 3 // 4))
+    return base64.b64encode(crudo).decode("ascii")
+
+
+def generar_sesiones(n_sesiones: int, fecha: str, semilla: int = 0) -> list[dict]:
+    aleatorio = random.Random(semilla)
+    sesiones = []
+    for i in range(n_sesiones):
+        hora = 7 * 60 + (i * 15) % (15 * 60)
+        totales = aleatorio.choice((12, 16, 20, 25))
+        sesiones.append({
+            "COD_SALA": str(100 + i % 7),
+            "NOM_SALA": f"Sala {i % 7 + 1}",
+            "COD_EVENTO": str(5000 + i % len(NOMBRES_CLASES)),
+            "NOM_EVENTO": NOMBRES_CLASES[i % len(NOMBRES_CLASES)],
+            "COD_SESION": str(900000 + i),
+            "FECHA": fecha,
+            "HORA_DESDE": f"{hora // 60:02d}:{hora % 60:02d}",
+            "HORA_HASTA": f"{(hora + 60) // 60:02d}:{hora % 60:02d}",
+            "HABILITAR_LIMITE_RESERVAS": "S",
+            "LIMITE_RESERVAS": "1",
+            "SALAS_MULTIPLES": "N",
+            "plazas_disponibles": aleatorio.randint(0, totales),
+            "plazas_totales": totales,
+        })
+    return sesiones
+
+
+def bloque_sesion(sesion: dict) -> str:
+    datos = ", ".join(
+        f"{clave}: '{valor}'" for clave, valor in sesion.items()
+        if not clave.startswith("plazas_")
+    )
+    return (
+        f"$('<div/>', {{ 'class': 'evento' }}).on('click', {{ {datos} }}, seleccionarSesion)\n"
+        f"    .append($('<span/>', {{ text: '{sesion['HORA_DESDE']} - {sesion['HORA_HASTA']}' }}))\n"
+        f"    .append($('<span/>', {{ style: 'font-weight: bold' }}).append('{sesion['plazas_disponibles']}'))\n"
+        f"    .append($('<span/>', {{ style: 'font-weight: bold' }}).append('/{sesion['plazas_totales']}'))\n"
+        f"    .appendTo('#eventos');\n"
+    )
+
+
+def generar_html_eventos(sesiones: list[dict]) -> str:
+    return "<div id=\"eventos\"></div>\n<script type=\"text/javascript\">\n" + "".join(bloque_sesion(s) for s in sesiones) + "</script>\n"
+
+
+def generar_pagina_formulario(titulo: str, tamano_viewstate: int, semilla: int = 0, cuerpo: str = "") -> str:
+    """Página ASP.NET completa (GET) con los campos ocultos al principio del formulario"""
+    viewstate = generar_viewstate(tamano_viewstate, semilla)
+    validacion = generar_viewstate(max(tamano_viewstate // 20, 64), semilla + 1)
+    relleno = "".join(
+        f"<li class=\"menu\"><a href=\"#\" data-menu=\"{i}\">Opción {i}</a></li>\n" for i in range(400)
+    )
+    return (
+        f"<!DOCTYPE html>\n<html><head><title>{titulo}</title>\n"
+        "<link rel=\"stylesheet\" href=\"/DeportesWeb/estilos.css\" /></head>\n<body>\n"
+        f"<form method=\"post\" action=\"./{titulo}\" id=\"form1\">\n"
+        "<div class=\"aspNetHidden\">\n"
+        "<input type=\"hidden\" name=\"__EVENTTARGET\" id=\"__EVENTTARGET\" value=\"\" />\n"
+        "<input type=\"hidden\" name=\"__EVENTARGUMENT\" id=\"__EVENTARGUMENT\" value=\"\" />\n"
+        f"<input type=\"hidden\" name=\"__VIEWSTATE\" id=\"__VIEWSTATE\" value=\"{viewstate}\" />\n"
+        "</div>\n"
+        "<div class=\"aspNetHidden\">\n"
+        "<input type=\"hidden\" name=\"__VIEWSTATEGENERATOR\" id=\"__VIEWSTATEGENERATOR\" value=\"A1B2C3D4\" />\n"
+        f"<input type=\"hidden\" name=\"__EVENTVALIDATION\" id=\"__EVENTVALIDATION\" value=\"{validacion}\" />\n"
+        "</div>\n"
+        f"<ul class=\"menu\">\n{relleno}</ul>\n"
+        + cuerpo +
+        "</form>\n</body></html>\n"
+    )
+
+
+def generar_pagina_alta_eventos(n_sesiones: int = 60, tamano_viewstate: int = 300_000, fecha: str = "2026-10-19",
+                                semilla: int = 0, person_code: str = "9c879716dbb3e6068e0ff3a82f11cbe515346dbd6b08fd84",
+                                sesiones: list[dict] | None = None) -> str:
+    """Página AltaEventos completa (GET) con los campos ocultos arriba y las sesiones del día abajo"""
+    if sesiones is None:
+        sesiones = generar_sesiones(n_sesiones, fecha, semilla)
+    return generar_pagina_formulario(
+        "AltaEventos", tamano_viewstate, semilla,
+        f"<div id=\"usuario\" data-person-code=\"{person_code}\"></div>\n" + generar_html_eventos(sesiones)
+    )
+
+
+def segmento_delta(tipo: str, id_segmento: str, contenido: str) -> str:
+    return f"{len(contenido)}|{tipo}|{id_segmento}|{contenido}|"
+
+
+def campos_ocultos_delta(tamano_viewstate: int, semilla: int = 0) -> str:
+    """Registros hiddenField con los que ASP.NET cierra cada respuesta delta"""
+    return (
+        segmento_delta("hiddenField", "__EVENTTARGET", "")
+        + segmento_delta("hiddenField", "__EVENTARGUMENT", "")
+        + segmento_delta("hiddenField", "__VIEWSTATE", generar_viewstate(tamano_viewstate, semilla))
+        + segmento_delta("hiddenField", "__VIEWSTATEGENERATOR", "A1B2C3D4")
+        + segmento_delta("hiddenField", "__EVENTVALIDATION", generar_viewstate(max(tamano_viewstate // 20, 64), semilla + 1))
+    )
+
+
+def generar_delta_eventos(n_sesiones: int = 60, tamano_viewstate: int = 300_000, fecha: str = "2026-10-19", semilla: int = 0,
+                          sesiones: list[dict] | None = None) -> str:
+    """Respuesta delta del POST Load de AltaEventos para `fecha`"""
+    if sesiones is None:
+        sesiones = generar_sesiones(n_sesiones, fecha, semilla)
+    return (
+        segmento_delta("updatePanel", ID_PANEL_EVENTOS, generar_html_eventos(sesiones))
+        + campos_ocultos_delta(tamano_viewstate, semilla)
+        + segmento_delta("asyncPostBackControlIDs", "", "")
+        + segmento_delta("pageTitle", "", "AltaEventos")
+    )
+
+
+def generar_delta_redireccion(url: str, tamano_viewstate: int = 2_000, semilla: int = 0) -> str:
+    """Respuesta delta que manda al navegador a `url` (login correcto, SelectFacility, Seleccionar...)"""
+    return campos_ocultos_delta(tamano_viewstate, semilla) + segmento_delta("pageRedirect", "", urllib.parse.quote(url, safe="/?=&"))
+
+
+def generar_delta_alerta(mensaje: str, id_panel: str, tamano_viewstate: int = 2_000, semilla: int = 0) -> str:
+    """Respuesta delta que repinta el panel de avisos con `mensaje` (errores de negocio)"""
+    return (
+        segmento_delta("updatePanel", id_panel, f"<div class=\"alert alert-danger\">{mensaje}</div>")
+        + campos_ocultos_delta(tamano_viewstate, semilla)
+    )
@@ -0,0 +1,439 @@
+"""
+Servidor local que imita los endpoints ASP.NET de deportesweb.madrid.es para
+ejecutar el flujo completo de ProgramaFundi.py sin tocar la web real.
+
+Sirve Login, Home, Centro, AltaEventos y CarritoConfirmar con páginas y
+respuestas delta en el mismo formato que las reales (paginas_sinteticas.py):
+ViewState del tamaño indicado, latencia configurable, aperturas
+HORAS_ANTES_APERTURA antes de cada clase (o todas a la vez), plazas que se
+agotan al poco de abrir y cancelaciones que las vuelven a liberar.
+
+    python benchmarks/servidor_simulado.py --puerto 8080 --latencia-ms 80 --abrir-en 120
+    URL_BASE=http://127.0.0.1:8080 python ProgramaFundi.py
+
+Las clases de CLASES (o las de `--clases`) aparecen en su día con `--plazas` plazas, junto con
+sesiones de relleno; cada código de instalación es un centro con sus propias plazas.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import random
+import secrets
+import sys
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timedelta
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import ProgramaFundi as pf
+try:
+    import brotli
+except ImportError:  # sin brotli, --comprimir solo sirve gzip
+    brotli = None
+
+from paginas_sinteticas import (
+    campos_ocultos_delta,
+    generar_delta_alerta,
+    generar_delta_eventos,
+    generar_delta_redireccion,
+    generar_pagina_alta_eventos,
+    generar_pagina_formulario,
+    generar_sesiones,
+    segmento_delta,
+)
+
+RUTA_ALTA_EVENTOS = "/DeportesWeb/Modulos/VentaServicios/Eventos/AltaEventos"
+RUTA_CARRITO = "/DeportesWeb/Modulos/VentaServicios/CarritoConfirmar"
+RUTA_RESULTADO = "/DeportesWeb/Modulos/VentaServicios/CarritoResultado"
+
+MENSAJE_NO_ABIERTA = "La sesión seleccionada todavía no está disponible para su reserva"
+MENSAJE_LIMITE = "La sesión seleccionada no permite más de 1 reserva"
+MENSAJE_COMPLETA = "No quedan plazas disponibles en la sesión seleccionada"
+MENSAJE_CARRITO_OCUPADO = "Ya tiene una sesión en el carrito: finalice la compra antes de añadir otra"
+MENSAJE_CARRITO_VACIO = "No hay ninguna sesión en el carrito"
+MENSAJE_LOTE_RECHAZADO = "No es posible confirmar varias sesiones en una misma compra"
+
+
+def ahora_servidor() -> datetime:
+    """Hora del servidor real (Europe/Madrid), sea cual sea la zona del sistema"""
+    return datetime.now(pf.ZONA_HORARIA)
+
+
+class Simulador:
+    """
+    Estado del servidor simulado: usuarios, tokens de navegación, plazas y carritos.
+
+    Los manejadores corren en hilos distintos (ThreadingHTTPServer), así que todo
+    acceso al estado pasa por `lock`.
+    """
+
+    def __init__(self, args: argparse.Namespace):
+        self.latencia = args.latencia_ms / 1000
+        self.jitter = args.jitter_ms / 1000
+        self.tamano_viewstate = args.tamano_viewstate
+        self.relleno = args.relleno
+        self.plazas = args.plazas
+        self.agotar_tras = timedelta(milliseconds=args.agotar_tras_ms) if args.agotar_tras_ms is not None else None
+        self.apertura_fija = ahora_servidor() + timedelta(seconds=args.abrir_en) if args.abrir_en is not None else None
+        self.cancelacion = ahora_servidor() + timedelta(seconds=args.cancelar_en) if args.cancelar_en is not None else None
+        self.password = args.password
+        self.carrito_individual = args.carrito_individual
+        self.rechazar_lote = args.rechazar_lote
+        self.comprimir = args.comprimir
+        self.clases = json.loads(Path(args.clases).read_text(encoding="utf-8")) if args.clases else pf.CLASES
+        self.lock = threading.Lock()
+        self.usuarios_por_cookie: dict[str, str] = {}
+        self.tokens_centro: dict[str, str] = {}
+        self.tokens_alta: dict[str, str] = {}
+        self.sesiones: dict[str, dict] = {}
+        self.plazas_libres: dict[str, int] = {}
+        self.agotadas: set[str] = set()
+        self.canceladas: set[str] = set()
+        self.carritos: dict[str, list[str]] = {}
+        self.reservas: dict[str, set[str]] = {}
+
+    def esperar_latencia(self) -> None:
+        time.sleep(self.latencia + random.uniform(0, self.jitter))
+
+    def sesiones_del_dia(self, facility_code: str, fecha: str) -> list[dict]:
+        """Clases de CLASES de ese día de la semana más relleno; se generan una vez por centro y fecha"""
+        dia = datetime.strptime(fecha, "%Y-%m-%d").weekday()
+        compacta = fecha.replace("-", "")
+        sesiones = []
+        for clase in self.clases:
+            if pf.DIAS_SEMANA[clase["dia"]] != dia:
+                continue
+            inicio = datetime.strptime(f"{fecha} {clase['hora']}", "%Y-%m-%d %H:%M")
+            sesiones.append({
+                "COD_SALA": "101",
+                "NOM_SALA": "Sala 1",
+                "COD_EVENTO": str(5000 + len(sesiones)),
+                "NOM_EVENTO": clase["nombre"],
+                "COD_SESION": f"{facility_code}{compacta}{clase['hora'].replace(':', '')}",
+                "FECHA": fecha,
+                "HORA_DESDE": clase["hora"],
+                "HORA_HASTA": (inicio + timedelta(hours=1)).strftime("%H:%M"),
+                "HABILITAR_LIMITE_RESERVAS": "S",
+                "LIMITE_RESERVAS": "1",
+                "SALAS_MULTIPLES": "N",
+                "plazas_disponibles": self.plazas,
+                "plazas_totales": max(self.plazas, 20),
+            })
+        for sesion in generar_sesiones(self.relleno, fecha, semilla=int(compacta)):
+            sesion["COD_SESION"] = f"{facility_code}{compacta}{sesion['COD_SESION']}"
+            sesiones.append(sesion)
+
+        for sesion in sesiones:
+            self.sesiones.setdefault(sesion["COD_SESION"], sesion)
+            self.plazas_libres.setdefault(sesion["COD_SESION"], sesion["plazas_disponibles"])
+        return [self.sesiones[s["COD_SESION"]] for s in sesiones]
+
+    def apertura(self, sesion: dict) -> datetime:
+        """Apertura de la sesión con la misma regla que el cliente (pf.apertura_de_clase, en Europe/Madrid)"""
+        if self.apertura_fija:
+            return self.apertura_fija
+        inicio = datetime.strptime(f"{sesion['FECHA']} {sesion['HORA_DESDE']}", "%Y-%m-%d %H:%M")
+        return pf.apertura_de_clase(inicio.replace(tzinfo=pf.ZONA_HORARIA))
+
+    def plazas_de(self, cod_sesion: str, ahora: datetime) -> int:
+        """
+        Plazas libres; pasado `agotar_tras` desde la apertura el resto de usuarios las ha
+        agotado, y a partir de `cancelacion` cada sesión llena recupera una plaza (una vez)
+        """
+        if (self.agotar_tras is not None and cod_sesion not in self.agotadas
+                and ahora >= self.apertura(self.sesiones[cod_sesion]) + self.agotar_tras):
+            self.agotadas.add(cod_sesion)
+            self.plazas_libres[cod_sesion] = 0
+        if (self.cancelacion is not None and ahora >= self.cancelacion
+                and cod_sesion not in self.canceladas and self.plazas_libres[cod_sesion] <= 0):
+            self.canceladas.add(cod_sesion)
+            self.plazas_libres[cod_sesion] = 1
+        return self.plazas_libres[cod_sesion]
+
+    def con_plazas_actuales(self, sesiones: list[dict]) -> list[dict]:
+        ahora = ahora_servidor()
+        return [{**s, "plazas_disponibles": self.plazas_de(s["COD_SESION"], ahora)} for s in sesiones]
+
+    def seleccionar(self, email: str, cod_sesion: str) -> str | None:
+        """Añade la sesión al carrito del usuario; devuelve el mensaje de error, o None si entra"""
+        ahora = ahora_servidor()
+        sesion = self.sesiones.get(cod_sesion)
+        if sesion is None:
+            return MENSAJE_COMPLETA
+        if ahora < self.apertura(sesion):
+            return MENSAJE_NO_ABIERTA
+        if cod_sesion in self.reservas.setdefault(email, set()) or cod_sesion in self.carritos.setdefault(email, []):
+            return MENSAJE_LIMITE
+        if self.carrito_individual and self.carritos[email]:
+            return MENSAJE_CARRITO_OCUPADO
+        if self.plazas_de(cod_sesion, ahora) <= 0:
+            return MENSAJE_COMPLETA
+        self.plazas_libres[cod_sesion] -= 1
+        self.carritos[email].append(cod_sesion)
+        return None
+
+    def confirmar(self, email: str) -> list[str] | None:
+        """
+        Confirma el carrito del usuario y devuelve sus sesiones; None si `rechazar_lote` y
+        lleva varias (el carrito se vacía y sus plazas se liberan)
+        """
+        carrito = self.carritos.pop(email, [])
+        if self.rechazar_lote and len(carrito) > 1:
+            for cod_sesion in carrito:
+                self.plazas_libres[cod_sesion] += 1
+            return None
+        self.reservas.setdefault(email, set()).update(carrito)
+        return carrito
+
+
+class Manejador(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "Microsoft-IIS/10.0"
+
+    @property
+    def simulador(self) -> Simulador:
+        return self.server.simulador
+
+    def log_message(self, formato, *args):
+        pass
+
+    # ---- Respuestas ----
+
+    def comprimir(self, datos: bytes) -> tuple[bytes, str | None]:
+        """Comprime con la primera codificación que acepte el cliente (br si hay brotli, si no gzip)"""
+        if not self.simulador.comprimir or len(datos) < 1024:
+            return datos, None
+        aceptadas = {c.split(";")[0].strip() for c in self.headers.get("Accept-Encoding", "").split(",")}
+        if brotli is not None and "br" in aceptadas:
+            return brotli.compress(datos, quality=4), "br"
+        if "gzip" in aceptadas:
+            return gzip.compress(datos, compresslevel=6), "gzip"
+        return datos, None
+
+    def responder(self, cuerpo: str, tipo: str = "text/plain; charset=utf-8", cabeceras: dict | None = None) -> None:
+        datos, codificacion = self.comprimir(cuerpo.encode("utf-8"))
+        self.send_response(200)
+        self.send_header("Content-Type", tipo)
+        if codificacion:
+            self.send_header("Content-Encoding", codificacion)
+            self.send_header("Vary", "Accept-Encoding")
+        self.send_header("Content-Length", str(len(datos)))
+        self.send_header("Cache-Control", "private")
+        for nombre, valor in (cabeceras or {}).items():
+            self.send_header(nombre, valor)
+        self.end_headers()
+        self.wfile.write(datos)
+
+    def responder_html(self, html: str) -> None:
+        self.responder(html, "text/html; charset=utf-8")
+
+    def redirigir(self, ruta: str) -> None:
+        self.send_response(302)
+        self.send_header("Location", ruta)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def registrar(self, accion: str, resultado: str) -> None:
+        print(f"{ahora_servidor().strftime('%H:%M:%S.%f')[:-3]} {self.command} {urllib.parse.urlsplit(self.path).path} "
+              f"{accion} -> {resultado}")
+
+    # ---- Petición ----
+
+    def usuario(self) -> str | None:
+        cookies = {}
+        for trozo in self.headers.get("Cookie", "").split(";"):
+            if "=" in trozo:
+                nombre, valor = trozo.strip().split("=", 1)
+                cookies[nombre] = valor
+        return self.simulador.usuarios_por_cookie.get(cookies.get("Token", ""))
+
+    def token(self) -> str:
+        return urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query).get("token", [""])[0]
+
+    def formulario(self) -> tuple[dict, str, dict]:
+        """Campos del POST, acción de __EVENTARGUMENT y sus argumentos"""
+        longitud = int(self.headers.get("Content-Length", 0))
+        campos = {k: v[0] for k, v in urllib.parse.parse_qs(self.rfile.read(longitud).decode("utf-8")).items()}
+        try:
+            argumento = json.loads(campos.get("__EVENTARGUMENT", "{}"))
+        except json.JSONDecodeError:
+            argumento = {}
+        return campos, argumento.get("action", ""), argumento.get("args") or {}
+
+    def tamano_pagina(self) -> int:
+        return max(self.simulador.tamano_viewstate // 10, 64)
+
+    def do_GET(self):
+        self.simulador.esperar_latencia()
+        ruta = urllib.parse.urlsplit(self.path).path
+        sim = self.simulador
+
+        if ruta == "/DeportesWeb/Login":
+            self.responder_html(generar_pagina_formulario("Login", self.tamano_pagina()))
+            return
+
+        with sim.lock:
+            email = self.usuario()
+            facility_centro = sim.tokens_centro.get(self.token())
+            facility_alta = sim.tokens_alta.get(self.token())
+        if email is None:
+            self.registrar("GET", "sin sesión, a Login")
+            self.redirigir("/DeportesWeb/Login")
+            return
+
+        if ruta == "/DeportesWeb/Home":
+            self.responder_html(generar_pagina_formulario("Home", self.tamano_pagina()))
+        elif ruta == "/DeportesWeb/Centro" and facility_centro:
+            self.responder_html(generar_pagina_formulario("Centro", self.tamano_pagina()))
+        elif ruta == RUTA_ALTA_EVENTOS and facility_alta:
+            fecha = ahora_servidor().strftime("%Y-%m-%d")
+            with sim.lock:
+                sesiones = sim.con_plazas_actuales(sim.sesiones_del_dia(facility_alta, fecha))
+            self.responder_html(generar_pagina_alta_eventos(
+                tamano_viewstate=sim.tamano_viewstate,
+                person_code=hashlib.sha256(email.encode("utf-8")).hexdigest(),
+                sesiones=sesiones
+            ))
+        elif ruta in (RUTA_CARRITO, RUTA_RESULTADO):
+            self.responder_html(generar_pagina_formulario(ruta.rsplit("/", 1)[1], self.tamano_pagina()))
+        elif ruta in ("/DeportesWeb/Centro", RUTA_ALTA_EVENTOS):
+            self.registrar("GET", "token no válido, a Home")
+            self.redirigir("/DeportesWeb/Home")
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        self.simulador.esperar_latencia()
+        ruta = urllib.parse.urlsplit(self.path).path
+        campos, accion, args = self.formulario()
+        sim = self.simulador
+        panel = campos.get("__EVENTTARGET", "")
+
+        if not campos.get("__VIEWSTATE"):
+            self.registrar(accion, "sin __VIEWSTATE")
+            self.send_error(500, "Validation of viewstate MAC failed")
+            return
+
+        if ruta == "/DeportesWeb/Login":
+            if accion == "Login":
+                email = campos.get("ctl00$ContentFixedSection$uLogin$txtIdentificador", "")
+                if sim.password is not None and campos.get("ctl00$ContentFixedSection$uLogin$txtContrasena") != sim.password:
+                    self.registrar(accion, "credenciales incorrectas")
+                    self.responder(generar_delta_alerta("Usuario o contraseña incorrectos", panel))
+                    return
+                cookie = secrets.token_hex(32).upper()
+                with sim.lock:
+                    sim.usuarios_por_cookie[cookie] = email
+                caduca = formatdate(time.time() + pf.HORAS_VALIDEZ_SESION * 3600, usegmt=True)
+                self.registrar(accion, email)
+                self.responder(generar_delta_redireccion("/DeportesWeb/Home"), cabeceras={
+                    "Set-Cookie": f"Token={cookie}; expires={caduca}; path=/; HttpOnly",
+                })
+            else:
+                self.responder(segmento_delta("updatePanel", panel, "<div></div>") + campos_ocultos_delta(self.tamano_pagina()))
+            return
+
+        with sim.lock:
+            email = self.usuario()
+            facility_alta = sim.tokens_alta.get(self.token())
+        if email is None:
+            self.registrar(accion, "sin sesión")
+            self.responder(generar_delta_redireccion("/DeportesWeb/Login"))
+            return
+
+        if ruta == "/DeportesWeb/Home" and accion == "SelectFacility":
+            token = secrets.token_hex(16).upper()
+            with sim.lock:
+                sim.tokens_centro[token] = str(args.get("facility_code"))
+            self.registrar(accion, f"centro {args.get('facility_code')}")
+            self.responder(generar_delta_redireccion(f"/DeportesWeb/Centro?token={token}"))
+        elif ruta == "/DeportesWeb/Centro" and accion == "SelectMenu":
+            with sim.lock:
+                facility_code = sim.tokens_centro.get(self.token())
+                token = secrets.token_hex(16).upper()
+                if facility_code:
+                    sim.tokens_alta[token] = facility_code
+            if not facility_code:
+                self.responder(generar_delta_redireccion("/DeportesWeb/Home"))
+                return
+            self.responder(generar_delta_redireccion(f"{RUTA_ALTA_EVENTOS}?token={token}"))
+        elif ruta == RUTA_ALTA_EVENTOS and facility_alta and accion == "Load":
+            with sim.lock:
+                sesiones = sim.con_plazas_actuales(sim.sesiones_del_dia(facility_alta, args.get("date", "")))
+            self.registrar(accion, f"{args.get('date')} ({len(sesiones)} sesiones)")
+            self.responder(generar_delta_eventos(tamano_viewstate=sim.tamano_viewstate, sesiones=sesiones))
+        elif ruta == RUTA_ALTA_EVENTOS and facility_alta and accion == "Seleccionar":
+            with sim.lock:
+                error = sim.seleccionar(email, str(args.get("session_code")))
+            descripcion = f"{args.get('event_name')} {args.get('date')} {args.get('from_hour')}"
+            if error:
+                self.registrar(accion, f"{descripcion}: {error}")
+                self.responder(generar_delta_alerta(error, panel))
+            else:
+                self.registrar(accion, f"{descripcion}: al carrito")
+                self.responder(generar_delta_redireccion(RUTA_CARRITO))
+        elif ruta == RUTA_CARRITO and accion == "ConfirmCart":
+            with sim.lock:
+                confirmadas = sim.confirmar(email)
+            if confirmadas is None:
+                self.registrar(accion, "varias sesiones, compra rechazada")
+                self.responder(generar_delta_alerta(MENSAJE_LOTE_RECHAZADO, panel))
+                return
+            if not confirmadas:
+                self.registrar(accion, "carrito vacío")
+                self.responder(generar_delta_alerta(MENSAJE_CARRITO_VACIO, panel))
+                return
+            self.registrar(accion, f"{len(confirmadas)} reserva(s) confirmada(s)")
+            self.responder(generar_delta_redireccion(RUTA_RESULTADO))
+        else:
+            self.registrar(accion, "token o acción no válidos")
+            self.responder(generar_delta_redireccion("/DeportesWeb/Home"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servidor local que imita deportesweb.madrid.es")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--puerto", type=int, default=8080)
+    parser.add_argument("--latencia-ms", type=float, default=60, help="Latencia fija por petición")
+    parser.add_argument("--jitter-ms", type=float, default=20, help="Latencia aleatoria añadida (0..jitter)")
+    parser.add_argument("--tamano-viewstate", type=int, default=100_000, help="Bytes de __VIEWSTATE de AltaEventos")
+    parser.add_argument("--relleno", type=int, default=60, help="Sesiones de relleno por día y centro")
+    parser.add_argument("--plazas", type=int, default=3, help="Plazas libres de cada clase de CLASES")
+    parser.add_argument("--abrir-en", type=float, default=None,
+                        help="Abrir todas las sesiones dentro de N segundos (por defecto, HORAS_ANTES_APERTURA antes de cada clase)")
+    parser.add_argument("--agotar-tras-ms", type=float, default=None,
+                        help="Milisegundos tras la apertura en los que el resto de usuarios agota las plazas")
+    parser.add_argument("--cancelar-en", type=float, default=None,
+                        help="Liberar una plaza de cada sesión llena dentro de N segundos (una cancelación)")
+    parser.add_argument("--carrito-individual", action="store_true",
+                        help="Rechazar una segunda sesión mientras el carrito no esté confirmado")
+    parser.add_argument("--rechazar-lote", action="store_true",
+                        help="Aceptar varias sesiones en el carrito pero rechazar su confirmación conjunta (vacía el carrito)")
+    parser.add_argument("--comprimir", action="store_true",
+                        help="Comprimir las respuestas (br o gzip, según Accept-Encoding), como IIS con compresión dinámica")
+    parser.add_argument("--clases", default=None, help="JSON con la lista de clases a servir (por defecto, CLASES)")
+    parser.add_argument("--password", default=None, help="Contraseña exigida en el login (por defecto, cualquiera)")
+    args = parser.parse_args()
+
+    servidor = ThreadingHTTPServer((args.host, args.puerto), Manejador)
+    servidor.simulador = Simulador(args)
+
+    print(f"🧪 Servidor simulado en http://{args.host}:{args.puerto} "
+          f"(latencia {args.latencia_ms:.0f}+{args.jitter_ms:.0f} ms, ViewState {args.tamano_viewstate // 1000} KB)")
+    if servidor.simulador.apertura_fija:
+        print(f"🔓 Todas las sesiones abren a las {servidor.simulador.apertura_fija.strftime('%H:%M:%S')}")
+    print(f"   URL_BASE=http://{args.host}:{args.puerto} python ProgramaFundi.py")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        print("\n⏹️ Servidor detenido")
+
+
+if __name__ == "__main__":
+    main()